@@ -1,17 +1,21 @@
 import os
+import json
+import time
 import uuid
 import shutil
-import zipfile
 from datetime import datetime, timedelta
 from pathlib import Path
 
 from flask import (
-    Flask, request, send_file, render_template, abort, make_response,
-    session, redirect, url_for, flash
+    Flask, request, render_template, abort, make_response, Response, stream_with_context,
+    session, redirect, url_for, flash, jsonify, g, send_from_directory
 )
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text, tuple_
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload
 from flask_login import (
     LoginManager, UserMixin, login_user, login_required, 
     logout_user, current_user
@@ -19,13 +23,41 @@ from flask_login import (
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # --- IMPORTAMOS LOS MÓDULOS ACTUALIZADOS ---
-from modules.modulo_auditoria import ejecutar_auditoria
+from modules.modulo_auditoria import ejecutar_auditoria, listar_pdfs_zip
+from modules.modulo_bitacora import BitacoraEnLotes
+from modules.modulo_cfdi_xml import revisar_zip_cfdi_xml
+from modules.modulo_cache import CacheTTL
+from modules.modulo_completo import ejecutar_completo
 from modules.modulo_conciliacion import ejecutar_conciliacion, generar_resumen_ia
+from modules.modulo_entregables import SUFIJO_PARCIAL, ArchivoResultado, RetencionResultados, limpiar_resultados
+from modules.modulo_metricas import Span, registro_global, span
+from modules.modulo_subidas import (MAX_SUBIDA_MB, TAMANO_BLOQUE, VIGENCIA_SUBIDA_DIAS, ErrorSubida, bloquear,
+                                    hashes_en_curso)
+from modules.modulo_trabajos import (ColaTrabajos, ColaLlena, CuposPorUsuario, Progreso, identificar_proceso,
+                                     proceso_vivo)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'clave-secreta-paniagua-palacios-2024'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///suite_financiera.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# SQLite con 3 workers de gunicorn: pocas conexiones por proceso (peticiones, trabajos y bitácora) que
+# esperan el candado de escritura hasta 30 s en lugar de fallar con "database is locked"
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 5, 'max_overflow': 5, 'pool_timeout': 30,
+    'connect_args': {'timeout': 30, 'check_same_thread': False},
+}
+# Identidad del usuario: segundos en la caché del proceso y vigencia de la copia guardada en la sesión
+app.config['TTL_CACHE_USUARIOS'] = int(os.environ.get('SUITE_TTL_USUARIOS', 60))
+app.config['TTL_IDENTIDAD_SESION'] = int(os.environ.get('SUITE_TTL_IDENTIDAD', 900))
+# Trabajos en segundo plano: simultáneos por proceso de gunicorn y máximo en espera (global, vía DB)
+app.config['MAX_TRABAJOS_SIMULTANEOS'] = int(os.environ.get('SUITE_MAX_TRABAJOS', 2))
+app.config['MAX_TRABAJOS_EN_COLA'] = int(os.environ.get('SUITE_MAX_COLA', 10))
+# Avance en vivo: segundos mínimos entre escrituras del avance en la DB, duración de cada conexión de
+# /trabajos/<id>/eventos (corta: ocupa uno de los hilos de gunicorn y el navegador se reconecta solo) y
+# conexiones de eventos abiertas a la vez por usuario, sumando todos los workers
+app.config['INTERVALO_PROGRESO'] = float(os.environ.get('SUITE_INTERVALO_PROGRESO', 1.0))
+app.config['DURACION_EVENTOS'] = int(os.environ.get('SUITE_DURACION_EVENTOS', 5))
+app.config['EVENTOS_POR_USUARIO'] = int(os.environ.get('SUITE_EVENTOS_POR_USUARIO', 2))
 
 db = SQLAlchemy(app)
 login_manager = LoginManager(app)
@@ -46,12 +78,96 @@ class ActivityLog(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     action = db.Column(db.String(100))
     details = db.Column(db.String(255))
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     user = db.relationship('User', backref=db.backref('logs', lazy=True))
+    # Filtro por usuario ya ordenado por fecha (el id va implícito en los índices de SQLite)
+    __table_args__ = (db.Index('ix_activity_log_user_id_timestamp', 'user_id', 'timestamp'),)
+
+class Subida(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    nombre = db.Column(db.String(255))
+    tamano = db.Column(db.BigInteger) # Bytes declarados por el cliente
+    status = db.Column(db.String(20), default='subiendo') # 'subiendo' o 'completa'
+    sha256 = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Job(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    tipo = db.Column(db.String(20)) # 'conciliacion', 'auditoria' o 'completo' (ambas con una sola subida)
+    status = db.Column(db.String(20), default='en_cola') # 'en_cola', 'procesando', 'terminado' o 'error'
+    mensaje = db.Column(db.Text)
+    resultado = db.Column(db.Text) # JSON con dashboard / resumen del módulo
+    progreso = db.Column(db.Text) # JSON con el último avance por herramienta (ver Progreso)
+    archivo = db.Column(db.String(255)) # Nombre del zip en outputs/
+    proceso = db.Column(db.String(40)) # identificar_proceso() del worker que lo tiene en su pool
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    user = db.relationship('User', backref=db.backref('jobs', lazy=True))
+
+    def to_dict(self):
+        return {
+            "id": self.id, "tipo": self.tipo, "status": self.status,
+            "mensaje": self.mensaje, "archivo": self.archivo,
+            "progreso": json.loads(self.progreso) if self.progreso else None,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+class Identidad(UserMixin):
+    """Copia de solo lectura de los campos de User que usan las vistas; no pertenece a la sesión de la DB."""
+    CAMPOS = ('id', 'username', 'role', 'status')
+
+    def __init__(self, id, username, role, status):
+        self.id, self.username, self.role, self.status = id, username, role, status
+
+    @classmethod
+    def de_usuario(cls, user):
+        return cls(*(getattr(user, c) for c in cls.CAMPOS))
+
+    def a_dict(self):
+        return {c: getattr(self, c) for c in self.CAMPOS}
+
+# Invalidación compartida entre workers: approve_user toca instance/usuarios.version
+cache_usuarios = CacheTTL(ttl=app.config['TTL_CACHE_USUARIOS'], ruta_version=Path(app.instance_path) / 'usuarios.version')
+# /metrics suma los acumulados de todos los workers (cada uno deja los suyos en instance/metricas)
+registro_global.compartir(Path(app.instance_path) / 'metricas')
+
+def recordar_identidad(identidad):
+    """Guarda la identidad en la caché del proceso y una copia firmada en la cookie de sesión."""
+    version = cache_usuarios.version()
+    cache_usuarios.guardar(identidad.id, identidad)
+    session['identidad'] = dict(identidad.a_dict(), version=list(version) if version else None, guardada=time.time())
+
+def invalidar_usuario(user_id):
+    """Llamar después de cambiar estado o rol: ningún worker vuelve a usar la copia anterior."""
+    cache_usuarios.invalidar(user_id)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    """
+    Sin consultar la DB mientras se pueda: primero la caché del proceso, luego la copia en la sesión
+    (si no hubo invalidaciones desde que se guardó y no ha vencido) y solo al final User en la DB.
+    """
+    user_id = int(user_id)
+    identidad = cache_usuarios.obtener(user_id)
+    if identidad is not None:
+        return identidad
+    copia = session.get('identidad')
+    version = cache_usuarios.version()
+    if (copia and copia.get('id') == user_id and copia.get('version') == (list(version) if version else None)
+            and time.time() - copia.get('guardada', 0) < app.config['TTL_IDENTIDAD_SESION']):
+        identidad = Identidad(**{c: copia[c] for c in Identidad.CAMPOS})
+        cache_usuarios.guardar(user_id, identidad)
+        return identidad
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    identidad = Identidad.de_usuario(user)
+    recordar_identidad(identidad)
+    return identidad
 
 # --- CONFIGURACIÓN DE RUTAS Y LIMITADORES ---
 
@@ -67,12 +183,40 @@ UPLOAD_FOLDER = BASE_DIR / 'uploads'
 OUTPUT_FOLDER = BASE_DIR / 'outputs'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+# Borra de outputs/ los resultados viejos o que rebasan el espacio asignado (SUITE_RETENCION_*)
+retencion_resultados = RetencionResultados(OUTPUT_FOLDER).iniciar()
+# Subidas por bloques: '<id>.zip.parcial' mientras llegan, '<id>.zip' al completarse (ver limpiar_subidas)
+SUBIDAS_FOLDER = UPLOAD_FOLDER / 'subidas'
+os.makedirs(SUBIDAS_FOLDER, exist_ok=True)
+# Un archivo de cupo por conexión de eventos permitida a cada usuario (ver CuposPorUsuario)
+cupos_eventos = CuposPorUsuario(UPLOAD_FOLDER / 'eventos', app.config['EVENTOS_POR_USUARIO'])
 
 # --- INICIALIZACIÓN DE DB ---
 
+def configurar_sqlite(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL") # Lecturas sin bloquear al que escribe
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000") # Esperar el candado de escritura en vez de fallar
+    cursor.close()
+
 def init_db():
     with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', configurar_sqlite)
         db.create_all()
+        # create_all no agrega índices ni columnas a tablas que ya existían
+        for indice in ActivityLog.__table__.indexes:
+            indice.create(db.engine, checkfirst=True)
+        columnas_job = {c['name'] for c in inspect(db.engine).get_columns('job')}
+        for columna, tipo in (('progreso', 'TEXT'), ('proceso', 'VARCHAR(40)')):
+            if columna in columnas_job: continue
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE job ADD COLUMN {columna} {tipo}"))
+            except OperationalError:
+                pass # Otro worker la agregó al mismo tiempo
+        cerrar_trabajos_huerfanos()
         # Usuarios Maestros
         masters = {
             'YASMINPALACIOS': '19080519',
@@ -90,13 +234,50 @@ def init_db():
                 db.session.add(new_master)
         db.session.commit()
 
+def cerrar_trabajos_huerfanos():
+    """
+    Un reinicio (update_app.sh) o un worker caído se lleva los hilos de su pool: sus trabajos en cola o
+    corriendo se quedarían así para siempre, ocupando cupo. Cada worker al arrancar marca como error los
+    que pertenecían a un proceso que ya no existe y borra su carpeta temporal y su zip parcial.
+    """
+    huerfanos = [job for job in Job.query.filter(Job.status.in_(['en_cola', 'procesando']))
+                 if not job.proceso or not proceso_vivo(job.proceso)]
+    for job in huerfanos:
+        job.status, job.finished_at = 'error', datetime.utcnow()
+        job.mensaje = "El servidor se reinició antes de terminar el trabajo. Vuelve a enviarlo."
+        shutil.rmtree(UPLOAD_FOLDER / job.id, ignore_errors=True)
+        for parcial in OUTPUT_FOLDER.glob(f".*_{job.id}.zip{SUFIJO_PARCIAL}"):
+            parcial.unlink(missing_ok=True)
+    db.session.commit()
+    if huerfanos: print(f"Trabajos huérfanos cerrados: {len(huerfanos)}")
+
 init_db()
 
+# --- MÉTRICAS ---
+
+@app.before_request
+def iniciar_cronometro():
+    g.inicio_peticion = time.perf_counter()
+
+@app.after_request
+def medir_peticion(response):
+    inicio = g.pop('inicio_peticion', None)
+    if inicio is not None:
+        registro_global.observar_peticion(request.endpoint, request.method, response.status_code, time.perf_counter() - inicio)
+    return response
+
+def guardar_actividad(lote):
+    with app.app_context():
+        db.session.execute(db.insert(ActivityLog), lote)
+        db.session.commit()
+
+# Los registros se guardan en lote desde un hilo aparte, fuera de la petición
+bitacora = BitacoraEnLotes(guardar_actividad)
+
 def log_activity(action, details):
     if current_user.is_authenticated:
-        log = ActivityLog(user_id=current_user.id, action=action, details=details)
-        db.session.add(log)
-        db.session.commit()
+        bitacora.registrar({"user_id": current_user.id, "action": action, "details": details,
+                            "timestamp": datetime.utcnow()})
 
 # --- RUTAS ---
 
@@ -111,6 +292,7 @@ def login():
                 flash('Cuenta pendiente de aprobación.', 'error')
                 return redirect(url_for('login'))
             login_user(user)
+            recordar_identidad(Identidad.de_usuario(user))
             log_activity("Login", f"Usuario {username} ha entrado.")
             return redirect(url_for('home'))
         flash('Credenciales incorrectas.', 'error')
@@ -135,6 +317,7 @@ def register():
 @login_required
 def logout():
     logout_user()
+    session.pop('identidad', None)
     return redirect(url_for('login'))
 
 @app.route('/')
@@ -151,15 +334,41 @@ def home():
 @login_required
 def index():
     active_tab = request.args.get('tab', 'conciliador') 
-    return render_template('index.html', tab=active_tab)
+    return render_template('index.html', tab=active_tab, trabajo=request.args.get('trabajo'))
+
+LOGS_POR_PAGINA = 50
+
+def leer_cursor_bitacora(valor):
+    """'<fecha ISO>_<id>' -> (datetime, id); None si no viene o es inválido."""
+    try:
+        fecha, log_id = (valor or '').rsplit('_', 1)
+        return datetime.fromisoformat(fecha), int(log_id)
+    except ValueError:
+        return None
 
 @app.route('/admin')
 @login_required
 def admin_dashboard():
     if current_user.role != 'superadmin': abort(403)
-    users = User.query.all()
-    logs = ActivityLog.query.order_by(ActivityLog.timestamp.desc()).limit(50).all()
-    return render_template('admin_dashboard.html', users=users, logs=logs)
+    users = User.query.order_by(User.username).all()
+    filtro_usuario = request.args.get('usuario', type=int)
+    filtro_accion = request.args.get('accion', '').strip()
+
+    consulta = ActivityLog.query.options(joinedload(ActivityLog.user))
+    if filtro_usuario: consulta = consulta.filter(ActivityLog.user_id == filtro_usuario)
+    if filtro_accion: consulta = consulta.filter(ActivityLog.action == filtro_accion)
+    # Paginación por llave (fecha, id): "Ver anteriores" sigue desde el último renglón mostrado sin OFFSET
+    cursor = leer_cursor_bitacora(request.args.get('antes'))
+    if cursor:
+        consulta = consulta.filter(tuple_(ActivityLog.timestamp, ActivityLog.id) < tuple_(*cursor))
+    logs = consulta.order_by(ActivityLog.timestamp.desc(), ActivityLog.id.desc()).limit(LOGS_POR_PAGINA + 1).all()
+
+    siguiente = None
+    if len(logs) > LOGS_POR_PAGINA:
+        logs = logs[:LOGS_POR_PAGINA]
+        siguiente = f"{logs[-1].timestamp.isoformat()}_{logs[-1].id}"
+    return render_template('admin_dashboard.html', users=users, logs=logs, siguiente=siguiente,
+                           filtro_usuario=filtro_usuario, filtro_accion=filtro_accion, paginado=bool(cursor))
 
 @app.route('/admin/approve/<int:user_id>')
 @login_required
@@ -168,102 +377,407 @@ def approve_user(user_id):
     user = User.query.get_or_404(user_id)
     user.status = 'activo'
     db.session.commit()
+    invalidar_usuario(user.id)
     flash(f"Usuario {user.username} aprobado.", "success")
     return redirect(url_for('admin_dashboard'))
 
+@app.route('/metrics')
+@login_required
+def metricas():
+    if current_user.role != 'superadmin': abort(403)
+    response = make_response(registro_global.texto_prometheus())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+# --- TRABAJOS EN SEGUNDO PLANO ---
+cola_trabajos = ColaTrabajos(app.config['MAX_TRABAJOS_SIMULTANEOS'], app.config['MAX_TRABAJOS_EN_COLA'])
+
+def encolar_trabajo(tipo, unique_id, temp_dir):
+    """Registra el trabajo en la DB y lo manda al pool. Devuelve el id o None si no hay cupo."""
+    en_espera = Job.query.filter(Job.status.in_(['en_cola', 'procesando'])).count()
+    if en_espera >= app.config['MAX_TRABAJOS_SIMULTANEOS'] + app.config['MAX_TRABAJOS_EN_COLA']:
+        return None
+    job = Job(id=unique_id, user_id=current_user.id, tipo=tipo, proceso=identificar_proceso())
+    db.session.add(job)
+    db.session.commit()
+    try:
+        cola_trabajos.enviar(ejecutar_trabajo, job.id, tipo, temp_dir)
+    except ColaLlena:
+        job.status, job.mensaje = 'error', 'Cola llena'
+        db.session.commit()
+        return None
+    return job.id
+
+def guardar_progreso(job_id, estado):
+    """Escribe el avance con una sesión propia: también se llama desde el hilo de la conciliación (modo completo)."""
+    with app.app_context():
+        db.session.execute(db.update(Job).where(Job.id == job_id).values(progreso=json.dumps(estado)))
+        db.session.commit()
+
+def ejecutar_trabajo(job_id, tipo, temp_dir):
+    """Corre dentro del pool: ejecuta el módulo correspondiente y guarda el resultado en la DB."""
+    with app.app_context():
+        total = Span(f"trabajo.{tipo}")
+        job = db.session.get(Job, job_id)
+        job.status, job.started_at = 'procesando', datetime.utcnow()
+        db.session.commit()
+        ent_dir = temp_dir / "entregables"
+        progreso = Progreso(lambda estado: guardar_progreso(job_id, estado), app.config['INTERVALO_PROGRESO'])
+        try:
+            nombre_zip = {'conciliacion': f"Resultados_IA_{job_id}", 'auditoria': f"Conciliacion_IVA_{job_id}",
+                          'completo': f"Expediente_Completo_{job_id}"}[tipo]
+            estadisticas = {}
+            # El zip de resultados se arma mientras salen los entregables y solo aparece en outputs/ completo
+            with ArchivoResultado(OUTPUT_FOLDER, nombre_zip) as archivo:
+                if tipo == 'conciliacion':
+                    out_p = ent_dir / f"Conciliacion_IA_{job_id}.xlsx"
+                    success, db_data, msg = ejecutar_conciliacion(
+                        str(temp_dir / "cfdi.xlsx"), str(temp_dir / "aux.xlsx"), str(out_p), estadisticas=estadisticas,
+                        progreso=progreso)
+                    resultado = {"dashboard": db_data, "consejo": msg, "estadisticas": estadisticas}
+                    if success:
+                        with span("conciliacion.empaquetado") as s:
+                            for ruta in sorted(ent_dir.iterdir()):
+                                archivo.agregar(ruta)
+                        estadisticas.setdefault("etapas", []).append(dict(s.datos, nombre="empaquetado"))
+                elif tipo == 'completo':
+                    # CFDI y AUX se leen una vez para las dos herramientas; la conciliación deja su Excel en
+                    # entregables/ y la auditoría escribe directo en el zip (un solo hilo escribe en él)
+                    out_p = ent_dir / f"Conciliacion_IA_{job_id}.xlsx"
+                    success, db_data, consejo, msg = ejecutar_completo(
+                        str(temp_dir / "cfdi.xlsx"), str(temp_dir / "aux.xlsx"), str(temp_dir / "pdfs.zip"), str(out_p),
+                        estadisticas=estadisticas, archivo_resultado=archivo.zip, progreso=progreso)
+                    resultado = {"success_auditoria": msg, "dashboard": db_data, "consejo": consejo, "estadisticas": estadisticas}
+                    if success:
+                        archivo.agregar(out_p)
+                else:
+                    # CFDI y AUX van por separado (cada uno se lee una vez); los PDFs se leen directo del zip subido
+                    # y los entregables se escriben directo en el zip de resultados
+                    success, msg = ejecutar_auditoria(str(temp_dir / "cfdi.xlsx"), str(temp_dir / "aux.xlsx"), str(temp_dir / "pdfs.zip"),
+                                                      estadisticas=estadisticas, archivo_resultado=archivo.zip,
+                                                      progreso=progreso)
+                    resultado = {"success_auditoria": msg, "estadisticas": estadisticas}
+                if success: archivo.publicar()
+
+            if success:
+                job.status, job.archivo = 'terminado', archivo.ruta.name
+                job.resultado = json.dumps(resultado, default=str)
+            else:
+                job.status = 'error'
+            job.mensaje = msg
+        except Exception as e:
+            job.status, job.mensaje = 'error', str(e)
+        finally:
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            total.cerrar(error=job.status == 'error')
+
+def preparar_directorio_trabajo():
+    unique_id = uuid.uuid4().hex[:8]
+    temp_dir = UPLOAD_FOLDER / unique_id
+    os.makedirs(temp_dir / "entregables", exist_ok=True)
+    return unique_id, temp_dir
+
+def responder_trabajo(job_id, tab):
+    if job_id is None:
+        flash("El servidor está ocupado con otros procesos. Intenta de nuevo en unos minutos.", "error")
+        return redirect(url_for('index', tab=tab))
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({"job_id": job_id, "status_url": url_for('estado_trabajo', job_id=job_id)}), 202
+    return redirect(url_for('index', tab=tab, trabajo=job_id))
+
 # --- PROCESAMIENTO IA ---
 @app.route('/procesar', methods=['POST'])
 @login_required
 def procesar_ia():
-    if 'archivo_cfdi' not in request.files or 'archivo_aux' not in request.files or 'archivo_pdf' not in request.files:
+    # Solo Excel: la conciliación no usa PDFs (para ambas herramientas está el modo completo de /procesar_auditoria)
+    if 'archivo_cfdi' not in request.files or 'archivo_aux' not in request.files:
         flash("Faltan archivos.", "error")
         return redirect(url_for('index'))
         
-    f_cfdi, f_aux, f_pdf = request.files['archivo_cfdi'], request.files['archivo_aux'], request.files['archivo_pdf']
-    unique_id = str(uuid.uuid4())[:8]
-    temp_dir = UPLOAD_FOLDER / unique_id
-    pdf_dir = temp_dir / "pdfs"
-    ent_dir = temp_dir / "entregables"
-    os.makedirs(pdf_dir, exist_ok=True)
-    os.makedirs(ent_dir, exist_ok=True)
+    f_cfdi, f_aux = request.files['archivo_cfdi'], request.files['archivo_aux']
+    unique_id, temp_dir = preparar_directorio_trabajo()
 
     try:
-        cfdi_p = temp_dir / "cfdi.xlsx"
-        aux_p = temp_dir / "aux.xlsx"
-        pdf_z = temp_dir / "pdfs.zip"
-        f_cfdi.save(cfdi_p)
-        f_aux.save(aux_p)
-        f_pdf.save(pdf_z)
-        with zipfile.ZipFile(pdf_z, 'r') as z: z.extractall(pdf_dir)
-
-        out_p = ent_dir / f"Conciliacion_IA_{unique_id}.xlsx"
-        success, db_data, res_ia = ejecutar_conciliacion(str(cfdi_p), str(aux_p), str(out_p), str(pdf_dir), str(ent_dir))
-        
-        if success:
-            shutil.make_archive(str(OUTPUT_FOLDER / f"Resultados_IA_{unique_id}"), 'zip', str(ent_dir))
-            return render_template('index.html', tab='conciliador', dashboard=db_data, consejo=res_ia, downloadFile=f"Resultados_IA_{unique_id}.zip")
-        flash(f"Error: {res_ia}", "error")
-    except Exception as e: flash(f"Error: {e}", "error")
-    finally: shutil.rmtree(temp_dir, ignore_errors=True)
-    return redirect(url_for('index', tab='conciliador'))
+        f_cfdi.save(temp_dir / "cfdi.xlsx") # Excel o zip de XML: los módulos lo distinguen por contenido
+        f_aux.save(temp_dir / "aux.xlsx")
+        revisar_zip_cfdi_xml(temp_dir / "cfdi.xlsx") # Rechaza zips de XML bomba antes de encolar
+        job_id = encolar_trabajo('conciliacion', unique_id, temp_dir)
+    except Exception as e:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        flash(f"Error: {e}", "error")
+        return redirect(url_for('index', tab='conciliador'))
+    if job_id is None: shutil.rmtree(temp_dir, ignore_errors=True)
+    return responder_trabajo(job_id, 'conciliador')
 
 # --- PROCESAMIENTO IVA ---
 @app.route('/procesar_auditoria', methods=['POST'])
 @login_required
 def procesar_iva():
-    # Nuevos nombres de campos desde el formulario de index.html
-    if 'archivo_cfdi_iva' not in request.files or 'archivo_aux_iva' not in request.files or 'archivo_pdf_iva' not in request.files:
+    # Nuevos nombres de campos desde el formulario de index.html. El ZIP puede venir en el formulario
+    # o ya subido por bloques (/subidas), en cuyo caso llega solo su id en 'subida_pdf_iva'.
+    # Con 'incluir_conciliacion' también se corre la Conciliación IA con los mismos archivos (modo completo)
+    id_subida = request.form.get('subida_pdf_iva')
+    tipo = 'completo' if request.form.get('incluir_conciliacion') else 'auditoria'
+    if 'archivo_cfdi_iva' not in request.files or 'archivo_aux_iva' not in request.files or \
+            ('archivo_pdf_iva' not in request.files and not id_subida):
         flash("Faltan archivos para Conciliación IVA.", "error")
         return redirect(url_for('index', tab='auditoria'))
         
     f_cfdi = request.files['archivo_cfdi_iva']
     f_aux = request.files['archivo_aux_iva']
-    f_pdf = request.files['archivo_pdf_iva']
-    
-    unique_id = str(uuid.uuid4())[:8]
-    temp_dir = UPLOAD_FOLDER / unique_id
-    pdf_dir = temp_dir / "pdfs"
-    ent_dir = temp_dir / "entregables"
-    os.makedirs(pdf_dir, exist_ok=True)
-    os.makedirs(ent_dir, exist_ok=True)
+    unique_id, temp_dir = preparar_directorio_trabajo()
+    pdf_z, subida = temp_dir / "pdfs.zip", None
 
     try:
-        # En el módulo auditoría (Conciliación IVA), necesitamos combinar CFDI y AUX en uno o procesarlos.
-        # El módulo actual espera un solo 'ruta_excel'. Vamos a crear un temporal que tenga ambas hojas si es necesario, 
-        # o mejor, modificamos el módulo para aceptar ambos. 
-        # Pero por ahora, vamos a unir CFDI y AUX en un solo libro temporal para el módulo de auditoría.
-        
-        cfdi_p = temp_dir / "cfdi.xlsx"
-        aux_p = temp_dir / "aux.xlsx"
-        f_cfdi.save(cfdi_p)
-        f_aux.save(aux_p)
-        
-        # Combinar en un solo Excel para el modulo_auditoria
-        combined_p = temp_dir / "combined.xlsx"
-        with pd.ExcelWriter(combined_p, engine='openpyxl') as writer:
-            pd.read_excel(cfdi_p).to_excel(writer, sheet_name='CFDI', index=False)
-            pd.read_excel(aux_p).to_excel(writer, sheet_name='AUX', index=False)
+        f_cfdi.save(temp_dir / "cfdi.xlsx") # Excel o zip de XML: los módulos lo distinguen por contenido
+        f_aux.save(temp_dir / "aux.xlsx")
+        revisar_zip_cfdi_xml(temp_dir / "cfdi.xlsx") # Rechaza zips de XML bomba antes de encolar
+        if id_subida:
+            subida = tomar_subida(id_subida, pdf_z)
+        else:
+            request.files['archivo_pdf_iva'].save(pdf_z)
+        listar_pdfs_zip(pdf_z) # Rechaza zips inválidos o bomba antes de encolar
+        job_id = encolar_trabajo(tipo, unique_id, temp_dir)
+    except Exception as e:
+        if subida is not None: devolver_subida(subida, pdf_z)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        flash(f"Error: {e}", "error")
+        return redirect(url_for('index', tab='auditoria'))
+    if job_id is None:
+        # Sin cupo: el ZIP subido por bloques se conserva para volver a enviar sin subirlo de nuevo
+        if subida is not None:
+            devolver_subida(subida, pdf_z)
+            flash("El ZIP ya está en el servidor: al volver a enviar con el mismo archivo no se sube de nuevo.", "error")
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    elif subida is not None:
+        db.session.delete(subida)
+        db.session.commit()
+    return responder_trabajo(job_id, 'auditoria')
+
+# --- SUBIDAS POR BLOQUES (ZIP de PDFs grandes, reanudables) ---
+
+def obtener_subida(id_subida):
+    subida = db.get_or_404(Subida, id_subida)
+    if subida.user_id != current_user.id: abort(403)
+    return subida
+
+def ruta_subida(subida):
+    return SUBIDAS_FOLDER / (f"{subida.id}.zip" if subida.status == 'completa' else f"{subida.id}.zip.parcial")
+
+def estado_subida(subida, recibido=None):
+    ruta = ruta_subida(subida)
+    if recibido is None:
+        recibido = ruta.stat().st_size if ruta.exists() else 0
+    return {"id": subida.id, "nombre": subida.nombre, "tamano": subida.tamano, "recibido": recibido,
+            "tamano_bloque": TAMANO_BLOQUE, "status": subida.status, "sha256": subida.sha256,
+            "url": url_for('recibir_bloque', id_subida=subida.id)}
+
+def tomar_subida(id_subida, destino):
+    """
+    Mueve el ZIP de una subida completa a la carpeta del trabajo y devuelve la Subida. El registro se
+    borra hasta que el trabajo queda en cola (una subida se usa una sola vez); si se rechaza,
+    devolver_subida regresa el ZIP para volver a enviarlo sin subirlo otra vez.
+    """
+    subida = db.session.get(Subida, id_subida)
+    if subida is None or subida.user_id != current_user.id or subida.status != 'completa':
+        raise ValueError("La subida del ZIP no existe o no ha terminado.")
+    os.replace(ruta_subida(subida), destino)
+    return subida
+
+def devolver_subida(subida, origen):
+    if origen.exists():
+        os.replace(origen, ruta_subida(subida))
+
+def limpiar_subidas(directorio, max_dias=VIGENCIA_SUBIDA_DIAS):
+    """
+    Borra las subidas abandonadas: sin bloques nuevos (mtime del archivo) en max_dias, o sin archivo y
+    creadas hace más de max_dias; luego los archivos que ya no tienen registro. Devuelve (borrados, bytes).
+    """
+    limite = time.time() - max_dias * 86400
+    vencidas, liberados = [], 0
+    with app.app_context():
+        for subida in db.session.execute(db.select(Subida)).scalars():
+            try:
+                st = ruta_subida(subida).stat()
+                ultima, tamano = st.st_mtime, st.st_size
+            except FileNotFoundError:
+                ultima, tamano = (subida.created_at - datetime(1970, 1, 1)).total_seconds(), 0
+            if ultima < limite:
+                vencidas.append(subida.id)
+                liberados += tamano
+        for id_subida in vencidas:
+            for ruta in (SUBIDAS_FOLDER / f"{id_subida}.zip", SUBIDAS_FOLDER / f"{id_subida}.zip{SUFIJO_PARCIAL}"):
+                ruta.unlink(missing_ok=True)
+            hashes_en_curso.descartar(id_subida)
+        if vencidas:
+            # Borrado en bloque: otro worker puede estar borrando las mismas al mismo tiempo
+            db.session.execute(db.delete(Subida).where(Subida.id.in_(vencidas)))
+            db.session.commit()
+    borrados, bytes_sueltos = limpiar_resultados(directorio, max_dias=max_dias, max_mb=10 ** 9)
+    return len(vencidas) + borrados, liberados + bytes_sueltos
+
+retencion_subidas = RetencionResultados(SUBIDAS_FOLDER, limpiar=limpiar_subidas).iniciar()
+
+@app.route('/subidas', methods=['POST'])
+@login_required
+def crear_subida():
+    datos = request.get_json(silent=True) or {}
+    nombre, tamano = str(datos.get('nombre', '')), datos.get('tamano')
+    if not nombre.lower().endswith('.zip') or not isinstance(tamano, int) or tamano <= 0:
+        return jsonify({"error": "Se espera un .zip con su tamaño en bytes."}), 400
+    if tamano > MAX_SUBIDA_MB * 1024 * 1024:
+        return jsonify({"error": f"El archivo rebasa el máximo de {MAX_SUBIDA_MB} MB."}), 413
+    subida = Subida(id=uuid.uuid4().hex, user_id=current_user.id, nombre=nombre[:255], tamano=tamano)
+    db.session.add(subida)
+    db.session.commit()
+    ruta_subida(subida).touch()
+    return jsonify(estado_subida(subida, 0)), 201
 
-        pdf_z = temp_dir / "pdfs.zip"
-        f_pdf.save(pdf_z)
-        with zipfile.ZipFile(pdf_z, 'r') as z: z.extractall(pdf_dir)
+@app.route('/subidas/<id_subida>', methods=['GET'])
+@login_required
+def consultar_subida(id_subida):
+    """Desde qué byte reanudar: lo que ya está escrito en disco."""
+    return jsonify(estado_subida(obtener_subida(id_subida)))
 
-        success, msg = ejecutar_auditoria(str(combined_p), str(pdf_dir), str(ent_dir))
-        
-        if success:
-            shutil.make_archive(str(OUTPUT_FOLDER / f"Conciliacion_IVA_{unique_id}"), 'zip', str(ent_dir))
-            return render_template('index.html', tab='auditoria', success_auditoria=msg, downloadFileAuditoria=f"Conciliacion_IVA_{unique_id}.zip")
-        flash(f"Error: {msg}", "error")
-    except Exception as e: flash(f"Error: {e}", "error")
-    finally: shutil.rmtree(temp_dir, ignore_errors=True)
-    return redirect(url_for('index', tab='auditoria'))
+@app.route('/subidas/<id_subida>', methods=['PUT'])
+@login_required
+def recibir_bloque(id_subida):
+    subida = obtener_subida(id_subida)
+    offset, longitud = request.args.get('offset', type=int), request.content_length
+    if subida.status != 'subiendo':
+        return jsonify({"error": "La subida ya se completó."}), 409
+    if offset is None or not longitud or longitud > TAMANO_BLOQUE or offset + longitud > subida.tamano:
+        return jsonify({"error": "Bloque inválido.", "tamano_bloque": TAMANO_BLOQUE}), 400
+    ruta = ruta_subida(subida)
+    if not ruta.exists():
+        return jsonify({"error": "La subida expiró, vuelve a empezar."}), 410
+    try:
+        with bloquear(ruta) as f:
+            recibido = hashes_en_curso.anexar(subida.id, f, offset, request.stream, longitud)
+    except ErrorSubida as e:
+        return jsonify({"error": str(e), "recibido": e.recibido}), 409
+    return jsonify({"recibido": recibido})
+
+@app.route('/subidas/<id_subida>/completar', methods=['POST'])
+@login_required
+def completar_subida(id_subida):
+    subida = obtener_subida(id_subida)
+    if subida.status == 'completa':
+        return jsonify(estado_subida(subida))
+    ruta = ruta_subida(subida)
+    if not ruta.exists():
+        return jsonify({"error": "La subida expiró, vuelve a empezar."}), 410
+    with bloquear(ruta) as f:
+        recibido = os.fstat(f.fileno()).st_size
+        if recibido != subida.tamano:
+            return jsonify({"error": "Faltan bloques.", "recibido": recibido}), 409
+        sha256 = hashes_en_curso.finalizar(subida.id, f)
+    esperado = (request.get_json(silent=True) or {}).get('sha256')
+    if esperado and esperado.lower() != sha256:
+        ruta.unlink(missing_ok=True)
+        db.session.delete(subida)
+        db.session.commit()
+        return jsonify({"error": "El SHA-256 no coincide, vuelve a subir el archivo."}), 422
+    try:
+        listar_pdfs_zip(ruta) # Rechaza zips inválidos o bomba en cuanto termina la subida
+    except Exception as e:
+        ruta.unlink(missing_ok=True)
+        db.session.delete(subida)
+        db.session.commit()
+        return jsonify({"error": str(e)}), 422
+    subida.status, subida.sha256 = 'completa', sha256
+    os.replace(ruta, ruta_subida(subida))
+    db.session.commit()
+    return jsonify(estado_subida(subida))
+
+def obtener_trabajo(job_id):
+    job = db.get_or_404(Job, job_id)
+    if job.user_id != current_user.id and current_user.role != 'superadmin': abort(403)
+    return job
 
-import pandas as pd # Importado para la combinación temporal
+@app.route('/trabajos/<job_id>')
+@login_required
+def estado_trabajo(job_id):
+    job = obtener_trabajo(job_id)
+    data = job.to_dict()
+    if job.status == 'terminado':
+        data["estadisticas"] = json.loads(job.resultado or '{}').get('estadisticas', {})
+        data["resultado_url"] = url_for('resultado_trabajo', job_id=job.id)
+        data["descarga_url"] = url_for('descargar', filename=job.archivo)
+    return jsonify(data)
+
+def evento_sse(evento, datos):
+    return f"event: {evento}\ndata: {json.dumps(datos)}\n\n"
+
+@app.route('/trabajos/<job_id>/eventos')
+@login_required
+def eventos_trabajo(job_id):
+    """
+    Server-Sent Events del trabajo: 'progreso' cada vez que cambia su estado o avance (lo escribe en la DB
+    el worker que lo corre) y 'fin' al terminar, con la URL del resultado o el error. La conexión se
+    cierra a los DURACION_EVENTOS segundos y EventSource se reconecta solo. Cada usuario tiene a lo más
+    EVENTOS_POR_USUARIO conexiones abiertas; de más recibe 429 y la página consulta el estado por polling.
+    """
+    obtener_trabajo(job_id)
+    intervalo, duracion = app.config['INTERVALO_PROGRESO'], app.config['DURACION_EVENTOS']
+    cupo = cupos_eventos.tomar(current_user.id)
+    if cupo is None:
+        return jsonify({"error": "Demasiadas conexiones de avance abiertas."}), 429, {'Retry-After': '10'}
+
+    def generar():
+        yield "retry: 1000\n\n"
+        anterior, limite, ultimo_envio = None, time.monotonic() + duracion, time.monotonic()
+        while time.monotonic() < limite:
+            fila = db.session.execute(db.select(Job.status, Job.progreso, Job.mensaje).where(Job.id == job_id)).one()
+            db.session.rollback() # Cierra la lectura: la siguiente consulta ve lo que escribió el trabajo
+            if fila.status in ('terminado', 'error'):
+                yield evento_sse('fin', {"status": fila.status, "mensaje": fila.mensaje,
+                                         "resultado_url": url_for('resultado_trabajo', job_id=job_id)})
+                return
+            if (fila.status, fila.progreso) != anterior:
+                anterior = (fila.status, fila.progreso)
+                yield evento_sse('progreso', {"status": fila.status, "progreso": json.loads(fila.progreso or 'null')})
+                ultimo_envio = time.monotonic()
+            elif time.monotonic() - ultimo_envio > 15:
+                yield ": latido\n\n" # Comentario SSE: mantiene viva la conexión a través de nginx
+                ultimo_envio = time.monotonic()
+            time.sleep(intervalo)
+
+    response = Response(stream_with_context(generar()), mimetype='text/event-stream')
+    response.call_on_close(lambda: cupos_eventos.soltar(cupo)) # Corre aunque el cliente corte a la mitad
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # nginx no debe juntar los eventos en su buffer
+    return response
+
+@app.route('/trabajos/<job_id>/resultado')
+@login_required
+def resultado_trabajo(job_id):
+    job = obtener_trabajo(job_id)
+    tab = 'conciliador' if job.tipo == 'conciliacion' else 'auditoria'
+    if job.status == 'error':
+        flash(f"Error: {job.mensaje}", "error")
+        return redirect(url_for('index', tab=tab))
+    if job.status != 'terminado':
+        return redirect(url_for('index', tab=tab, trabajo=job.id))
+    resultado = json.loads(job.resultado or '{}')
+    if job.tipo in ('auditoria', 'completo'):
+        # En el modo completo el resultado de la conciliación (dashboard / consejo) se muestra junto al de la auditoría
+        return render_template('index.html', tab=tab, success_auditoria=resultado.get('success_auditoria'), downloadFileAuditoria=job.archivo,
+                               estadisticas=resultado.get('estadisticas'), dashboard=resultado.get('dashboard'),
+                               consejo=resultado.get('consejo'))
+    return render_template('index.html', tab=tab, dashboard=resultado.get('dashboard'), consejo=resultado.get('consejo'), downloadFile=job.archivo,
+                           estadisticas=resultado.get('estadisticas'))
 
 @app.route('/descargar/<path:filename>')
 @login_required
 def descargar(filename):
-    return send_file(OUTPUT_FOLDER / filename, as_attachment=True)
+    # conditional=True: ETag / Last-Modified y respuestas 206 a peticiones Range para reanudar descargas
+    if not (OUTPUT_FOLDER / filename).is_file():
+        flash("El archivo ya no está disponible (los resultados se conservan por tiempo limitado).", "error")
+        return redirect(url_for('index'))
+    return send_from_directory(OUTPUT_FOLDER, filename, as_attachment=True, conditional=True)
 
 if __name__ == '__main__':
     app.run(debug=True, port=5001, host='0.0.0.0')
\ No newline at end of file
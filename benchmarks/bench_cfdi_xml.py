@@ -0,0 +1,53 @@
+# bench_cfdi_xml.py
+"""
+Compara la carga del CFDI desde el reporte de Excel contra el zip de XML (modulo_cfdi_xml),
+en un solo proceso y con el pool de procesos, y verifica que las columnas coincidan.
+
+Uso (desde la raíz del proyecto):
+    python benchmarks/bench_cfdi_xml.py --facturas 20000 --workers 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from generador import generar_cfdi, generar_cfdi_xml, generar_facturas
+from modules.modulo_cfdi_xml import leer_cfdi_xml
+from modules.modulo_conciliacion import load_cfdi
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--facturas", type=int, default=20000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        facturas = generar_facturas(args.facturas)
+        ruta_xlsx, ruta_zip = os.path.join(tmp, "cfdi.xlsx"), os.path.join(tmp, "cfdi_xml.zip")
+        generar_cfdi(ruta_xlsx, facturas)
+        generar_cfdi_xml(ruta_zip, facturas)
+
+        inicio = time.perf_counter()
+        df_excel = load_cfdi(ruta_xlsx, usar_cache=False)
+        t_excel = time.perf_counter() - inicio
+        for workers in sorted({1, args.workers}):
+            estadisticas = {}
+            inicio = time.perf_counter()
+            leer_cfdi_xml(ruta_zip, workers=workers, estadisticas=estadisticas)
+            print(f"XML   workers={workers}: {time.perf_counter() - inicio:7.3f}s ({estadisticas['xml_por_segundo']:9.0f} archivos/s, "
+                  f"{estadisticas['xml_errores']} con error)")
+        df_xml = load_cfdi(ruta_zip, usar_cache=False)
+
+    print(f"Excel             : {t_excel:7.3f}s ({len(df_excel) / t_excel:9.0f} filas/s)")
+    columnas = ['UUID', 'Folio', 'Total', 'Emisión', 'Monto_Target', 'Razon_Social']
+    iguales = df_excel[columnas].reset_index(drop=True).equals(df_xml[columnas].reset_index(drop=True))
+    print(f"Columnas de load_cfdi iguales entre Excel y XML: {iguales}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# bench_extraccion_pdf.py
+"""
+Compara los motores de extracción de montos de modulo_auditoria:
+- 'search_for': get_text() + page.search_for() por cada monto distinto (motor anterior).
+- 'cajas': una sola pasada sobre las cajas de caracteres (rawdict).
+
+Uso (desde la raíz del proyecto):
+    python benchmarks/bench_extraccion_pdf.py --pdfs 10 --paginas 20
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from generador import generar_pdfs
+from modules.modulo_auditoria import indexar_pdfs_profundo
+
+
+def medir(rutas, motor):
+    inicio = time.perf_counter()
+    indice = indexar_pdfs_profundo(rutas, workers=1, motor=motor)
+    return time.perf_counter() - inicio, indice
+
+
+def comparar(indice_a, indice_b):
+    """Cuenta montos con las mismas ocurrencias (ruta, página, rect redondeado) en ambos índices."""
+    def normalizar(indice):
+        return {m: [(e["ruta"], e["pag"], tuple(round(v, 1) for v in e["rect"])) for e in lista]
+                for m, lista in indice.items()}
+    a, b = normalizar(indice_a), normalizar(indice_b)
+    iguales = sum(1 for m in a if a[m] == b.get(m))
+    return iguales, len(a), len(b)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdfs", type=int, default=10)
+    parser.add_argument("--paginas", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rutas = generar_pdfs(tmp, args.pdfs, args.paginas)
+        total_paginas = args.pdfs * args.paginas
+
+        t_anterior, indice_anterior = medir(rutas, "search_for")
+        t_cajas, indice_cajas = medir(rutas, "cajas")
+        iguales, montos_anterior, montos_cajas = comparar(indice_anterior, indice_cajas)
+
+    print(f"PDFs: {args.pdfs} | Páginas: {total_paginas}")
+    print(f"search_for: {t_anterior:8.3f}s  ({total_paginas / t_anterior:8.1f} pág/s)")
+    print(f"cajas:      {t_cajas:8.3f}s  ({total_paginas / t_cajas:8.1f} pág/s)")
+    print(f"Aceleración: x{t_anterior / t_cajas:.1f}")
+    print(f"Montos idénticos: {iguales} de {montos_anterior} (cajas: {montos_cajas})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# bench_ingesta_excel.py
+"""
+Compara la lectura de CFDI / AUX de modulo_conciliacion:
+- 'read_excel': pd.read_excel(engine='openpyxl') sobre todo el libro (lectura anterior).
+- 'leer_hoja': una sola pasada en modo read-only solo con las columnas necesarias
+  (con calamine si está instalado, ver SUITE_MOTOR_EXCEL).
+
+Uso (desde la raíz del proyecto):
+    python benchmarks/bench_ingesta_excel.py --filas 50000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pandas as pd
+from generador import generar_aux, generar_cfdi, generar_facturas
+from modules.modulo_conciliacion import load_aux, load_cfdi
+from modules.modulo_excel import motor_disponible
+
+
+def medir(funcion, *args, **kwargs):
+    inicio = time.perf_counter()
+    resultado = funcion(*args, **kwargs)
+    return time.perf_counter() - inicio, resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filas", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        facturas = generar_facturas(args.filas)
+        ruta_cfdi, ruta_aux = os.path.join(tmp, "cfdi.xlsx"), os.path.join(tmp, "aux.xlsx")
+        generar_cfdi(ruta_cfdi, facturas)
+        generar_aux(ruta_aux, facturas)
+        t_cfdi_ant, _ = medir(pd.read_excel, ruta_cfdi, sheet_name='CFDI REC PROV', header=4, engine='openpyxl')
+        t_aux_ant, _ = medir(pd.read_excel, ruta_aux, sheet_name='AUX', header=0, engine='openpyxl')
+        t_cfdi, df_cfdi = medir(load_cfdi, ruta_cfdi, usar_cache=False)
+        t_aux, df_aux = medir(load_aux, ruta_aux, usar_cache=False)
+
+    print(f"Facturas generadas: {args.filas} | Motor: {motor_disponible()}")
+    for nombre, t_ant, t_nuevo, df in [("CFDI", t_cfdi_ant, t_cfdi, df_cfdi), ("AUX", t_aux_ant, t_aux, df_aux)]:
+        print(f"{nombre:5} read_excel: {t_ant:7.3f}s ({len(df) / t_ant:9.0f} filas/s) | "
+              f"leer_hoja: {t_nuevo:7.3f}s ({len(df) / t_nuevo:9.0f} filas/s) | x{t_ant / t_nuevo:.1f} | {len(df)} filas")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# bench_pipeline.py
+"""
+Benchmark de punta a punta de ejecutar_conciliacion y ejecutar_auditoria sobre datos sintéticos
+(ver generador.py), con tiempo por etapa y memoria pico. Cada corrida va en un proceso aparte para
+que la memoria pico de una no contamine a la siguiente.
+
+Uso (desde la raíz del proyecto):
+    python benchmarks/bench_pipeline.py --filas 1000,10000 --pdfs 10
+    python benchmarks/bench_pipeline.py --filas 100000 --pdfs 500 --salida base.json
+    python benchmarks/bench_pipeline.py --filas 1000 --pdfs 10 --comparar base.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+RAIZ = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(RAIZ))
+
+DIR_RESULTADOS = RAIZ / "benchmarks" / "resultados"
+PIPELINES = ("conciliacion", "auditoria")
+
+
+def _rss_pico_mb():
+    """Memoria residente pico del proceso y de sus hijos ya terminados (procesos de indexado de PDFs)."""
+    propio = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    hijos = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    factor = 1024 * 1024 if sys.platform == "darwin" else 1024 # macOS reporta bytes, Linux KB
+    return round(propio / factor, 1), round(hijos / factor, 1)
+
+
+def correr_hijo(pipeline, directorio):
+    """Se ejecuta en el proceso hijo: corre un pipeline y escribe el resultado como JSON en stdout."""
+    estadisticas = {}
+    inicio = time.perf_counter()
+    if pipeline == "conciliacion":
+        from modules.modulo_conciliacion import ejecutar_conciliacion
+        salida = os.path.join(directorio, "salida_conciliacion.xlsx")
+        exito, dashboard, mensaje = ejecutar_conciliacion(os.path.join(directorio, "cfdi.xlsx"), os.path.join(directorio, "aux.xlsx"),
+                                                          salida, estadisticas=estadisticas, usar_cache=False)
+        detalle = {fila["Paso"]: fila["Coincidencias"] for fila in dashboard}
+    else:
+        from modules.modulo_auditoria import ejecutar_auditoria
+        entregables = os.path.join(directorio, "entregables_auditoria")
+        os.makedirs(entregables, exist_ok=True)
+        exito, mensaje = ejecutar_auditoria(os.path.join(directorio, "cfdi.xlsx"), os.path.join(directorio, "aux.xlsx"),
+                                            os.path.join(directorio, "pdfs.zip"), dir_entregables=entregables,
+                                            estadisticas=estadisticas, usar_cache=False)
+        detalle = {k: v for k, v in estadisticas.items() if k not in ("tiempos", "etapas")}
+    total = time.perf_counter() - inicio
+    rss, rss_hijos = _rss_pico_mb()
+    print(json.dumps({"exito": exito, "mensaje": mensaje if not exito else "", "total_s": round(total, 3),
+                      "etapas_s": estadisticas.get("tiempos", {}), "etapas": estadisticas.get("etapas", []), "rss_pico_mb": rss,
+                      "rss_pico_hijos_mb": rss_hijos, "detalle": detalle}, default=str))
+
+
+def medir(pipeline, directorio):
+    proceso = subprocess.run([sys.executable, __file__, "--hijo", pipeline, directorio],
+                             capture_output=True, text=True, cwd=str(RAIZ))
+    lineas = [l for l in proceso.stdout.splitlines() if l.startswith("{")]
+    if proceso.returncode != 0 or not lineas:
+        return {"exito": False, "mensaje": proceso.stderr.strip().splitlines()[-1:] or "sin salida"}
+    return json.loads(lineas[-1])
+
+
+def _commit_actual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=str(RAIZ)).stdout.strip()
+    except OSError:
+        return ""
+
+
+def imprimir(resultado):
+    r = resultado
+    if not r["exito"]:
+        print(f"{r['pipeline']:13} filas={r['filas']:>7} pdfs={r['pdfs']:>4} | ERROR: {r.get('mensaje')}")
+        return
+    etapas = " ".join(f"{k}={v:.2f}s" for k, v in r["etapas_s"].items())
+    print(f"{r['pipeline']:13} filas={r['filas']:>7} pdfs={r['pdfs']:>4} | total {r['total_s']:8.2f}s | "
+          f"RSS pico {r['rss_pico_mb']:7.1f} MB | {etapas}")
+
+
+def comparar(actuales, ruta_base):
+    """Diferencia contra una corrida anterior guardada con --salida (misma pipeline, filas y pdfs)."""
+    with open(ruta_base, encoding="utf-8") as f:
+        base = {(r["pipeline"], r["filas"], r["pdfs"]): r for r in json.load(f)["resultados"]}
+    print(f"\nComparación contra {ruta_base}:")
+    for r in actuales:
+        b = base.get((r["pipeline"], r["filas"], r["pdfs"]))
+        if not b or not b.get("exito") or not r.get("exito"):
+            continue
+        cambio_t = (r["total_s"] / b["total_s"] - 1) * 100 if b["total_s"] else 0
+        cambio_m = (r["rss_pico_mb"] / b["rss_pico_mb"] - 1) * 100 if b["rss_pico_mb"] else 0
+        print(f"{r['pipeline']:13} filas={r['filas']:>7} pdfs={r['pdfs']:>4} | tiempo {b['total_s']:.2f}s -> {r['total_s']:.2f}s "
+              f"({cambio_t:+.1f}%) | RSS {b['rss_pico_mb']:.1f} -> {r['rss_pico_mb']:.1f} MB ({cambio_m:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filas", default="1000,10000", help="Escalas separadas por coma (ej. 1000,10000,100000)")
+    parser.add_argument("--pdfs", default="10", help="Número de PDFs separados por coma (ej. 10,100,500)")
+    parser.add_argument("--pipelines", default=",".join(PIPELINES))
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--salida", help="Archivo JSON de resultados (default: benchmarks/resultados/<fecha>.json)")
+    parser.add_argument("--comparar", help="JSON de una corrida anterior para mostrar la diferencia")
+    parser.add_argument("--hijo", nargs=2, metavar=("PIPELINE", "DIRECTORIO"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.hijo:
+        correr_hijo(*args.hijo)
+        return
+
+    from generador import generar_escenario
+
+    resultados = []
+    for filas in [int(x) for x in args.filas.split(",")]:
+        for pdfs in [int(x) for x in args.pdfs.split(",")]:
+            with tempfile.TemporaryDirectory() as tmp:
+                inicio = time.perf_counter()
+                generar_escenario(tmp, filas, pdfs, args.semilla)
+                print(f"Datos generados ({filas} facturas, {pdfs} PDFs) en {time.perf_counter() - inicio:.1f}s")
+                for pipeline in args.pipelines.split(","):
+                    resultado = {"pipeline": pipeline, "filas": filas, "pdfs": pdfs, **medir(pipeline, tmp)}
+                    imprimir(resultado)
+                    resultados.append(resultado)
+
+    salida = Path(args.salida) if args.salida else DIR_RESULTADOS / f"{datetime.now():%Y%m%d_%H%M%S}.json"
+    salida.parent.mkdir(parents=True, exist_ok=True)
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump({"fecha": datetime.now().isoformat(timespec="seconds"), "commit": _commit_actual(),
+                   "python": platform.python_version(), "cpus": os.cpu_count(), "semilla": args.semilla,
+                   "resultados": resultados}, f, indent=2, ensure_ascii=False)
+    print(f"\nResultados guardados en {salida}")
+
+    if args.comparar:
+        comparar(resultados, args.comparar)
+
+
+if __name__ == "__main__":
+    main()
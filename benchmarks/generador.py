@@ -0,0 +1,170 @@
+# generador.py
+"""
+Datos sintéticos deterministas (misma semilla = mismos archivos) para los benchmarks:
+- CFDI: hoja 'CFDI REC PROV' con encabezado en la fila 5 (UUID, Folio, Nombre Emisor, Emisión, IVA, Total).
+- AUX: hoja 'AUX' con Fecha / Debe / Haber / Concepto y las columnas IVA (H) y TOTAL (I) de la auditoría.
+- Estados de cuenta PDF (en un .zip) con los totales de las facturas entre movimientos de relleno.
+- Zip con un XML de CFDI 4.0 por factura (la alternativa al reporte de Excel).
+"""
+import os
+import random
+import zipfile
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import fitz  # PyMuPDF
+import openpyxl
+
+Factura = namedtuple('Factura', ['uuid', 'folio', 'proveedor', 'emision', 'iva', 'total'])
+
+FECHA_BASE = datetime(2024, 1, 1)
+RENGLONES_POR_PAGINA = 40
+
+
+def generar_facturas(filas, semilla=42):
+    """Facturas con montos realistas; 1 de cada 7 tiene el IVA recurrente de 160.00 (subtotal 1,000.00)."""
+    rnd = random.Random(semilla)
+    facturas = []
+    for i in range(filas):
+        subtotal = 1000.00 if i % 7 == 0 else round(rnd.uniform(100, 50000), 2)
+        iva = round(subtotal * 0.16, 2)
+        facturas.append(Factura(
+            uuid=f"{i:08X}-{rnd.getrandbits(16):04X}-4{rnd.getrandbits(12):03X}-A{rnd.getrandbits(12):03X}-{rnd.getrandbits(48):012X}",
+            folio=f"F{i}", proveedor=f"PROVEEDOR {i % 500} SA DE CV",
+            emision=FECHA_BASE + timedelta(days=rnd.randint(0, 364)), iva=iva, total=round(subtotal + iva, 2)))
+    return facturas
+
+
+def generar_cfdi(ruta, facturas):
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('CFDI REC PROV')
+    ws.append(["REPORTE DE CFDI RECIBIDOS"])
+    ws.append([])
+    ws.append(["RFC: XAXX010101000"])
+    ws.append([])
+    ws.append(['UUID', 'Folio', 'Nombre Emisor', 'Emisión', 'IVA Trasladado', 'Total'])
+    for f in facturas:
+        ws.append([f.uuid, f.folio, f.proveedor, f.emision, f.iva, f.total])
+    wb.save(ruta)
+
+
+XML_CFDI = """<?xml version="1.0" encoding="UTF-8"?>
+<cfdi:Comprobante xmlns:cfdi="http://www.sat.gob.mx/cfd/4" xmlns:tfd="http://www.sat.gob.mx/TimbreFiscalDigital" Version="4.0" Serie="A" Folio="{f.folio}" Fecha="{f.emision:%Y-%m-%dT%H:%M:%S}" SubTotal="{subtotal:.2f}" Moneda="MXN" Total="{f.total:.2f}" TipoDeComprobante="I" Exportacion="01" LugarExpedicion="06000">
+  <cfdi:Emisor Rfc="PRO{n:06d}AB1" Nombre="{f.proveedor}" RegimenFiscal="601"/>
+  <cfdi:Receptor Rfc="XAXX010101000" Nombre="DESPACHO" DomicilioFiscalReceptor="06000" RegimenFiscalReceptor="601" UsoCFDI="G03"/>
+  <cfdi:Conceptos>
+{conceptos}  </cfdi:Conceptos>
+  <cfdi:Impuestos TotalImpuestosTrasladados="{f.iva:.2f}">
+    <cfdi:Traslados>
+      <cfdi:Traslado Base="{subtotal:.2f}" Impuesto="002" TipoFactor="Tasa" TasaOCuota="0.160000" Importe="{f.iva:.2f}"/>
+    </cfdi:Traslados>
+  </cfdi:Impuestos>
+  <cfdi:Complemento>
+    <tfd:TimbreFiscalDigital Version="1.1" UUID="{uuid}" FechaTimbrado="{f.emision:%Y-%m-%dT%H:%M:%S}" RfcProvCertif="SAT970701NN3" NoCertificadoSAT="00001000000000000000"/>
+  </cfdi:Complemento>
+</cfdi:Comprobante>
+"""
+
+CONCEPTO_XML = """    <cfdi:Concepto ClaveProdServ="84111506" Cantidad="1" ClaveUnidad="E48" Descripcion="SERVICIO {k}" ValorUnitario="{importe:.2f}" Importe="{importe:.2f}" ObjetoImp="02">
+      <cfdi:Impuestos><cfdi:Traslados><cfdi:Traslado Base="{importe:.2f}" Impuesto="002" TipoFactor="Tasa" TasaOCuota="0.160000" Importe="{iva:.2f}"/></cfdi:Traslados></cfdi:Impuestos>
+    </cfdi:Concepto>
+"""
+
+
+def generar_cfdi_xml(ruta_zip, facturas, conceptos=3):
+    """Un XML de CFDI 4.0 timbrado por factura; el subtotal se reparte en varios conceptos con su propio IVA."""
+    with zipfile.ZipFile(ruta_zip, 'w', zipfile.ZIP_DEFLATED) as z:
+        for n, f in enumerate(facturas):
+            subtotal = round(f.total - f.iva, 2)
+            partes = [round(subtotal / conceptos, 2)] * (conceptos - 1)
+            partes.append(round(subtotal - sum(partes), 2))
+            texto = "".join(CONCEPTO_XML.format(k=k, importe=p, iva=p * 0.16) for k, p in enumerate(partes))
+            z.writestr(f"cfdi/{f.uuid}.xml", XML_CFDI.format(f=f, n=n % 500, subtotal=subtotal, conceptos=texto,
+                                                             uuid=f.uuid.lower()))
+
+
+def generar_aux(ruta, facturas, semilla=42):
+    """
+    ~80% de las facturas aparecen en el AUX (IVA en Debe, algunas con 1 centavo de diferencia y fecha
+    desplazada) más 10% de renglones de ruido (nómina, comisiones...).
+    """
+    rnd = random.Random(semilla + 1)
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('AUX')
+    ws.append(['Fecha', 'Tipo', 'Concepto', 'Debe', 'Haber', 'Saldo', 'Poliza', 'IVA', 'TOTAL', 'Ref'])
+    for j, f in enumerate(facturas):
+        if rnd.random() < 0.2: continue
+        iva = round(f.iva + (0.01 if rnd.random() < 0.05 else 0), 2)
+        ws.append([f.emision + timedelta(days=rnd.randint(-3, 15)), 'D', f"PAGO FACTURA {f.folio} {f.proveedor}",
+                   iva, 0, 0, f"P{j}", iva, None, None])
+        if rnd.random() < 0.1:
+            monto = round(rnd.uniform(500, 20000), 2)
+            ws.append([f.emision, 'E', rnd.choice(["NOMINA QUINCENAL", "COMISION BANCARIA", "TRASPASO ENTRE CUENTAS"]),
+                       0, monto, 0, f"N{j}", None, None, None])
+    wb.save(ruta)
+
+
+def _estado_de_cuenta(montos, rnd):
+    """Un PDF con RENGLONES_POR_PAGINA movimientos por página; cada monto real va entre cargos de relleno."""
+    doc = fitz.open()
+    for ini in range(0, max(len(montos), 1), RENGLONES_POR_PAGINA):
+        page = doc.new_page()
+        y = 50
+        for r, (fecha, folio, total) in enumerate(montos[ini:ini + RENGLONES_POR_PAGINA]):
+            relleno = round(rnd.uniform(1, 250000), 2)
+            page.insert_text((30, y), f"{fecha:%d/%m/%Y} SPEI {folio} REF {rnd.randint(1000, 99999)}", fontsize=8)
+            page.insert_text((240, y), f"${total:,.2f}", fontsize=8)
+            page.insert_text((330, y), f"{relleno:,.2f}", fontsize=8)
+            page.insert_text((420, y), f"{total + relleno:,.2f}", fontsize=8)
+            y += 18
+    datos = doc.tobytes()
+    doc.close()
+    return datos
+
+
+def generar_estados_pdf(ruta_zip, facturas, num_pdfs, semilla=42):
+    """Reparte los totales de ~90% de las facturas entre num_pdfs estados de cuenta dentro de un zip."""
+    rnd = random.Random(semilla + 2)
+    pagos = [(f.emision, f.folio, f.total) for f in facturas if rnd.random() < 0.9]
+    with zipfile.ZipFile(ruta_zip, 'w', zipfile.ZIP_DEFLATED) as z:
+        for k in range(num_pdfs):
+            z.writestr(f"bancos/estado_{k:03d}.pdf", _estado_de_cuenta(pagos[k::num_pdfs], rnd))
+
+
+def generar_pdfs(directorio, num_pdfs, paginas, renglones=RENGLONES_POR_PAGINA, semilla=42):
+    """Estados de cuenta sueltos con montos al azar: fecha, concepto, cargo/abono con y sin '$' y saldo."""
+    rnd = random.Random(semilla)
+    rutas = []
+    for k in range(num_pdfs):
+        doc = fitz.open()
+        for _ in range(paginas):
+            page = doc.new_page()
+            y = 50
+            for r in range(renglones):
+                monto = rnd.uniform(1, 250000)
+                recurrente = rnd.choice([160.00, 1000.00, monto])
+                page.insert_text((30, y), f"{r % 28 + 1:02d}/01/2024 SPEI REF {rnd.randint(1000, 99999)}", fontsize=8)
+                page.insert_text((240, y), f"{monto:,.2f}", fontsize=8)
+                page.insert_text((320, y), f"${recurrente:,.2f}", fontsize=8)
+                page.insert_text((420, y), f"{monto + recurrente:,.2f}", fontsize=8)
+                y += 18
+        ruta = os.path.join(directorio, f"estado_{k:03d}.pdf")
+        doc.save(ruta)
+        doc.close()
+        rutas.append(ruta)
+    return rutas
+
+
+def generar_escenario(directorio, filas, num_pdfs, semilla=42):
+    """CFDI + AUX + zip de PDFs para filas facturas; devuelve las rutas."""
+    os.makedirs(directorio, exist_ok=True)
+    facturas = generar_facturas(filas, semilla)
+    rutas = {
+        "cfdi": os.path.join(directorio, "cfdi.xlsx"),
+        "aux": os.path.join(directorio, "aux.xlsx"),
+        "pdfs": os.path.join(directorio, "pdfs.zip"),
+    }
+    generar_cfdi(rutas["cfdi"], facturas)
+    generar_aux(rutas["aux"], facturas, semilla)
+    generar_estados_pdf(rutas["pdfs"], facturas, num_pdfs, semilla)
+    return rutas
@@ -1,11 +1,22 @@
 # modulo_auditoria.py
+import io
 import os
 import re
+import zipfile
 from datetime import datetime
-from collections import defaultdict
+import multiprocessing
+from array import array
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
 import openpyxl
 from openpyxl.utils import column_index_from_string
 import fitz  # PyMuPDF
+from modules.modulo_cache import cache_pdf_global, cache_tablas_global, hash_archivo, hash_stream
+from modules.modulo_cfdi_xml import es_zip_cfdi_xml, leer_cfdi_xml
+from modules.modulo_conciliacion import emparejar_montos
+from modules.modulo_metricas import Etapas
+from modules.modulo_subidas import revisar_miembros_zip
 
 def formatear_moneda_pdf(valor):
     if valor is None: 
@@ -18,117 +29,563 @@ def formatear_moneda_pdf(valor):
     except (ValueError, TypeError):
         return None
 
-def indexar_pdfs_profundo(rutas):
-    indice = defaultdict(list)
-    patron_monto = re.compile(r'\d{1,3}(?:,\d{3})*\.\d{2}')
-    for ruta in rutas:
+def monto_absoluto(valor):
+    """Mismo criterio que formatear_moneda_pdf (valor absoluto, sin ceros ni textos), pero como float."""
+    try:
+        val_float = abs(float(valor))
+    except (ValueError, TypeError):
+        return None
+    return val_float if val_float else None
+
+# Diferencia máxima (en pesos) entre el IVA del AUX y el del CFDI para considerarlos la misma factura
+TOLERANCIA_IVA = float(os.environ.get('SUITE_TOLERANCIA_IVA', 0.01))
+PASO_PROGRESO = 1000 # Renglones del AUX entre reportes de avance (el reporte además se limita por tiempo)
+
+# 'editable': el AUX se carga completo y se edita (conserva estilos y fórmulas).
+# 'flujo': CFDI y AUX se recorren en read-only y el AUX de salida se escribe en write-only, renglón por
+# renglón; la memoria depende de los índices (montos de IVA y PDFs), no del tamaño del libro.
+# 'auto': 'flujo' cuando el AUX pesa más de AUX_FLUJO_MB.
+MODOS_AUX = ('editable', 'flujo', 'auto')
+MODO_AUX = os.environ.get('SUITE_MODO_AUX', 'editable')
+AUX_FLUJO_MB = int(os.environ.get('SUITE_AUX_FLUJO_MB', 50))
+
+# Un PDF suelto en disco (miembro=None) o un miembro dentro del zip subido (ruta = ruta del zip).
+DocumentoPDF = namedtuple('DocumentoPDF', ['nombre', 'ruta', 'miembro'])
+
+# Límites para rechazar zips bomba antes de leer un solo PDF
+MAX_PDFS_ZIP = int(os.environ.get('SUITE_MAX_PDFS_ZIP', 2000)) # Tamaño y compresión: ver modulo_subidas
+
+def listar_pdfs_zip(ruta_zip):
+    """
+    Lee solo el directorio central del zip y devuelve los PDFs como DocumentoPDF, sin extraer nada.
+    Lanza ValueError si el zip rebasa los límites de miembros, tamaño o tasa de compresión.
+    """
+    with zipfile.ZipFile(ruta_zip) as z:
+        miembros = [i for i in z.infolist()
+                    if not i.is_dir() and i.filename.lower().endswith('.pdf') and not i.filename.startswith('__MACOSX/')]
+    revisar_miembros_zip(miembros, MAX_PDFS_ZIP, "PDFs")
+    return [DocumentoPDF(i.filename, str(ruta_zip), i.filename) for i in sorted(miembros, key=lambda i: i.filename)]
+
+def listar_pdfs(fuente_pdfs):
+    """Acepta un zip (leído sin extraer) o una carpeta con PDFs."""
+    if zipfile.is_zipfile(fuente_pdfs):
+        return listar_pdfs_zip(fuente_pdfs)
+    return [DocumentoPDF(ruta, ruta, None)
+            for ruta in sorted(os.path.join(root, arc)
+                               for root, _, files in os.walk(fuente_pdfs)
+                               for arc in files if arc.lower().endswith('.pdf'))]
+
+def abrir_pdf(documento):
+    if documento.miembro is None:
+        return fitz.open(documento.ruta)
+    with zipfile.ZipFile(documento.ruta) as z:
+        return fitz.open(stream=z.read(documento.miembro), filetype="pdf")
+
+def hash_documento(documento):
+    if documento.miembro is None:
+        return hash_archivo(documento.ruta)
+    with zipfile.ZipFile(documento.ruta) as z, z.open(documento.miembro) as f:
+        return hash_stream(f)
+
+PATRON_MONTO = re.compile(r'\d{1,3}(?:,\d{3})*\.\d{2}')
+PDF_WORKERS = int(os.environ.get('SUITE_PDF_WORKERS', os.cpu_count() or 1))
+PAGINAS_POR_TAREA = 25 # Documentos más largos se reparten en rangos de páginas
+MIN_PAGINAS_PARALELO = 300 # Por debajo de esto no vale la pena levantar procesos
+X_MINIMO_MONTO = 50 # Ajustado para capturar montos en más áreas
+
+# 'cajas': una sola pasada sobre los caracteres posicionados de la página.
+# 'search_for': motor anterior (page.search_for por cada monto distinto), se conserva para comparar.
+MOTOR_EXTRACCION = os.environ.get('SUITE_MOTOR_PDF', 'cajas')
+VERSION_EXTRACTOR = {'cajas': 'cajas-1', 'search_for': 'search_for-1'}
+FLAGS_CAJAS = fitz.TEXTFLAGS_RAWDICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+def _montos_pagina_search_for(page, i):
+    encontrados = []
+    texto = page.get_text()
+    matches = PATRON_MONTO.findall(texto)
+    for monto in dict.fromkeys(matches): # Sin duplicados, conservando el orden de aparición
+        instancias = page.search_for(monto)
+        for rect in instancias:
+            if rect.x0 > X_MINIMO_MONTO:
+                encontrados.append((monto, i, tuple(rect)))
+    return encontrados
+
+def _montos_pagina_cajas(page, i):
+    """
+    Tokeniza los montos directo de las cajas de caracteres ('rawdict'). Cada renglón se arma con los
+    caracteres de todos sus spans, así un monto partido en spans contiguos ("1,234" + ".56") se
+    reconoce completo, y el rect sale de unir las cajas de sus caracteres, sin volver a buscar en la página.
+    """
+    encontrados = []
+    for bloque in page.get_text("rawdict", flags=FLAGS_CAJAS)["blocks"]:
+        for linea in bloque.get("lines", ()):
+            chars = [c for span in linea["spans"] for c in span["chars"]]
+            texto = "".join(c["c"] for c in chars)
+            for m in PATRON_MONTO.finditer(texto):
+                cajas = [chars[k]["bbox"] for k in range(m.start(), m.end())]
+                x0 = min(b[0] for b in cajas)
+                if x0 > X_MINIMO_MONTO:
+                    rect = (x0, min(b[1] for b in cajas), max(b[2] for b in cajas), max(b[3] for b in cajas))
+                    encontrados.append((m.group(), i, rect))
+    return encontrados
+
+MOTORES_EXTRACCION = {'cajas': _montos_pagina_cajas, 'search_for': _montos_pagina_search_for}
+
+def _indexar_rango(documento, pag_ini=0, pag_fin=None, motor=None, doc=None):
+    """
+    Indexa las páginas [pag_ini, pag_fin) de un DocumentoPDF (doc: el PDF ya abierto, que no se cierra aquí).
+    Devuelve ([(monto, pag, (x0, y0, x1, y1)), ...], completo) en orden de lectura; se usan tuplas
+    para poder regresar el resultado desde otro proceso. completo=False si el PDF falló a la mitad.
+    """
+    extraer = MOTORES_EXTRACCION[motor or MOTOR_EXTRACCION]
+    encontrados = []
+    try:
+        abierto = doc if doc is not None else abrir_pdf(documento)
+        for i in range(pag_ini, abierto.page_count if pag_fin is None else min(pag_fin, abierto.page_count)):
+            encontrados.extend(extraer(abierto[i], i))
+        if doc is None: abierto.close()
+    except Exception as e:
+        print(f"Error leyendo {os.path.basename(documento.nombre)}: {e}")
+        return encontrados, False
+    return encontrados, True
+
+def _planear_indexado(documentos, motor, avance=None):
+    """
+    Abre cada documento una vez para contar sus páginas. Mientras el total no llega a MIN_PAGINAS_PARALELO
+    el documento se indexa en esa misma apertura (una corrida que queda chica no abre ningún PDF dos veces);
+    los que siguen se parten en rangos de PAGINAS_POR_TAREA para el pool de procesos.
+    Devuelve ([(documento, (encontrados, completo)), ...] ya indexados, tareas). Un PDF que no abre queda
+    indexado como ([], False): cuenta como fallido y no se guarda en la caché.
+    """
+    indexados, tareas, paginas_vistas = [], [], 0
+    for n, documento in enumerate(documentos):
         try:
-            doc = fitz.open(ruta)
-            for i, page in enumerate(doc):
-                texto = page.get_text()
-                matches = patron_monto.findall(texto)
-                for monto in set(matches):
-                    instancias = page.search_for(monto)
-                    for rect in instancias:
-                        if rect.x0 > 50: # Ajustado para capturar montos en más áreas
-                            indice[monto].append({
-                                "ruta": ruta, "pag": i, "rect": rect, "usado": False
-                            })
-            doc.close()
+            doc = abrir_pdf(documento)
         except Exception as e:
-            print(f"Error leyendo {os.path.basename(ruta)}: {e}")
+            print(f"Error leyendo {os.path.basename(documento.nombre)}: {e}")
+            indexados.append((documento, ([], False)))
+            if avance: avance()
+            continue
+        with doc:
+            paginas = doc.page_count
+            ultimo_chico = n == len(documentos) - 1 and not tareas and paginas <= PAGINAS_POR_TAREA
+            if paginas_vistas + paginas < MIN_PAGINAS_PARALELO or ultimo_chico:
+                indexados.append((documento, _indexar_rango(documento, motor=motor, doc=doc)))
+                if avance: avance()
+            else:
+                tareas.extend((documento, ini, min(ini + PAGINAS_POR_TAREA, paginas))
+                              for ini in range(0, paginas, PAGINAS_POR_TAREA))
+        paginas_vistas += paginas
+    return indexados, tareas
+
+def indexar_pdfs_profundo(documentos, workers=None, motor=None, cache=None, estadisticas=None, progreso=None):
+    """
+    Índice monto -> [ {ruta, pag, rect, usado} ] de todos los PDFs ('ruta' es el nombre del DocumentoPDF).
+    Acepta DocumentoPDF o rutas sueltas. Con workers > 1 reparte documentos / rangos de páginas en un
+    pool de procesos. El resultado se fusiona en el orden (documento, página, aparición), igual que el
+    recorrido secuencial, para que la búsqueda del "primer match no usado" no cambie entre corridas.
+    Con cache (CacheIndicesPDF) los PDFs ya vistos (mismo SHA-256 y versión de extractor) no se vuelven a abrir.
+    progreso(etapa, hecho, total), si se pasa, recibe los PDFs indexados conforme terminan.
+    """
+    workers = PDF_WORKERS if workers is None else workers
+    motor = motor or MOTOR_EXTRACCION
+    version = VERSION_EXTRACTOR[motor]
+    documentos = [d if isinstance(d, DocumentoPDF) else DocumentoPDF(d, d, None) for d in documentos]
+
+    por_doc, hashes, pendientes = {}, {}, []
+    for documento in documentos:
+        if cache is not None:
+            try:
+                hashes[documento] = hash_documento(documento)
+                guardado = cache.obtener(hashes[documento], version)
+            except (OSError, zipfile.BadZipFile) as e:
+                print(f"Error leyendo {os.path.basename(documento.nombre)}: {e}")
+                guardado = None
+            if guardado is not None:
+                por_doc[documento] = guardado
+                continue
+        pendientes.append(documento)
+
+    hechos = len(documentos) - len(pendientes)
+    if progreso: progreso("auditoria.indexado", hechos, len(documentos))
+
+    def avance():
+        nonlocal hechos
+        hechos += 1
+        if progreso: progreso("auditoria.indexado", hechos, len(documentos))
+
+    if workers > 1:
+        resultados, tareas = _planear_indexado(pendientes, motor, avance)
+    else:
+        resultados, tareas = [], [(documento, 0, None) for documento in pendientes]
+    if len(tareas) > 1 and workers > 1:
+        # 'spawn' evita heredar hilos (pool de trabajos, SQLAlchemy) de un proceso de gunicorn
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(workers, len(tareas)), mp_context=ctx) as pool:
+            docs_t, inicios, fines = zip(*tareas)
+            ultima_tarea = {documento: k for k, documento in enumerate(docs_t)}
+            # map entrega en orden: un documento está completo al llegar su última tarea
+            for k, parcial in enumerate(pool.map(_indexar_rango, docs_t, inicios, fines, [motor] * len(tareas))):
+                resultados.append((docs_t[k], parcial))
+                if ultima_tarea[docs_t[k]] == k: avance()
+    else:
+        for documento, ini, fin in tareas:
+            resultados.append((documento, _indexar_rango(documento, ini, fin, motor)))
+            avance()
+
+    fallidos = set()
+    for documento, (encontrados, completo) in resultados:
+        por_doc.setdefault(documento, []).extend(encontrados)
+        if not completo: fallidos.add(documento)
+
+    if cache is not None:
+        for documento in pendientes:
+            if documento in hashes and documento not in fallidos:
+                cache.guardar(hashes[documento], version, por_doc.get(documento, []))
+
+    indice = defaultdict(list)
+    for documento in documentos:
+        for monto, pag, rect in por_doc.get(documento, ()):
+            indice[monto].append({
+                "ruta": documento.nombre, "pag": pag, "rect": fitz.Rect(rect), "usado": False
+            })
+
+    if estadisticas is not None:
+        estadisticas.update({
+            "pdfs_total": len(documentos), "pdfs_indexados": len(pendientes),
+            "cache_hits": len(documentos) - len(pendientes) if cache is not None else 0,
+            "cache_misses": len(pendientes) if cache is not None else 0,
+        })
     return indice
 
-def ejecutar_auditoria(ruta_excel, dir_pdfs, dir_entregables):
+def _guardar_entregable(nombre, datos, dir_entregables, archivo_resultado, comprimir=True):
+    """
+    Escribe un entregable directo en el zip de resultados (si se dio) o en la carpeta de entregables.
+    datos son bytes o una función que escribe en un archivo abierto (p. ej. wb.save), que se usa para
+    mandar el libro al zip por partes sin armarlo antes en memoria.
+    """
+    if archivo_resultado is not None:
+        compresion = zipfile.ZIP_DEFLATED if comprimir else zipfile.ZIP_STORED
+        if callable(datos):
+            info = zipfile.ZipInfo(nombre, date_time=datetime.now().timetuple()[:6])
+            info.compress_type = compresion
+            with archivo_resultado.open(info, "w") as f:
+                datos(f)
+        else:
+            archivo_resultado.writestr(nombre, datos, compress_type=compresion)
+    else:
+        with open(os.path.join(dir_entregables, nombre), "wb") as f:
+            datos(f) if callable(datos) else f.write(datos)
+
+HOJAS_AUX = ["AUX", "AUXILIAR", "AUX 2024"]
+HOJAS_CFDI = ["CFDI", "CFDI REC PROV"]
+
+def get_sheet(wb, names):
+    # Intentar obtener hojas por nombre o por índice
+    for name in names:
+        if name in wb.sheetnames: return wb[name]
+    return wb.worksheets[0]
+
+def _cargar_libro(fuente, **kwargs):
+    """Abre un libro desde ruta o stream; un stream se rebobina para poder leerlo más de una vez."""
+    if hasattr(fuente, 'seek'): fuente.seek(0)
+    return openpyxl.load_workbook(fuente, **kwargs)
+
+def _es_tabla(fuente):
+    return hasattr(fuente, 'columns') and hasattr(fuente, 'itertuples')
+
+def _es_filas(fuente):
+    return isinstance(fuente, list)
+
+def leer_filas_cfdi(fuente, cache=None, estadisticas=None):
+    """
+    Devuelve todas las filas (valores) del CFDI desde una ruta / stream de Excel (una sola lectura,
+    en modo read-only) o desde una tabla ya parseada (DataFrame), cuya primera fila son los encabezados.
+    Con cache (CacheTablas), un Excel ya leído antes no se vuelve a abrir.
+    """
+    if _es_filas(fuente):
+        return fuente
+    if _es_tabla(fuente):
+        return [tuple(fuente.columns)] + [tuple(None if v != v else v for v in fila) for fila in fuente.itertuples(index=False)]
+    def leer():
+        wb = _cargar_libro(fuente, read_only=True, data_only=True)
+        try:
+            return list(get_sheet(wb, HOJAS_CFDI).iter_rows(values_only=True))
+        finally:
+            wb.close()
+    return cache.tabla("filas_cfdi", fuente, leer, estadisticas) if cache else leer()
+
+def _abrir_aux(fuente):
+    """Libro editable con la hoja AUX: se carga completo para conservar estilos y fórmulas al guardar."""
+    if _es_tabla(fuente):
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.title = "AUX"
+        ws.append([str(c) for c in fuente.columns])
+        for fila in fuente.itertuples(index=False):
+            ws.append([None if v != v else v for v in fila])
+        return wb, ws
+    wb = _cargar_libro(fuente)
+    return wb, get_sheet(wb, HOJAS_AUX)
+
+def _columna_calculada(fuente, col_idx, cache=None, estadisticas=None):
+    """Valores calculados (cacheados por Excel) de una columna del AUX, para celdas con fórmula."""
+    def leer():
+        wb = _cargar_libro(fuente, read_only=True, data_only=True)
+        try:
+            ws = get_sheet(wb, HOJAS_AUX)
+            return {r: (fila[col_idx] if col_idx < len(fila) else None)
+                    for r, fila in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2)}
+        finally:
+            wb.close()
+    return cache.tabla(f"aux_calculada_{col_idx}", fuente, leer, estadisticas) if cache else leer()
+
+def _valor(fila, idx):
+    return fila[idx] if idx < len(fila) else None
+
+def elegir_modo_aux(modo=None, fuente_aux=None):
+    """Resuelve el modo del AUX ('editable' o 'flujo'); con 'auto' decide por el tamaño del archivo."""
+    modo = modo or MODO_AUX
+    if modo not in MODOS_AUX:
+        raise ValueError(f"Modo de AUX no soportado: {modo}")
+    if modo != 'auto':
+        return modo
+    if isinstance(fuente_aux, (str, os.PathLike)) and os.path.isfile(fuente_aux):
+        tamano = os.path.getsize(fuente_aux)
+    elif hasattr(fuente_aux, 'seek'):
+        tamano = fuente_aux.seek(0, os.SEEK_END)
+        fuente_aux.seek(0)
+    else:
+        return 'editable' # Una tabla ya parseada ya está en memoria
+    return 'flujo' if tamano > AUX_FLUJO_MB * 1024 * 1024 else 'editable'
+
+def _recorrer_filas(fuente, hojas):
+    """
+    Valores de una hoja fila por fila, encabezados incluidos, sin cargar el libro: Excel en modo
+    read-only, tabla ya parseada (DataFrame) o filas ya leídas.
+    """
+    if _es_filas(fuente):
+        yield from fuente
+        return
+    if _es_tabla(fuente):
+        yield tuple(str(c) for c in fuente.columns)
+        for fila in fuente.itertuples(index=False):
+            yield tuple(None if v != v else v for v in fila)
+        return
+    wb = _cargar_libro(fuente, read_only=True, data_only=True)
+    try:
+        yield from get_sheet(wb, hojas).iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+def _indice_iva_cfdi(filas, idx_iva, idx_total):
+    """
+    CFDI por monto de IVA: (montos, totales, filas_leidas) de las facturas con IVA, en el orden del archivo.
+    Se conservan todas aunque repitan IVA y de cada una solo el TOTAL, que es lo único que se pega en el AUX.
+    """
+    montos, totales, leidas = [], [], 0
+    for fila in filas:
+        leidas += 1
+        iva_val = monto_absoluto(_valor(fila, idx_iva))
+        if iva_val:
+            montos.append(iva_val)
+            totales.append(_valor(fila, idx_total))
+    return montos, totales, leidas
+
+def _referenciar_total(total_fiscal, db_montos, acciones_por_pdf, ref):
+    """Busca el TOTAL en los PDFs (primer monto aún no usado) y agenda su marca; True si lo encontró."""
+    total_str = formatear_moneda_pdf(total_fiscal)
+    if not total_str or total_str not in db_montos:
+        return False
+    match_encontrado = next((m for m in db_montos[total_str] if not m["usado"]), None)
+    if not match_encontrado:
+        return False
+    match_encontrado["usado"] = True
+    acciones_por_pdf[match_encontrado["ruta"]].append({
+        "pag": match_encontrado["pag"],
+        "rect": match_encontrado["rect"],
+        "ref": ref
+    })
+    return True
+
+def ejecutar_auditoria(fuente_cfdi, fuente_aux, fuente_pdfs, dir_entregables=None, estadisticas=None, usar_cache=True,
+                       archivo_resultado=None, progreso=None, modo_aux=None):
     """
     Programa: Conciliacion IVA
     1. Busca IVA de AUX en Columna IVA de CFDI.
     2. Pega info en AUX.
     3. Busca TOTAL en PDFs.
+    fuente_cfdi / fuente_aux: ruta o stream de Excel, o tabla ya parseada (DataFrame). Cada una se lee una
+    sola vez. fuente_cfdi también puede ser un zip con los XML de los CFDI o las filas de la hoja ya leídas
+    con leer_filas_cfdi. Con fuente_aux=None se asume un solo libro con ambas hojas (formato anterior 'combined').
+    fuente_pdfs puede ser el zip subido (se lee miembro por miembro, sin extraer) o una carpeta.
+    Si se pasa archivo_resultado (zipfile.ZipFile abierto en 'w'), los entregables se escriben directo
+    ahí en lugar de dir_entregables.
+    Si se pasa el dict estadisticas, se llena con los contadores del proceso (PDFs, caché), en
+    estadisticas["etapas"] un span por etapa (carga, indexado, cruce, anotacion, escritura) con segundos,
+    filas / páginas / PDFs y memoria residente (y su cambio en la etapa), y en estadisticas["tiempos"] solo los
+    segundos de cada una.
+    Con usar_cache se reutilizan los índices de PDFs y las tablas ya leídas de los mismos archivos
+    (estadisticas["tablas_cache"] indica cuáles salieron de la caché).
+    progreso(etapa, hecho, total), si se pasa (ver modulo_trabajos.Progreso), recibe el avance: PDFs
+    indexados, renglones del AUX recorridos, PDFs marcados y escritura del Excel.
+    modo_aux: 'editable', 'flujo' o 'auto' (default: SUITE_MODO_AUX). En 'flujo' el AUX de salida es un
+    libro nuevo con los valores (no fórmulas ni estilos) del original más el TOTAL y la Ref en las mismas
+    columnas, y la hoja CFDI; estadisticas["modo_aux"] indica el modo usado.
     """
+    etapas = Etapas("auditoria")
+    cache_tablas = cache_tablas_global() if usar_cache else None
     try:
-        lista_pdfs = [os.path.join(root, arc) 
-                      for root, _, files in os.walk(dir_pdfs) 
-                      for arc in files if arc.lower().endswith('.pdf')]
+        try:
+            lista_pdfs = listar_pdfs(fuente_pdfs)
+        except ValueError as e:
+            return False, str(e)
                       
         if not lista_pdfs:
             return False, "La carpeta de PDFs no existe o está vacía."
+        documentos_por_nombre = {d.nombre: d for d in lista_pdfs}
+        if progreso: progreso("auditoria.carga")
 
-        wb = openpyxl.load_workbook(ruta_excel)
-        
-        # Intentar obtener hojas por nombre o por índice
-        def get_sheet(wb, names):
-            for name in names:
-                if name in wb.sheetnames: return wb[name]
-            return wb.worksheets[0]
+        if fuente_aux is not None and not _es_tabla(fuente_cfdi) and not _es_filas(fuente_cfdi) and es_zip_cfdi_xml(fuente_cfdi):
+            if cache_tablas:
+                fuente_cfdi = cache_tablas.tabla("cfdi_xml", fuente_cfdi,
+                                                 lambda: leer_cfdi_xml(fuente_cfdi, estadisticas=estadisticas), estadisticas)
+            else:
+                fuente_cfdi = leer_cfdi_xml(fuente_cfdi, estadisticas=estadisticas)
 
-        ws_aux = get_sheet(wb, ["AUX", "AUXILIAR", "AUX 2024"])
-        ws_cfdi = get_sheet(wb, ["CFDI", "CFDI REC PROV"])
+        modo_aux = elegir_modo_aux(modo_aux, fuente_cfdi if fuente_aux is None else fuente_aux)
+        flujo = modo_aux == 'flujo'
+        if flujo:
+            # Nada se carga completo: el CFDI se recorre una vez aquí y otra al copiarlo al entregable
+            fuente_aux = fuente_cfdi if fuente_aux is None else fuente_aux
+            filas_cfdi = _recorrer_filas(fuente_cfdi, HOJAS_CFDI)
+            primeras_cfdi = list(islice(filas_cfdi, 5))
+            filas_cfdi = chain(primeras_cfdi, filas_cfdi)
+        elif fuente_aux is None:
+            wb, ws_aux = _abrir_aux(fuente_cfdi)
+            filas_cfdi = list(get_sheet(wb, HOJAS_CFDI).iter_rows(values_only=True))
+            fuente_aux = fuente_cfdi
+        else:
+            filas_cfdi = leer_filas_cfdi(fuente_cfdi, cache_tablas, estadisticas)
+            wb, ws_aux = _abrir_aux(fuente_aux)
+            # El entregable conserva también la hoja CFDI, como el libro combinado anterior
+            ws_cfdi_salida = wb.create_sheet("CFDI")
+            for fila in filas_cfdi:
+                ws_cfdi_salida.append(fila)
+        if not flujo:
+            primeras_cfdi = filas_cfdi[:5]
+            filas_cfdi = iter(filas_cfdi)
 
         # Identificar columnas en CFDI
-        headers_cfdi = [str(cell.value).upper() if cell.value else "" for cell in ws_cfdi[5]] # Asumiendo fila 5 para CFDI
-        if not any(headers_cfdi): headers_cfdi = [str(cell.value).upper() if cell.value else "" for cell in ws_cfdi[1]]
+        if _es_tabla(fuente_cfdi):
+            headers_cfdi = [str(h).upper() for h in primeras_cfdi[0]]
+        else:
+            fila_5 = primeras_cfdi[4] if len(primeras_cfdi) > 4 else () # Asumiendo fila 5 para CFDI
+            headers_cfdi = [str(v).upper() if v else "" for v in fila_5]
+            if not any(headers_cfdi): headers_cfdi = [str(v).upper() if v else "" for v in primeras_cfdi[0]] if primeras_cfdi else []
 
         idx_uuid = next((i for i, h in enumerate(headers_cfdi) if 'UUID' in h), 0)
         idx_iva_cfdi = next((i for i, h in enumerate(headers_cfdi) if 'IVA' in h), 1)
         idx_total_cfdi = next((i for i, h in enumerate(headers_cfdi) if 'TOTAL' in h), 2)
 
         # Identificar columnas en AUX
-        headers_aux = [str(cell.value).upper() if cell.value else "" for cell in ws_aux[1]]
+        if flujo:
+            filas_aux = _recorrer_filas(fuente_aux, HOJAS_AUX)
+            encabezado_aux = next(filas_aux, ())
+        else:
+            encabezado_aux = [cell.value for cell in ws_aux[1]]
+        headers_aux = [str(v).upper() if v else "" for v in encabezado_aux]
         idx_iva_aux = next((i for i, h in enumerate(headers_aux) if 'IVA' in h), 7) # Por defecto H(7)
         idx_total_aux_target = next((i for i, h in enumerate(headers_aux) if 'TOTAL' in h or 'MONTO' in h), 8) # Donde pegaremos el total
 
-        # 1. Pre-cargar CFDI por Monto de IVA
-        dict_iva_cfdi = {}
-        for r_idx, row in enumerate(ws_cfdi.iter_rows(min_row=2, values_only=False), start=2):
-            iva_val = formatear_moneda_pdf(row[idx_iva_cfdi].value)
-            if iva_val:
-                dict_iva_cfdi[iva_val] = row
+        # 1. CFDI por Monto de IVA
+        encabezado_cfdi = next(filas_cfdi, None)
+        montos_iva_cfdi, totales_cfdi, filas_leidas = _indice_iva_cfdi(filas_cfdi, idx_iva_cfdi, idx_total_cfdi)
+
+        if flujo:
+            # Primera pasada al AUX: solo el IVA de cada renglón (8 bytes por renglón) y el ancho de la hoja
+            ivas_aux = array('d')
+            ancho_aux = max(len(encabezado_aux), idx_total_aux_target + 1)
+            for fila in filas_aux:
+                ivas_aux.append(monto_absoluto(_valor(fila, idx_iva_aux)) or 0.0)
+                ancho_aux = max(ancho_aux, len(fila))
+
+        etapas.marcar("carga", filas_cfdi=filas_leidas + (encabezado_cfdi is not None), facturas_con_iva=len(montos_iva_cfdi))
 
         # 2. Indexar PDFs
-        db_montos = indexar_pdfs_profundo(lista_pdfs)
+        db_montos = indexar_pdfs_profundo(lista_pdfs, cache=cache_pdf_global() if usar_cache else None,
+                                          estadisticas=estadisticas, progreso=progreso)
         
         acciones_por_pdf = defaultdict(list)
         faltantes_reporte = [] 
         contador_ref = 1
         
-        # 3. Recorrido AUX para Match de IVA y búsqueda de TOTAL en PDF
-        for row_idx, row in enumerate(ws_aux.iter_rows(min_row=2, values_only=False), start=2):
-            iva_aux = formatear_moneda_pdf(row[idx_iva_aux].value)
-            
-            if iva_aux and iva_aux in dict_iva_cfdi:
-                row_c = dict_iva_cfdi[iva_aux]
-                # Pegar el TOTAL del CFDI en el AUX (Paso solicitado)
-                total_fiscal = row_c[idx_total_cfdi].value
-                row[idx_total_aux_target].value = total_fiscal
+        etapas.marcar("indexado", pdfs=len(lista_pdfs), montos=sum(len(v) for v in db_montos.values()))
+        
+        if not flujo:
+            iva_calculado = None # Solo se lee si la columna IVA del AUX trae fórmulas
+            filas_aux = list(ws_aux.iter_rows(min_row=2, values_only=False))
+            ivas_aux = []
+            for row_idx, row in enumerate(filas_aux, start=2):
+                valor_iva = row[idx_iva_aux].value
+                if isinstance(valor_iva, str) and valor_iva.startswith('=') and not _es_tabla(fuente_aux):
+                    if iva_calculado is None: iva_calculado = _columna_calculada(fuente_aux, idx_iva_aux, cache_tablas, estadisticas)
+                    valor_iva = iva_calculado.get(row_idx)
+                ivas_aux.append(monto_absoluto(valor_iva))
+        num_filas_aux = len(ivas_aux)
+
+        # Búsqueda en lote de todo el AUX contra el índice de IVA (+/- TOLERANCIA_IVA), una factura por renglón
+        con_iva = [i for i, v in enumerate(ivas_aux) if v]
+        asignados = emparejar_montos([ivas_aux[i] for i in con_iva], montos_iva_cfdi, TOLERANCIA_IVA)
+        total_por_fila = {i: totales_cfdi[a] for i, a in zip(con_iva, asignados.tolist()) if a >= 0}
+        
+        # 3. Recorrido AUX: pegar el TOTAL del CFDI asignado y buscarlo en los PDFs
+        if flujo:
+            # Segunda pasada al AUX: cada renglón se completa y se escribe al libro de salida en write-only
+            wb = openpyxl.Workbook(write_only=True)
+            ws_salida = wb.create_sheet("AUX")
+            ws_salida.append(list(encabezado_aux) + [None] * (ancho_aux - len(encabezado_aux)))
+            filas_aux = islice(_recorrer_filas(fuente_aux, HOJAS_AUX), 1, None)
+            for row_idx, fila in enumerate(filas_aux, start=2):
+                if progreso and row_idx % PASO_PROGRESO == 0: progreso("auditoria.cruce", row_idx - 1, num_filas_aux)
+                fila = list(fila) + [None] * (ancho_aux - len(fila))
+                if row_idx - 2 in total_por_fila:
+                    total_fiscal = total_por_fila[row_idx - 2]
+                    fila[idx_total_aux_target] = total_fiscal
+                    if _referenciar_total(total_fiscal, db_montos, acciones_por_pdf, contador_ref):
+                        fila[ancho_aux - 1] = f"Ref:{contador_ref:03d}" # Misma columna que en el modo editable
+                        contador_ref += 1
+                ws_salida.append(fila)
+        else:
+            for row_idx, row in enumerate(filas_aux, start=2):
+                if progreso and row_idx % PASO_PROGRESO == 0: progreso("auditoria.cruce", row_idx - 1, num_filas_aux)
                 
-                # Buscar ese TOTAL en los PDFs
-                total_str = formatear_moneda_pdf(total_fiscal)
-                if total_str and total_str in db_montos:
-                    match_encontrado = next((m for m in db_montos[total_str] if not m["usado"]), None)
-                    if match_encontrado:
-                        match_encontrado["usado"] = True
-                        acciones_por_pdf[match_encontrado["ruta"]].append({
-                            "pag": match_encontrado["pag"],
-                            "rect": match_encontrado["rect"], 
-                            "ref": contador_ref
-                        })
+                if row_idx - 2 in total_por_fila:
+                    # Pegar el TOTAL del CFDI en el AUX (Paso solicitado)
+                    total_fiscal = total_por_fila[row_idx - 2]
+                    row[idx_total_aux_target].value = total_fiscal
+                    
+                    # Buscar ese TOTAL en los PDFs
+                    if _referenciar_total(total_fiscal, db_montos, acciones_por_pdf, contador_ref):
                         # Guardar referencia en el AUX
                         ref_col = len(row) - 1 # Usar ultima columna disponible para la referencia
                         row[ref_col].value = f"Ref:{contador_ref:03d}"
                         contador_ref += 1
-            
-            # Registro de faltantes si no se encontró en PDF
-            last_col_val = row[len(row)-1].value
-            if not last_col_val or "Ref:" not in str(last_col_val):
-                monto_rep = row[idx_iva_aux].value or 0
-                faltantes_reporte.append(f"Fila {row_idx} | IVA: {monto_rep}")
+                
+                # Registro de faltantes si no se encontró en PDF
+                last_col_val = row[len(row)-1].value
+                if not last_col_val or "Ref:" not in str(last_col_val):
+                    monto_rep = row[idx_iva_aux].value or 0
+                    faltantes_reporte.append(f"Fila {row_idx} | IVA: {monto_rep}")
+
+        etapas.marcar("cruce", filas_aux=num_filas_aux, coincidencias=len(total_por_fila), referencias=contador_ref - 1)
+        if progreso: progreso("auditoria.cruce", num_filas_aux, num_filas_aux)
 
         # 4. Generar PDFs marcados
         pdfs_generados = 0
-        for ruta_pdf, lista_acciones in acciones_por_pdf.items():
+        for nombre_pdf, lista_acciones in acciones_por_pdf.items():
             try:
-                doc = fitz.open(ruta_pdf)
+                doc = abrir_pdf(documentos_por_nombre[nombre_pdf])
                 for accion in lista_acciones:
                     page = doc[accion["pag"]]
                     rect = accion["rect"]
@@ -138,27 +595,45 @@ def ejecutar_auditoria(ruta_excel, dir_pdfs, dir_entregables):
                     pt = fitz.Point(rect.x1 + 2, rect.y1)
                     page.insert_text(pt, f"Ref:{accion['ref']:03d}", fontsize=6, color=(0,0.5,0))
                 
-                nombre_salida = os.path.basename(ruta_pdf).replace(".pdf", "_IVA_AUDITADO.pdf")
-                doc.save(os.path.join(dir_entregables, nombre_salida))
+                nombre_salida = os.path.basename(nombre_pdf).replace(".pdf", "_IVA_AUDITADO.pdf")
+                # El PDF ya va comprimido por dentro: se guarda sin volver a comprimir
+                _guardar_entregable(nombre_salida, doc.tobytes(), dir_entregables, archivo_resultado, comprimir=False)
                 pdfs_generados += 1
                 doc.close()
             except Exception as e:
-                print(f"Error marcando {ruta_pdf}: {e}")
+                print(f"Error marcando {nombre_pdf}: {e}")
+            if progreso: progreso("auditoria.anotacion", pdfs_generados, len(acciones_por_pdf))
+
+        etapas.marcar("anotacion", pdfs=pdfs_generados,
+                      paginas=len({(n, a["pag"]) for n, acciones in acciones_por_pdf.items() for a in acciones}))
 
         # 5. Reporte y Guardado
-        ruta_txt = os.path.join(dir_entregables, "REPORTE_CONCILIACION_IVA.txt")
-        with open(ruta_txt, "w", encoding="utf-8") as f:
-            f.write(f"REPORTE CONCILIACIÓN IVA - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write("="*50 + "\n")
-            f.write(f"TOTAL MATCHES IVA (Fiscal vs Contable): {len(acciones_por_pdf)}\n")
-            f.write(f"TOTAL TOTALES ENCONTRADOS EN PDF: {contador_ref - 1}\n")
-            f.write("="*50 + "\n")
-                
-        ruta_final = os.path.join(dir_entregables, "CONCILIACION_IVA_FINAL.xlsx")
-        wb.save(ruta_final)
+        if progreso: progreso("auditoria.escritura")
+        reporte = io.StringIO()
+        reporte.write(f"REPORTE CONCILIACIÓN IVA - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        reporte.write("="*50 + "\n")
+        reporte.write(f"TOTAL MATCHES IVA (Fiscal vs Contable): {len(acciones_por_pdf)}\n")
+        reporte.write(f"TOTAL TOTALES ENCONTRADOS EN PDF: {contador_ref - 1}\n")
+        reporte.write("="*50 + "\n")
+        _guardar_entregable("REPORTE_CONCILIACION_IVA.txt", reporte.getvalue().encode("utf-8"), dir_entregables, archivo_resultado)
+
+        if flujo:
+            # El entregable conserva también la hoja CFDI, copiada renglón por renglón
+            ws_cfdi_salida = wb.create_sheet("CFDI")
+            for fila in _recorrer_filas(fuente_cfdi, HOJAS_CFDI):
+                ws_cfdi_salida.append(fila)
+
+        # El .xlsx ya es un zip: va sin volver a comprimir
+        _guardar_entregable("CONCILIACION_IVA_FINAL.xlsx", wb.save, dir_entregables, archivo_resultado, comprimir=False)
+
+        etapas.marcar("escritura", filas=num_filas_aux + 1 if flujo else ws_aux.max_row)
+        if progreso: progreso("auditoria.terminado")
+        if estadisticas is not None:
+            estadisticas.update({"etapas": etapas.lista, "tiempos": etapas.tiempos, "modo_aux": modo_aux})
 
         return True, f"Proceso Conciliación IVA exitoso. {pdfs_generados} PDFs generados."
 
     except Exception as e:
         import traceback
+        etapas.fallar()
         return False, f"Error: {traceback.format_exc()}"
\ No newline at end of file
@@ -0,0 +1,69 @@
+# modulo_bitacora.py
+import atexit
+import queue
+import threading
+import time
+import traceback
+
+_FIN = object()
+
+
+class BitacoraEnLotes:
+    """
+    Escritor en segundo plano para registros de actividad: registrar() solo encola (no toca la DB en la
+    petición) y un hilo los guarda con guardar(lote) en una sola transacción.
+    - max_lote: registros por escritura como máximo.
+    - intervalo: segundos que se espera a juntar más registros después del primero.
+    - max_pendientes: si la DB no responde y se llena la cola, los registros nuevos se descartan
+      (con aviso) en lugar de bloquear las peticiones.
+    Al terminar el proceso (atexit) se escribe lo pendiente.
+    """
+
+    def __init__(self, guardar, max_lote=500, intervalo=1.0, max_pendientes=10000):
+        self._guardar = guardar
+        self.max_lote = max_lote
+        self.intervalo = intervalo
+        self._cola = queue.Queue(maxsize=max_pendientes)
+        self._terminar = False
+        self._hilo = threading.Thread(target=self._ciclo, name="bitacora", daemon=True)
+        self._hilo.start()
+        atexit.register(self.cerrar)
+
+    def registrar(self, registro):
+        try:
+            self._cola.put_nowait(registro)
+        except queue.Full:
+            print("Bitácora saturada: se descartó un registro de actividad.")
+
+    def _tomar_lote(self):
+        primero = self._cola.get()
+        if primero is _FIN: return None
+        lote, limite = [primero], time.monotonic() + self.intervalo
+        while len(lote) < self.max_lote:
+            restante = limite - time.monotonic()
+            try:
+                registro = self._cola.get(timeout=restante) if restante > 0 else self._cola.get_nowait()
+            except queue.Empty:
+                break
+            if registro is _FIN:
+                self._terminar = True # se sale después de guardar este lote
+                break
+            lote.append(registro)
+        return lote
+
+    def _ciclo(self):
+        while not self._terminar:
+            lote = self._tomar_lote()
+            if lote is None: break
+            try:
+                self._guardar(lote)
+            except Exception:
+                print(f"Error guardando {len(lote)} registros de actividad: {traceback.format_exc()}")
+
+    def cerrar(self, timeout=5.0):
+        if self._hilo.is_alive():
+            try:
+                self._cola.put(_FIN, timeout=timeout)
+            except queue.Full:
+                return
+            self._hilo.join(timeout)
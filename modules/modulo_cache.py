@@ -0,0 +1,338 @@
+# modulo_cache.py
+import os
+import json
+import time
+import zlib
+import pickle
+import sqlite3
+import hashlib
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather  # Formato columnar leído con memory map, opcional (pip install pyarrow)
+except ImportError:
+    pa = feather = None
+
+DIR_INSTANCE = Path(__file__).resolve().parent.parent / 'instance'
+RUTA_CACHE_PDF = os.environ.get('SUITE_CACHE_PDF', str(DIR_INSTANCE / 'cache_indices_pdf.db'))
+LIMITE_CACHE_PDF_MB = int(os.environ.get('SUITE_CACHE_PDF_MB', 512))
+RUTA_CACHE_TABLAS = os.environ.get('SUITE_CACHE_TABLAS', str(DIR_INSTANCE / 'cache_tablas'))
+LIMITE_CACHE_TABLAS_MB = int(os.environ.get('SUITE_CACHE_TABLAS_MB', 1024)) # 0 desactiva la caché
+VERSION_TABLAS = 1 # Subir al cambiar cómo se normalizan las tablas (load_cfdi, load_aux, filas de la auditoría)
+
+
+def hash_stream(f, bloque=1024 * 1024):
+    """SHA-256 de un archivo abierto en modo binario, leído por bloques."""
+    h = hashlib.sha256()
+    for parte in iter(lambda: f.read(bloque), b''):
+        h.update(parte)
+    return h.hexdigest()
+
+
+def hash_archivo(ruta):
+    with open(ruta, 'rb') as f:
+        return hash_stream(f)
+
+
+@lru_cache(maxsize=64)
+def _hash_archivo_version(ruta, mtime_ns, tamano):
+    return hash_archivo(ruta)
+
+
+def hash_fuente(fuente):
+    """
+    SHA-256 de una ruta o de un stream binario (que se rebobina); None si la fuente no son bytes
+    (p. ej. un DataFrame). Una ruta sin cambios (mismo mtime y tamaño) no se vuelve a leer.
+    """
+    if isinstance(fuente, (str, os.PathLike)):
+        try:
+            st = os.stat(fuente)
+        except OSError:
+            return None
+        return _hash_archivo_version(os.path.abspath(fuente), st.st_mtime_ns, st.st_size)
+    if hasattr(fuente, 'read') and hasattr(fuente, 'seek'):
+        fuente.seek(0)
+        sha = hash_stream(fuente)
+        fuente.seek(0)
+        return sha
+    return None
+
+
+class CacheIndicesPDF:
+    """
+    Caché en disco (SQLite) de los montos encontrados en cada PDF.
+    - Llave: SHA-256 de los bytes del PDF + versión del extractor, así un PDF re-subido con otro
+      nombre se reutiliza y un cambio de motor invalida lo anterior.
+    - Valor: lista [(monto, pag, (x0, y0, x1, y1)), ...] en JSON comprimido con zlib.
+    - Al rebasar limite_bytes se expulsan las entradas con acceso más antiguo (LRU).
+    """
+
+    def __init__(self, ruta=RUTA_CACHE_PDF, limite_bytes=LIMITE_CACHE_PDF_MB * 1024 * 1024):
+        self.ruta = str(ruta)
+        self.limite_bytes = limite_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.ruta) or '.', exist_ok=True)
+        with self._conectar() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS indices (
+                    clave TEXT PRIMARY KEY,
+                    datos BLOB NOT NULL,
+                    tamano INTEGER NOT NULL,
+                    ultimo_acceso REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_indices_acceso ON indices (ultimo_acceso)")
+
+    def _conectar(self):
+        return sqlite3.connect(self.ruta, timeout=30)
+
+    def obtener(self, sha, version):
+        """Devuelve la lista de montos guardada o None si no está en caché."""
+        clave = f"{sha}:{version}"
+        try:
+            with self._conectar() as conn:
+                fila = conn.execute("SELECT datos FROM indices WHERE clave = ?", (clave,)).fetchone()
+                if fila:
+                    conn.execute("UPDATE indices SET ultimo_acceso = ? WHERE clave = ?", (time.time(), clave))
+        except sqlite3.Error as e:
+            print(f"Error leyendo caché de PDFs: {e}")
+            fila = None
+        with self._lock:
+            if fila:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not fila:
+            return None
+        return [(monto, pag, tuple(rect)) for monto, pag, rect in json.loads(zlib.decompress(fila[0]))]
+
+    def guardar(self, sha, version, encontrados):
+        datos = zlib.compress(json.dumps(encontrados, separators=(',', ':')).encode('utf-8'))
+        try:
+            with self._conectar() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO indices (clave, datos, tamano, ultimo_acceso) VALUES (?, ?, ?, ?)",
+                    (f"{sha}:{version}", datos, len(datos), time.time()))
+                self._expulsar(conn)
+        except sqlite3.Error as e:
+            print(f"Error escribiendo caché de PDFs: {e}")
+
+    def _expulsar(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(tamano), 0) FROM indices").fetchone()[0]
+        if total <= self.limite_bytes:
+            return
+        expulsar = []
+        for clave, tamano in conn.execute("SELECT clave, tamano FROM indices ORDER BY ultimo_acceso"):
+            if total <= self.limite_bytes:
+                break
+            expulsar.append((clave,))
+            total -= tamano
+        conn.executemany("DELETE FROM indices WHERE clave = ?", expulsar)
+
+    def estadisticas(self):
+        with self._lock:
+            return {"cache_hits": self.hits, "cache_misses": self.misses}
+
+
+_cache_pdf = None
+
+
+def cache_pdf_global():
+    """Instancia compartida por el proceso (se crea al primer uso)."""
+    global _cache_pdf
+    if _cache_pdf is None:
+        _cache_pdf = CacheIndicesPDF()
+    return _cache_pdf
+
+
+class CacheTablas:
+    """
+    Caché en disco de las tablas ya normalizadas que salen de los Excel / XML subidos, compartida por
+    la conciliación y la auditoría (y por todos los workers).
+    - Llave: tipo de tabla + SHA-256 de los bytes subidos + VERSION_TABLAS, así el mismo archivo subido
+      en la otra pestaña (o de nuevo) no se vuelve a parsear.
+    - DataFrames en Feather sin compresión (Arrow), leídos con memory map, si está instalado pyarrow;
+      si no, o si la tabla tiene columnas que Arrow no representa, y para otros valores, pickle.
+    - Un archivo por entrada; su mtime marca el último acceso y al rebasar limite_bytes se borran los
+      de acceso más antiguo (LRU).
+    """
+
+    def __init__(self, directorio=RUTA_CACHE_TABLAS, limite_bytes=LIMITE_CACHE_TABLAS_MB * 1024 * 1024):
+        self.directorio = Path(directorio)
+        self.limite_bytes = limite_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _rutas(self, clave):
+        return [self.directorio / f"{clave}.feather", self.directorio / f"{clave}.pkl"]
+
+    def obtener(self, clave):
+        """Devuelve el valor guardado o None si no está en caché."""
+        valor = None
+        for ruta in self._rutas(clave):
+            try:
+                if ruta.suffix == '.feather':
+                    if feather is None: continue
+                    valor = feather.read_table(ruta, memory_map=True).to_pandas()
+                else:
+                    with open(ruta, 'rb') as f:
+                        valor = pickle.load(f)
+                os.utime(ruta) # Último acceso, para la expulsión LRU
+                break
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                # Entrada truncada o de otra versión de pyarrow / pandas: se descarta
+                print(f"Error leyendo caché de tablas ({ruta.name}): {e}")
+                ruta.unlink(missing_ok=True)
+        with self._lock:
+            if valor is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return valor
+
+    def _escribir_feather(self, valor, destino):
+        if feather is None or not hasattr(valor, 'columns'): return False
+        try:
+            feather.write_feather(valor, destino, compression='uncompressed')
+            return True
+        except (pa.ArrowException, TypeError, ValueError):
+            return False
+
+    def guardar(self, clave, valor):
+        """Escribe en un temporal y lo renombra: otro worker nunca lee una entrada a medias."""
+        try:
+            self.directorio.mkdir(parents=True, exist_ok=True)
+            feather_ruta, pickle_ruta = self._rutas(clave)
+            temporal = self.directorio / f".{clave}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                if self._escribir_feather(valor, temporal):
+                    os.replace(temporal, feather_ruta)
+                else:
+                    with open(temporal, 'wb') as f:
+                        pickle.dump(valor, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(temporal, pickle_ruta)
+            finally:
+                temporal.unlink(missing_ok=True)
+            self._expulsar()
+        except OSError as e:
+            print(f"Error escribiendo caché de tablas: {e}")
+
+    def _expulsar(self):
+        entradas = []
+        for ruta in self.directorio.iterdir():
+            if ruta.suffix not in ('.feather', '.pkl'): continue
+            try:
+                st = ruta.stat()
+            except FileNotFoundError:
+                continue
+            entradas.append((st.st_mtime, st.st_size, ruta))
+        total = sum(tamano for _, tamano, _ in entradas)
+        for _, tamano, ruta in sorted(entradas):
+            if total <= self.limite_bytes: break
+            ruta.unlink(missing_ok=True)
+            total -= tamano
+
+    def tabla(self, tipo, fuente, leer, estadisticas=None):
+        """
+        Valor de la tabla tipo para fuente (ruta o stream): de la caché o, si no está, de leer() (que
+        se guarda si no devuelve None). Con estadisticas (dict) se anota en
+        estadisticas["tablas_cache"][tipo] si vino de la caché.
+        """
+        sha = hash_fuente(fuente) if self.limite_bytes > 0 else None
+        if sha is None:
+            return leer()
+        clave = f"{tipo}-{sha}-v{VERSION_TABLAS}"
+        valor = self.obtener(clave)
+        desde_cache = valor is not None
+        if not desde_cache:
+            valor = leer()
+            if valor is not None:
+                self.guardar(clave, valor)
+        if estadisticas is not None:
+            estadisticas.setdefault("tablas_cache", {})[tipo] = desde_cache
+        return valor
+
+    def estadisticas(self):
+        with self._lock:
+            return {"tablas_hits": self.hits, "tablas_misses": self.misses}
+
+
+_cache_tablas = None
+
+
+def cache_tablas_global():
+    """Instancia compartida por el proceso (se crea al primer uso)."""
+    global _cache_tablas
+    if _cache_tablas is None:
+        _cache_tablas = CacheTablas()
+    return _cache_tablas
+
+
+class CacheTTL:
+    """
+    Caché en memoria del proceso: cada entrada caduca a los ttl segundos y se guardan a lo más
+    max_entradas (al llenarse se descarta la que vence antes).
+    Con ruta_version, invalidar() toca ese archivo y los demás procesos (workers de gunicorn) vacían su
+    copia en la siguiente consulta; comprobarlo cuesta un os.stat, no una consulta a la DB.
+    """
+
+    def __init__(self, ttl=60, max_entradas=1024, ruta_version=None):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self.ruta_version = str(ruta_version) if ruta_version else None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._datos = {}  # clave -> (vence, valor)
+        self._version = self.version()
+
+    def version(self):
+        """Marca de la última invalidación global: (mtime, tamaño) del archivo de versión."""
+        if not self.ruta_version: return None
+        try:
+            st = os.stat(self.ruta_version)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def obtener(self, clave):
+        version = self.version()
+        ahora = time.monotonic()
+        with self._lock:
+            if version != self._version:
+                self._datos.clear()
+                self._version = version
+            entrada = self._datos.get(clave)
+            if entrada is None or entrada[0] < ahora:
+                self._datos.pop(clave, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entrada[1]
+
+    def guardar(self, clave, valor):
+        with self._lock:
+            if len(self._datos) >= self.max_entradas and clave not in self._datos:
+                del self._datos[min(self._datos, key=lambda k: self._datos[k][0])]
+            self._datos[clave] = (time.monotonic() + self.ttl, valor)
+
+    def invalidar(self, clave=None):
+        """Sin clave vacía todo; con ruta_version la invalidación alcanza a todos los procesos."""
+        with self._lock:
+            if clave is None:
+                self._datos.clear()
+            else:
+                self._datos.pop(clave, None)
+        if self.ruta_version:
+            os.makedirs(os.path.dirname(self.ruta_version) or '.', exist_ok=True)
+            # Un byte por invalidación: el tamaño cambia aunque el mtime del sistema de archivos sea grueso
+            with open(self.ruta_version, 'a') as f:
+                f.write('.')
+            self._version = self.version()
@@ -0,0 +1,169 @@
+# modulo_cfdi_xml.py
+# Zip con los XML de CFDI 3.3 / 4.0 descargados del SAT como alternativa al reporte de Excel:
+# cada XML se recorre con iterparse (sin armar el árbol) y el zip se reparte entre procesos.
+import multiprocessing
+import os
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from modules.modulo_subidas import revisar_miembros_zip
+
+NS_CFDI = {'http://www.sat.gob.mx/cfd/3', 'http://www.sat.gob.mx/cfd/4'}
+NS_TFD = 'http://www.sat.gob.mx/TimbreFiscalDigital'
+IMPUESTO_IVA = '002'
+
+# Mismos nombres de columna que el reporte de Excel 'CFDI REC PROV'
+COLUMNAS = ['UUID', 'Serie', 'Folio', 'Emisión', 'RFC Emisor', 'Nombre Emisor', 'IVA Trasladado', 'Total']
+
+XML_WORKERS = int(os.environ.get('SUITE_XML_WORKERS', os.cpu_count() or 1))
+MIN_XML_PARALELO = 2000 # Por debajo de esto no vale la pena levantar procesos
+TAREAS_POR_WORKER = 4 # Cada tarea relee el directorio central del zip: pocas tareas grandes
+MAX_XML_ZIP = int(os.environ.get('SUITE_MAX_XML_ZIP', 200000)) # Tamaño y compresión: ver modulo_subidas
+
+
+def _partir(tag):
+    """'{namespace}Nombre' -> (namespace, 'Nombre')."""
+    if tag[:1] == '{':
+        ns, _, nombre = tag[1:].partition('}')
+        return ns, nombre
+    return '', tag
+
+
+def _numero(valor):
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def parsear_cfdi(f):
+    """
+    Un XML de CFDI (archivo abierto en binario) -> tupla en el orden de COLUMNAS.
+    El IVA es la suma de los traslados 002 a nivel comprobante (no los de cada concepto).
+    Lanza ValueError si no es un Comprobante de CFDI.
+    """
+    pila = []
+    comprobante = emisor = {}
+    uuid, iva = None, None
+    for evento, elem in ET.iterparse(f, events=('start', 'end')):
+        if evento == 'end':
+            pila.pop()
+            elem.clear() # Los atributos ya se leyeron en 'start'; así la memoria no crece con los conceptos
+            continue
+        ns, nombre = _partir(elem.tag)
+        pila.append(nombre)
+        nivel = len(pila)
+        if nivel == 1:
+            if nombre != 'Comprobante' or ns not in NS_CFDI:
+                raise ValueError("No es un CFDI 3.3 / 4.0.")
+            comprobante = dict(elem.attrib)
+        elif nivel == 2 and nombre == 'Emisor':
+            emisor = dict(elem.attrib)
+        elif nivel == 4 and nombre == 'Traslado' and pila[1:3] == ['Impuestos', 'Traslados'] \
+                and elem.get('Impuesto') == IMPUESTO_IVA:
+            iva = (iva or 0.0) + _numero(elem.get('Importe'))
+        elif nombre == 'TimbreFiscalDigital' and ns == NS_TFD:
+            uuid = elem.get('UUID')
+    if not comprobante:
+        raise ValueError("XML vacío.")
+    return (uuid.upper().strip() if uuid else None, comprobante.get('Serie'), comprobante.get('Folio'),
+            comprobante.get('Fecha'), emisor.get('Rfc'), emisor.get('Nombre'),
+            round(iva, 2) if iva is not None else np.nan, _numero(comprobante.get('Total')))
+
+
+def _miembros_xml(z):
+    return [i for i in z.infolist()
+            if not i.is_dir() and i.filename.lower().endswith('.xml') and not i.filename.startswith('__MACOSX/')]
+
+
+def es_zip_cfdi_xml(fuente):
+    """True si fuente (ruta o stream) es un zip de XML y no un libro .xlsx (que también es un zip)."""
+    if isinstance(fuente, (str, os.PathLike)) and not os.path.isfile(fuente):
+        return False
+    try:
+        if hasattr(fuente, 'seek'): fuente.seek(0)
+        with zipfile.ZipFile(fuente) as z:
+            nombres = z.namelist()
+            return 'xl/workbook.xml' not in nombres and bool(_miembros_xml(z))
+    except (zipfile.BadZipFile, OSError):
+        return False
+    finally:
+        if hasattr(fuente, 'seek'): fuente.seek(0)
+
+
+def revisar_zip_cfdi_xml(fuente):
+    """
+    Si fuente es un zip de XML, lanza ValueError cuando rebasa los límites de miembros, tamaño o tasa de
+    compresión (solo lee el directorio central). Un Excel pasa sin revisar.
+    """
+    if not es_zip_cfdi_xml(fuente):
+        return
+    with zipfile.ZipFile(fuente) as z:
+        revisar_miembros_zip(_miembros_xml(z), MAX_XML_ZIP, "XML")
+    if hasattr(fuente, 'seek'): fuente.seek(0)
+
+
+def _parsear_miembros(z, nombres):
+    filas, errores = [], []
+    for nombre in nombres:
+        try:
+            with z.open(nombre) as f:
+                filas.append(parsear_cfdi(f))
+        except (ET.ParseError, ValueError) as e:
+            errores.append(f"{nombre}: {e}")
+    return filas, errores
+
+
+def _parsear_tarea(ruta_zip, nombres):
+    """Corre en el proceso hijo: abre el zip por su cuenta y devuelve (filas, errores)."""
+    with zipfile.ZipFile(ruta_zip) as z:
+        return _parsear_miembros(z, nombres)
+
+
+def leer_cfdi_xml(fuente, workers=None, estadisticas=None):
+    """
+    Zip de XML de CFDI -> DataFrame con COLUMNAS (UUID en mayúsculas, Emisión datetime, montos float),
+    en el orden de los archivos del zip. Lanza ValueError si el zip rebasa los límites de
+    revisar_zip_cfdi_xml. Con estadisticas (dict) se reportan xml_total, xml_errores y
+    xml_por_segundo.
+    """
+    inicio = time.perf_counter()
+    workers = XML_WORKERS if workers is None else workers
+    if hasattr(fuente, 'seek'): fuente.seek(0)
+    with zipfile.ZipFile(fuente) as z:
+        miembros = _miembros_xml(z)
+        revisar_miembros_zip(miembros, MAX_XML_ZIP, "XML") # Zips bomba: antes de parsear un solo XML
+        nombres = [i.filename for i in miembros]
+        # Los procesos abren el zip por su cuenta: solo se puede con una ruta, no con un stream
+        if workers > 1 and len(nombres) >= MIN_XML_PARALELO and isinstance(fuente, (str, os.PathLike)):
+            por_tarea = -(-len(nombres) // (workers * TAREAS_POR_WORKER))
+            tareas = [nombres[i:i + por_tarea] for i in range(0, len(nombres), por_tarea)]
+            # 'spawn' evita heredar hilos (pool de trabajos, SQLAlchemy) de un proceso de gunicorn
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+                parciales = list(pool.map(_parsear_tarea, [fuente] * len(tareas), tareas))
+        else:
+            parciales = [_parsear_miembros(z, nombres)]
+
+    filas = [fila for parcial, _ in parciales for fila in parcial]
+    errores = [error for _, parcial in parciales for error in parcial]
+    for error in errores[:10]:
+        print(f"CFDI XML omitido: {error}")
+
+    df = pd.DataFrame(filas, columns=COLUMNAS)
+    df['Emisión'] = pd.to_datetime(df['Emisión'], errors='coerce')
+    for c in ('IVA Trasladado', 'Total'):
+        df[c] = df[c].astype(float)
+
+    if estadisticas is not None:
+        segundos = time.perf_counter() - inicio
+        estadisticas.update({
+            "xml_total": len(nombres), "xml_errores": len(errores),
+            "xml_por_segundo": round(len(nombres) / segundos, 1) if segundos else 0,
+        })
+    return df
@@ -0,0 +1,72 @@
+# modulo_completo.py
+# Conciliación IA + Conciliación IVA con una sola subida: los archivos se leen una vez y las dos
+# herramientas corren al mismo tiempo sobre lo ya leído.
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.modulo_auditoria import ejecutar_auditoria, leer_filas_cfdi
+from modules.modulo_cache import cache_tablas_global
+from modules.modulo_cfdi_xml import es_zip_cfdi_xml, leer_cfdi_xml
+from modules.modulo_conciliacion import cfdi_desde_filas, ejecutar_conciliacion, load_aux, normalizar_cfdi
+from modules.modulo_metricas import span
+
+
+def leer_cfdi_compartido(ruta_cfdi, estadisticas=None, usar_cache=True):
+    """
+    Lee el CFDI una sola vez para las dos herramientas. Devuelve (fuente_auditoria, df_conciliacion):
+    - zip de XML: la tabla de leer_cfdi_xml para la auditoría y, normalizada, para la conciliación.
+    - Excel: las filas de la hoja (como las lee la auditoría) y la tabla de load_cfdi armada con esas
+      mismas filas, sin volver a abrir el libro.
+    Ambas pasan por la caché de tablas con las mismas llaves que en cada herramienta por separado.
+    """
+    cache = cache_tablas_global() if usar_cache else None
+    if es_zip_cfdi_xml(ruta_cfdi):
+        leer = lambda: leer_cfdi_xml(ruta_cfdi, estadisticas=estadisticas)
+        fuente = cache.tabla("cfdi_xml", ruta_cfdi, leer, estadisticas) if cache else leer()
+        derivar = lambda: normalizar_cfdi(fuente)
+    else:
+        fuente = leer_filas_cfdi(ruta_cfdi, cache, estadisticas)
+        derivar = lambda: cfdi_desde_filas(fuente)
+    df_cfdi = cache.tabla("cfdi", ruta_cfdi, derivar, estadisticas) if cache else derivar()
+    return fuente, df_cfdi
+
+
+def ejecutar_completo(ruta_cfdi, ruta_aux, fuente_pdfs, salida_conciliacion, dir_entregables=None, estadisticas=None,
+                      usar_cache=True, archivo_resultado=None, progreso=None):
+    """
+    Programa: Conciliación IA + Conciliación IVA (una sola subida)
+    1. Lee CFDI y AUX una vez (leer_cfdi_compartido / load_aux).
+    2. La conciliación corre en un hilo sobre esas tablas mientras la auditoría indexa los PDFs (en sus
+       procesos), cruza y anota; el AUX editable de la auditoría se abre aparte porque conserva estilos.
+    El Excel de la conciliación queda en salida_conciliacion; los entregables de la auditoría van a
+    archivo_resultado (o dir_entregables), como en ejecutar_auditoria.
+    estadisticas: las de la auditoría en el primer nivel, las de la conciliación en
+    estadisticas["conciliacion"] y la lectura compartida como primera etapa. progreso se pasa a las dos.
+    Devuelve (exito, dashboard, consejo, mensaje).
+    """
+    estadisticas = {} if estadisticas is None else estadisticas
+    estadisticas_conciliacion = {}
+    if progreso:
+        progreso("conciliacion.carga")
+        progreso("auditoria.carga")
+    try:
+        with span("completo.lectura") as lectura:
+            fuente_cfdi, df_cfdi = leer_cfdi_compartido(ruta_cfdi, estadisticas, usar_cache)
+            df_aux = load_aux(ruta_aux, estadisticas, usar_cache)
+            if df_cfdi is not None and df_aux is not None:
+                lectura.contar(filas_cfdi=len(df_cfdi), filas_aux=len(df_aux))
+    except Exception as e:
+        return False, [], "", f"Error en carga de archivos: {e}"
+    if df_cfdi is None or df_aux is None: return False, [], "", "Error en carga de archivos."
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="conciliacion") as pool:
+        futuro = pool.submit(ejecutar_conciliacion, df_cfdi, df_aux, salida_conciliacion,
+                             estadisticas=estadisticas_conciliacion, usar_cache=usar_cache, progreso=progreso)
+        exito, mensaje = ejecutar_auditoria(fuente_cfdi, ruta_aux, fuente_pdfs, dir_entregables, estadisticas,
+                                            usar_cache, archivo_resultado, progreso)
+        exito_conciliacion, dashboard, consejo = futuro.result()
+
+    estadisticas["conciliacion"] = estadisticas_conciliacion
+    estadisticas.setdefault("etapas", []).insert(0, dict(lectura.datos, nombre="lectura compartida"))
+    if not exito_conciliacion:
+        return False, dashboard, consejo, f"Conciliación IA: {consejo}"
+    return exito, dashboard, consejo, mensaje
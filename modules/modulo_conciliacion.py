@@ -3,57 +3,109 @@ import pandas as pd
 import numpy as np
 import re
 import os
+import time
+import threading
 import warnings
 from datetime import datetime
+from pathlib import Path
+import joblib
+from modules.modulo_cache import cache_tablas_global
+from modules.modulo_cfdi_xml import es_zip_cfdi_xml, leer_cfdi_xml
+from modules.modulo_excel import escribir_libro, leer_hoja, tabla_desde_filas
+from modules.modulo_metricas import Etapas
 
 # Silenciamos advertencias de formato de Excel
 warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
 
-TOLERANCIA_MONTO = 1.00 # +/- 1 peso
+TOLERANCIA_MONTO = 1.00 # +/- 1 peso (valor sugerido para match_by_monto_proximo; el pipeline no lo usa)
 PALABRAS_EXCLUSION = ['NOMINA', 'IMSS', 'SAT', 'INFONAVIT', 'COMISION', 'TRASPASO', 'IMPUESTO']
+MAX_CANDIDATOS = int(os.environ.get('SUITE_MAX_CANDIDATOS', 5)) # CFDI con el mismo monto que se evalúan por renglón del AUX
+DIAS_SIN_FECHA = 99999 # Distancia asignada cuando falta alguna de las dos fechas (última prioridad)
+MAX_RONDAS = 4 # Rondas de búsqueda por cercanía antes de emparejar el resto por orden de fecha
 
-def load_cfdi(filename):
+# Modelo entrenado con training/train_model.py
+RUTA_MODELO = os.environ.get('SUITE_MODELO', str(Path(__file__).resolve().parent.parent / 'models' / 'modelo_conciliacion.pkl'))
+FEATURES_MODELO = ['diferencia_monto', 'diferencia_dias', 'similitud_folio', 'similitud_razon_social', 'es_mismo_monto']
+LOTE_MODELO = int(os.environ.get('SUITE_LOTE_MODELO', 50000)) # Pares por llamada a predict_proba
+PARES_POR_LOTE = 1_000_000 # Pares candidatos por lote en emparejar_montos (niveles con diferencia > 0)
+UMBRAL_ALTA, UMBRAL_MEDIA = 0.80, 0.50
+
+def _columna_razon_social(encabezados):
+    return next((c for c in encabezados if 'RAZ' in c.upper() or 'NOMBRE' in c.upper()), None)
+
+def _columnas_cfdi(encabezados):
+    """Solo las columnas que usa la conciliación: UUID, Folio, Total, Emisión, la primera con 'IVA' y la razón social."""
+    iva_col = next((c for c in encabezados if 'IVA' in c.upper()), None)
+    razon_col = _columna_razon_social(encabezados)
+    return ['UUID', 'Folio', 'Total', 'Emisión'] + [c for c in (iva_col, razon_col) if c]
+
+def load_cfdi(filename, estadisticas=None, usar_cache=True):
+    """
+    Reporte de Excel 'CFDI REC PROV' (encabezado en la fila 5) o zip con los XML de los CFDI.
+    Con usar_cache, un archivo con el mismo contenido que uno ya leído sale de la caché de tablas.
+    """
+    if not usar_cache: return _leer_cfdi(filename, estadisticas)
+    return cache_tablas_global().tabla("cfdi", filename, lambda: _leer_cfdi(filename, estadisticas), estadisticas)
+
+def _leer_cfdi(filename, estadisticas=None):
     try:
-        try:
-            df = pd.read_excel(filename, sheet_name='CFDI REC PROV', header=4, engine='openpyxl')
-        except:
-            df = pd.read_excel(filename, header=4, engine='openpyxl')
-            
-        df.columns = [str(c).strip() for c in df.columns]
-        iva_col = next((c for c in df.columns if 'IVA' in c.upper()), None)
-        
-        cols_to_keep = ['UUID', 'Folio', 'Total', 'Emisión']
-        if iva_col: cols_to_keep.append(iva_col)
-            
-        if 'UUID' not in df.columns or 'Total' not in df.columns: return None
-            
-        df_clean = df[[c for c in cols_to_keep if c in df.columns]].copy()
-        
-        if 'Total' in df_clean.columns:
-            df_clean['Total'] = pd.to_numeric(df_clean['Total'], errors='coerce')
-        if 'Emisión' in df_clean.columns:
-            df_clean['Emisión'] = pd.to_datetime(df_clean['Emisión'], errors='coerce')
-        if 'UUID' in df_clean.columns:
-            df_clean['UUID'] = df_clean['UUID'].astype(str).str.upper().str.strip()
-        
-        if iva_col:
-            df_clean['Monto_Target'] = pd.to_numeric(df_clean[iva_col], errors='coerce').fillna(0).round(2)
+        if es_zip_cfdi_xml(filename):
+            df = leer_cfdi_xml(filename, estadisticas=estadisticas)
         else:
-            df_clean['Monto_Target'] = df_clean['Total'].round(2)
-            
-        df_clean.dropna(subset=['UUID'], inplace=True)
-        return df_clean
+            df = leer_hoja(filename, hojas=['CFDI REC PROV'], fila_encabezado=5, columnas=_columnas_cfdi)
+        return normalizar_cfdi(df)
     except Exception as e:
         print(f"Error cargando CFDI: {e}")
         return None
 
-def load_aux(filename):
+def cfdi_desde_filas(filas):
+    """Mismo resultado que load_cfdi a partir de las filas de la hoja ya leídas (encabezado en la fila 5)."""
     try:
-        try:
-            df = pd.read_excel(filename, sheet_name='AUX', header=0, engine='openpyxl')
-        except:
-            df = pd.read_excel(filename, header=0, engine='openpyxl')
-        df.columns = [str(c).strip() for c in df.columns]
+        return normalizar_cfdi(tabla_desde_filas(filas, fila_encabezado=5, columnas=_columnas_cfdi))
+    except Exception as e:
+        print(f"Error cargando CFDI: {e}")
+        return None
+
+def normalizar_cfdi(df):
+    """Tabla del CFDI como se leyó (Excel o XML) -> columnas tipadas de la conciliación; None si faltan UUID / Total."""
+    iva_col = next((c for c in df.columns if 'IVA' in c.upper()), None)
+    
+    razon_col = _columna_razon_social(df.columns)
+    
+    cols_to_keep = ['UUID', 'Folio', 'Total', 'Emisión']
+    if iva_col: cols_to_keep.append(iva_col)
+    if razon_col: cols_to_keep.append(razon_col)
+        
+    if 'UUID' not in df.columns or 'Total' not in df.columns: return None
+        
+    df_clean = df[[c for c in cols_to_keep if c in df.columns]].copy()
+    
+    if 'Total' in df_clean.columns:
+        df_clean['Total'] = pd.to_numeric(df_clean['Total'], errors='coerce')
+    if 'Emisión' in df_clean.columns:
+        df_clean['Emisión'] = pd.to_datetime(df_clean['Emisión'], errors='coerce')
+    if 'UUID' in df_clean.columns:
+        df_clean['UUID'] = df_clean['UUID'].astype(str).str.upper().str.strip()
+    
+    if razon_col:
+        df_clean = df_clean.rename(columns={razon_col: 'Razon_Social'})
+    
+    if iva_col:
+        df_clean['Monto_Target'] = pd.to_numeric(df_clean[iva_col], errors='coerce').fillna(0).round(2)
+    else:
+        df_clean['Monto_Target'] = df_clean['Total'].round(2)
+        
+    df_clean.dropna(subset=['UUID'], inplace=True)
+    return df_clean
+
+def load_aux(filename, estadisticas=None, usar_cache=True):
+    """Hoja 'AUX' (encabezado en la fila 1); con usar_cache sale de la caché de tablas si ya se leyó."""
+    if not usar_cache: return _leer_aux(filename)
+    return cache_tablas_global().tabla("aux", filename, lambda: _leer_aux(filename), estadisticas)
+
+def _leer_aux(filename):
+    try:
+        df = leer_hoja(filename, hojas=['AUX'], fila_encabezado=1)
         df_clean = df.copy()
             
         if 'Fecha' in df_clean.columns:
@@ -71,28 +123,481 @@ def load_aux(filename):
         print(f"Error cargando AUX: {e}")
         return None
 
-def ejecutar_conciliacion(cfdi_path, aux_path, output_path, *args, **kwargs):
+# --- MOTOR DE CRUCE POR MONTO (arreglos ordenados, sin iterrows) ---
+
+def a_centavos(valores):
+    """Montos a enteros en centavos, para comparar sin errores de punto flotante."""
+    return np.rint(np.asarray(valores, dtype=float) * 100).astype(np.int64)
+
+def candidatos_por_rango(claves_busqueda, claves_indice_ordenadas, radio):
+    """
+    Para cada clave buscada, todas las posiciones de claves_indice_ordenadas dentro de [clave - radio, clave + radio],
+    resueltas con searchsorted (O(log n) por búsqueda). Devuelve (pos_busqueda, pos_indice) en orden de búsqueda.
+    """
+    claves_busqueda = np.asarray(claves_busqueda)
+    lo = np.searchsorted(claves_indice_ordenadas, claves_busqueda - radio, side='left')
+    hi = np.searchsorted(claves_indice_ordenadas, claves_busqueda + radio, side='right')
+    cuenta = hi - lo
+    pos_busqueda = np.repeat(np.arange(len(claves_busqueda)), cuenta)
+    inicio_grupo = np.repeat(np.cumsum(cuenta) - cuenta, cuenta)
+    pos_indice = np.repeat(lo, cuenta) + (np.arange(cuenta.sum()) - inicio_grupo)
+    return pos_busqueda, pos_indice
+
+def asignar_uno_a_uno(izq, der, usado_izq, usado_der):
+    """
+    Asignación greedy uno a uno sobre pares (izq[k], der[k]) ya ordenados por prioridad: cada par se
+    acepta si ninguno de sus dos lados está usado. Ordenar por (fila izquierda, distancia) reproduce
+    "cada fila toma su mejor candidato libre"; ordenar solo por distancia da "menor distancia primero".
+    usado_izq / usado_der son bytearray que se actualizan, para poder procesar por bloques.
+    Devuelve las posiciones k aceptadas.
+    """
+    aceptados = []
+    for k, (i, d) in enumerate(zip(izq.tolist(), der.tolist())):
+        if usado_izq[i] or usado_der[d]:
+            continue
+        usado_izq[i] = usado_der[d] = 1
+        aceptados.append(k)
+    return np.array(aceptados, dtype=np.int64)
+
+def emparejar_montos(montos_busqueda, montos_indice, tolerancia=0.0):
+    """
+    Empareja uno a uno cada monto buscado con un monto del índice dentro de +/- tolerancia, sin repetir
+    ninguno de los dos lados. Prioridad: menor diferencia, luego orden de búsqueda, luego orden del índice.
+    Se resuelve por niveles de diferencia en centavos. Nivel 0: el k-ésimo monto buscado de cada importe
+    toma el k-ésimo del índice con ese importe (rango dentro de la clave, sin generar pares, así un IVA
+    repetido miles de veces en ambos lados no multiplica la memoria). Niveles 1..tolerancia: pares contra
+    los montos aún libres a esa distancia exacta, por lotes de PARES_POR_LOTE en orden de búsqueda.
+    Devuelve, por cada monto buscado, la posición asignada en montos_indice o -1.
+    """
+    busqueda = a_centavos(montos_busqueda)
+    indice = a_centavos(montos_indice)
+    asignado = np.full(len(busqueda), -1, dtype=np.int64)
+    if not len(busqueda) or not len(indice): return asignado
+
+    orden_i = np.argsort(indice, kind='stable')
+    claves_i = indice[orden_i]
+    orden_b = np.argsort(busqueda, kind='stable')
+    claves_b = busqueda[orden_b]
+    rango = np.arange(len(claves_b)) - np.searchsorted(claves_b, claves_b, side='left')
+    lo = np.searchsorted(claves_i, claves_b, side='left')
+    ok = rango < np.searchsorted(claves_i, claves_b, side='right') - lo
+    asignado[orden_b[ok]] = orden_i[lo[ok] + rango[ok]]
+
+    libre_i = np.ones(len(indice), dtype=bool)
+    libre_i[asignado[asignado >= 0]] = False
+    usado_b, usado_i = bytearray(len(busqueda)), bytearray((~libre_i).tobytes())
+    for diferencia in range(1, int(round(tolerancia * 100)) + 1):
+        pendientes = np.flatnonzero(asignado < 0)
+        while len(pendientes) and libre_i.any():
+            libres = orden_i[libre_i[orden_i]]
+            claves_libres = indice[libres]
+            claves = busqueda[pendientes]
+            cuenta = sum(np.searchsorted(claves_libres, c, side='right') - np.searchsorted(claves_libres, c, side='left')
+                         for c in (claves - diferencia, claves + diferencia))
+            pendientes, cuenta = pendientes[cuenta > 0], cuenta[cuenta > 0] # Sin libres a esta distancia: pasan al siguiente nivel
+            if not len(pendientes): break
+            corte = max(1, int(np.searchsorted(np.cumsum(cuenta), PARES_POR_LOTE, side='right')))
+            lote, pendientes = pendientes[:corte], pendientes[corte:]
+            pares = [candidatos_por_rango(busqueda[lote] + signo * diferencia, claves_libres, 0) for signo in (-1, 1)]
+            pos_b = lote[np.concatenate([p[0] for p in pares])]
+            pos_i = libres[np.concatenate([p[1] for p in pares])]
+            prioridad = np.lexsort((pos_i, pos_b))
+            pos_b, pos_i = pos_b[prioridad], pos_i[prioridad]
+            k = asignar_uno_a_uno(pos_b, pos_i, usado_b, usado_i)
+            if len(k):
+                asignado[pos_b[k]] = pos_i[k]
+                libre_i[pos_i[k]] = False
+    return asignado
+
+def _aux_por_monto(aux_df, columnas):
+    """AUX 'derretido': una fila por cada Debe > 0 y cada Haber > 0, con su monto en Monto_Match."""
+    return pd.concat([
+        aux_df[aux_df['Monto_Debe'] > 0][columnas + ['Monto_Debe']].rename(columns={'Monto_Debe': 'Monto_Match'}),
+        aux_df[aux_df['Monto_Haber'] > 0][columnas + ['Monto_Haber']].rename(columns={'Monto_Haber': 'Monto_Match'})
+    ])
+
+def match_by_monto_proximo(cfdi_df, aux_df, tolerance, date_window_days, match_type_label, bloque=20000):
+    """
+    Pase de monto con tolerancia + ventana de fechas (mismo resultado que la versión con iterrows de
+    deprecated/CODIGO_CONCIDENCIAS_CFDI.py). Cada CFDI, en orden, toma el movimiento de AUX libre con
+    menor diferencia de monto dentro de +/- tolerance y +/- date_window_days, excluyendo el monto exacto.
+    Los candidatos salen de rangos sobre el AUX ordenado por centavos y se procesan por bloques de CFDI.
+
+    Se conserva solo para llamadas externas (scripts que venían del archivo anterior): trabaja con las columnas
+    de ese script (CFDI: UUID, Monto_Total, Emisión; AUX: ID_AUX, Fecha, Monto_Debe, Monto_Haber), que los
+    cargadores de este módulo no generan, y ejecutar_conciliacion no lo llama; el pipeline cruza con
+    match_monto_fecha sobre Monto_Search/Monto_Target.
+    """
+    if aux_df.empty or cfdi_df.empty: return pd.DataFrame(), aux_df, cfdi_df
+
+    aux_melted = _aux_por_monto(aux_df, ['ID_AUX', 'Fecha']).dropna(subset=['Fecha'])
+    cfdi_df_clean = cfdi_df.dropna(subset=['Emisión'])
+
+    orden = np.argsort(a_centavos(aux_melted['Monto_Match']), kind='stable')
+    aux_cent = a_centavos(aux_melted['Monto_Match'])[orden]
+    aux_monto = aux_melted['Monto_Match'].to_numpy(dtype=float)[orden]
+    aux_fecha = aux_melted['Fecha'].to_numpy(dtype='datetime64[ns]').astype(np.int64)[orden]
+    aux_ids, aux_codigo = np.unique(aux_melted['ID_AUX'].to_numpy()[orden], return_inverse=True)
+
+    cfdi_monto = cfdi_df_clean['Monto_Total'].to_numpy(dtype=float)
+    cfdi_cent = a_centavos(cfdi_monto)
+    cfdi_fecha = cfdi_df_clean['Emisión'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    cfdi_uuid = cfdi_df_clean['UUID'].to_numpy()
+    ventana = np.int64(pd.Timedelta(days=date_window_days).value)
+    radio = int(round(tolerance * 100))
+
+    usado_cfdi, usado_aux = bytearray(len(cfdi_df_clean)), bytearray(len(aux_ids))
+    all_matches = []
+    for ini in range(0, len(cfdi_df_clean), bloque):
+        fin = min(ini + bloque, len(cfdi_df_clean))
+        pos_c, pos_a = candidatos_por_rango(cfdi_cent[ini:fin], aux_cent, radio)
+        pos_c += ini
+        validos = (np.abs(aux_fecha[pos_a] - cfdi_fecha[pos_c]) <= ventana) & (aux_cent[pos_a] != cfdi_cent[pos_c])
+        pos_c, pos_a = pos_c[validos], pos_a[validos]
+        diff = np.abs(aux_monto[pos_a] - cfdi_monto[pos_c])
+        prioridad = np.lexsort((orden[pos_a], diff, pos_c)) # CFDI en orden, luego menor diferencia, luego orden original del AUX
+        pos_c, pos_a, diff = pos_c[prioridad], pos_a[prioridad], diff[prioridad]
+        k = asignar_uno_a_uno(pos_c, aux_codigo[pos_a], usado_cfdi, usado_aux)
+        all_matches.append(pd.DataFrame({'UUID': cfdi_uuid[pos_c[k]], 'ID_AUX': aux_ids[aux_codigo[pos_a[k]]], 'Monto_Diff': diff[k]}))
+
+    # Sin CFDI con fecha no hay bloques: mismo resultado vacío que la versión anterior
+    if not all_matches: return pd.DataFrame(), aux_df, cfdi_df
+    matches = pd.concat(all_matches, ignore_index=True)
+    if matches.empty: return pd.DataFrame(), aux_df, cfdi_df
+
+    df_encontrados = pd.merge(matches, aux_df, on='ID_AUX', suffixes=('_MATCH', '_AUX_ORIG')).merge(cfdi_df, on='UUID', suffixes=('', '_CFDI_ORIG'))
+    df_encontrados['Match_Type'] = match_type_label
+    
+    sobrantes_aux = aux_df[~aux_df['ID_AUX'].isin(df_encontrados['ID_AUX'])].copy()
+    sobrantes_cfdi = cfdi_df[~cfdi_df['UUID'].isin(df_encontrados['UUID'])].copy()
+    return df_encontrados, sobrantes_aux, sobrantes_cfdi
+
+# --- ÍNDICE DE FOLIOS (similitud_folio; mismas regex que los pases Folio+Monto del script anterior) ---
+
+REGEX_FOLIO_EXACTO = r'\b{folio}\b'
+REGEX_FOLIO_PARCIAL = r'{folio}(?:\b|$)'
+PATRON_TOKEN = re.compile(r'\w+')
+
+class IndiceFolios:
+    r"""
+    Índice invertido de los conceptos del AUX contra un conjunto de folios, armado en UNA pasada por los tokens
+    (\w+) de cada concepto. De cada folio se toma su primer tramo de letras/dígitos T:
+    - Si T abre el folio, \b{folio}\b solo ocurre en conceptos con un token igual a T y {folio}(?:\b|$) en
+      conceptos con un token que termina en T.
+    - Si T va precedido de un símbolo (ej. '-15'), en ambos casos hace falta un token igual a T.
+    Si el folio es puro token el índice ya es la respuesta; si no (ej. '123.0', 'A-15') se confirma con la
+    regex original, pero solo sobre los conceptos candidatos.
+    """
+
+    def __init__(self, conceptos, folios):
+        """conceptos: Serie de Concepto_Upper indexada por ID_AUX. folios: iterable de Folio_str."""
+        self.conceptos = {i: c for i, c in conceptos.items() if isinstance(c, str)}
+        self.tramos = {}
+        for folio in {str(f) for f in folios}:
+            m = PATRON_TOKEN.search(folio)
+            if m: self.tramos[folio] = (m.group(), m.start() == 0)
+        claves = {t for t, _ in self.tramos.values()}
+        largos = sorted({len(t) for t in claves})
+        self.exacto, self.parcial = {}, {}
+        for id_aux, concepto in self.conceptos.items():
+            for token in PATRON_TOKEN.findall(concepto):
+                if token in claves:
+                    self.exacto.setdefault(token, set()).add(id_aux)
+                for n in largos:
+                    if n > len(token): break
+                    sufijo = token[-n:]
+                    if sufijo in claves:
+                        self.parcial.setdefault(sufijo, set()).add(id_aux)
+
+    def buscar(self, folio, regex_template=REGEX_FOLIO_EXACTO):
+        """ID_AUX cuyo concepto cumple regex_template para el folio."""
+        folio = str(folio)
+        tramo = self.tramos.get(folio)
+        if tramo is None:
+            candidatos = self.conceptos.keys()
+        else:
+            token, al_inicio = tramo
+            usar_sufijo = al_inicio and regex_template == REGEX_FOLIO_PARCIAL
+            candidatos = (self.parcial if usar_sufijo else self.exacto).get(token, set())
+            if token == folio:
+                return candidatos
+        patron = re.compile(regex_template.format(folio=re.escape(folio)))
+        return {i for i in candidatos if patron.search(self.conceptos[i])}
+
+# --- CRUCE MONTO + FECHA (bloques por monto, sin producto cartesiano) ---
+
+ESCALA_DIAS = np.int64(1 << 22) # Llave compuesta centavos * ESCALA_DIAS + día; cabe en int64 hasta ~2e10 pesos
+
+def _dias(fechas):
+    """Fechas a número de día desde 1970 (int64); NaT o fechas anteriores -> -1."""
+    dias = pd.to_datetime(pd.Series(fechas), errors='coerce').to_numpy(dtype='datetime64[D]')
+    return np.where(np.isnat(dias), -1, np.clip(dias.astype(np.int64), -1, ESCALA_DIAS - 2))
+
+def candidatos_por_bloque(cent_busq, dias_busq, cent_idx, dias_idx, max_candidatos):
+    """
+    Llave compuesta (centavos, día): el índice se ordena por ambas y cada búsqueda se ubica con searchsorted
+    dentro de su bloque de monto. Solo se miran las max_candidatos posiciones a cada lado y se conservan las
+    max_candidatos de menor distancia en días, así la memoria crece con las búsquedas y no con el producto
+    de los montos repetidos. Devuelve (pos_busqueda, pos_indice, dias_diferencia).
+    """
+    orden = np.lexsort((dias_idx, cent_idx))
+    cent_ord, dias_ord = cent_idx[orden], dias_idx[orden]
+    lo = np.searchsorted(cent_ord, cent_busq, side='left')
+    hi = np.searchsorted(cent_ord, cent_busq, side='right')
+    # Ubicación de la fecha buscada dentro de su bloque de monto; sin fecha (-1) queda al inicio del bloque
+    centro = np.searchsorted(cent_ord * ESCALA_DIAS + (dias_ord + 1), cent_busq * ESCALA_DIAS + (dias_busq + 1))
+    desplazamientos = np.arange(-max_candidatos, max_candidatos)
+    pos = centro[:, None] + desplazamientos[None, :]
+    validos = (pos >= lo[:, None]) & (pos < hi[:, None])
+    pos_b = np.broadcast_to(np.arange(len(cent_busq))[:, None], pos.shape)[validos]
+    pos_o = pos[validos]
+
+    d_b, d_i = dias_busq[pos_b], dias_ord[pos_o]
+    dist = np.where((d_b < 0) | (d_i < 0), DIAS_SIN_FECHA, np.abs(d_b - d_i))
+    # Los max_candidatos más cercanos de cada búsqueda
+    prioridad = np.lexsort((pos_o, dist, pos_b))
+    pos_b, pos_o, dist = pos_b[prioridad], pos_o[prioridad], dist[prioridad]
+    inicio = np.searchsorted(pos_b, pos_b, side='left')
+    conservar = (np.arange(len(pos_b)) - inicio) < max_candidatos
+    return pos_b[conservar], orden[pos_o[conservar]], dist[conservar]
+
+def _emparejar_por_orden(cent_a, dias_a, cent_c, dias_c):
+    """Dentro de cada monto, el i-ésimo de un lado (por fecha) con el i-ésimo del otro. Devuelve (pos_a, pos_c)."""
+    def rango(cent, dias):
+        orden = np.lexsort((dias, cent))
+        rango_en_monto = np.arange(len(orden)) - np.searchsorted(cent[orden], cent[orden], side='left')
+        return pd.DataFrame({'cent': cent[orden], 'rango': rango_en_monto, 'pos': orden})
+    pares = rango(cent_a, dias_a).merge(rango(cent_c, dias_c), on=['cent', 'rango'], suffixes=('_a', '_c'))
+    return pares['pos_a'].to_numpy(dtype=np.int64), pares['pos_c'].to_numpy(dtype=np.int64)
+
+def match_monto_fecha(df_aux, df_cfdi, max_candidatos=MAX_CANDIDATOS):
+    """
+    Cruce uno a uno Monto_Search (AUX) vs Monto_Target (CFDI): mismo monto en centavos, hasta max_candidatos
+    CFDI por renglón (los de fecha más cercana) y asignación greedy global, menor distancia de días primero.
+    Los renglones que pierden todos sus candidatos repiten la búsqueda contra los CFDI que quedaron libres
+    (hasta MAX_RONDAS veces; lo que quede se empareja por orden de fecha). Los montos en cero no se cruzan. Devuelve el cruce con columnas de ambos lados + Dias_Diferencia.
+    """
+    aux_validos = np.flatnonzero(df_aux['Monto_Search'].fillna(0).to_numpy() != 0)
+    cfdi_validos = np.flatnonzero(df_cfdi['Monto_Target'].fillna(0).to_numpy() != 0)
+    fechas_aux = df_aux['Fecha'] if 'Fecha' in df_aux.columns else pd.Series(pd.NaT, index=df_aux.index)
+    fechas_cfdi = df_cfdi['Emisión'] if 'Emisión' in df_cfdi.columns else pd.Series(pd.NaT, index=df_cfdi.index)
+
+    cent_aux = a_centavos(df_aux['Monto_Search'].to_numpy()[aux_validos])
+    dias_aux = _dias(fechas_aux.to_numpy()[aux_validos])
+    cent_cfdi = a_centavos(df_cfdi['Monto_Target'].to_numpy()[cfdi_validos])
+    dias_cfdi = _dias(fechas_cfdi.to_numpy()[cfdi_validos])
+
+    # Por rondas: quien se quedó sin candidato libre vuelve a buscar solo entre los CFDI que siguen libres
+    libres_a, libres_c = np.arange(len(aux_validos)), np.arange(len(cfdi_validos))
+    asignados_a, asignados_c, asignados_d = [], [], []
+    for _ in range(MAX_RONDAS):
+        if not len(libres_a) or not len(libres_c): break
+        pos_a, pos_c, dist = candidatos_por_bloque(cent_aux[libres_a], dias_aux[libres_a],
+                                                   cent_cfdi[libres_c], dias_cfdi[libres_c], max_candidatos)
+        if not len(pos_a): break
+        prioridad = np.lexsort((pos_c, pos_a, dist))
+        pos_a, pos_c, dist = pos_a[prioridad], pos_c[prioridad], dist[prioridad]
+        k = asignar_uno_a_uno(pos_a, pos_c, bytearray(len(libres_a)), bytearray(len(libres_c)))
+        asignados_a.append(libres_a[pos_a[k]]); asignados_c.append(libres_c[pos_c[k]]); asignados_d.append(dist[k])
+        # Siguen solo los renglones del AUX que tenían candidatos (los demás no tienen monto igual libre)
+        con_candidato = np.zeros(len(libres_a), dtype=bool); con_candidato[pos_a] = True
+        con_candidato[pos_a[k]] = False
+        usados_c = np.zeros(len(libres_c), dtype=bool); usados_c[pos_c[k]] = True
+        libres_a, libres_c = libres_a[con_candidato], libres_c[~usados_c]
+    else:
+        # Lo que sigue compitiendo (típicamente renglones sin fecha contra el mismo puñado de CFDI)
+        # se empareja dentro de cada monto por orden de fecha
+        pos_a, pos_c = _emparejar_por_orden(cent_aux[libres_a], dias_aux[libres_a], cent_cfdi[libres_c], dias_cfdi[libres_c])
+        d_a, d_c = dias_aux[libres_a[pos_a]], dias_cfdi[libres_c[pos_c]]
+        asignados_a.append(libres_a[pos_a]); asignados_c.append(libres_c[pos_c])
+        asignados_d.append(np.where((d_a < 0) | (d_c < 0), DIAS_SIN_FECHA, np.abs(d_a - d_c)))
+
+    pos_a = np.concatenate(asignados_a) if asignados_a else np.array([], dtype=np.int64)
+    pos_c = np.concatenate(asignados_c) if asignados_c else np.array([], dtype=np.int64)
+    dist = np.concatenate(asignados_d) if asignados_d else np.array([], dtype=np.int64)
+    k = np.argsort(pos_a, kind='stable') # Salida en el orden del AUX, como el merge anterior
+
+    izq = df_aux.iloc[aux_validos[pos_a[k]]].reset_index(drop=True)
+    der = df_cfdi.iloc[cfdi_validos[pos_c[k]]].reset_index(drop=True)
+    comunes = set(izq.columns) & set(der.columns)
+    merged = pd.concat([izq.rename(columns={c: f"{c}_AUX" for c in comunes}),
+                        der.rename(columns={c: f"{c}_CFDI" for c in comunes})], axis=1)
+    merged['Dias_Diferencia'] = np.where(dist[k] == DIAS_SIN_FECHA, np.nan, dist[k])
+    return merged
+
+# --- CALIFICACIÓN DE COINCIDENCIAS CON EL MODELO ---
+
+_modelos = {}
+_lock_modelos = threading.Lock()
+
+def cargar_modelo(ruta=RUTA_MODELO):
+    """
+    Modelo de training/train_model.py, cargado una sola vez por proceso y vuelto a cargar solo si cambia
+    la fecha de modificación del archivo. None si no existe o no se puede leer.
+    """
+    try:
+        mtime = os.path.getmtime(ruta)
+    except OSError:
+        return None
+    with _lock_modelos:
+        cacheado = _modelos.get(ruta)
+        if cacheado and cacheado[0] == mtime:
+            return cacheado[1]
+        try:
+            modelo = joblib.load(ruta)
+        except Exception as e:
+            print(f"Error cargando modelo de conciliación: {e}")
+            return None
+        _modelos[ruta] = (mtime, modelo)
+        return modelo
+
+def _texto_folio(folios):
+    """Folio como texto en mayúsculas (123.0 -> '123'); vacío si no hay folio."""
+    numeros = pd.to_numeric(folios, errors='coerce')
+    enteros = numeros.notna() & (numeros % 1 == 0)
+    texto = folios.astype(str).str.strip().str.upper()
+    texto[enteros] = numeros[enteros].astype(np.int64).astype(str)
+    return texto.where(folios.notna() & (texto != '') & (texto != 'NAN'), '')
+
+def _similitud_folio(conceptos, folios):
+    """1.0 si el folio aparece como palabra completa en el concepto, 0.5 si solo como terminación, 0 si no."""
+    conceptos = conceptos.reset_index(drop=True)
+    folios = folios.reset_index(drop=True)
+    resultado = np.zeros(len(folios))
+    con_folio = folios[folios != '']
+    if con_folio.empty: return resultado
+    indice = IndiceFolios(conceptos, con_folio.unique())
+    for folio, filas in con_folio.groupby(con_folio).groups.items():
+        filas = set(filas)
+        parcial = filas & indice.buscar(folio, REGEX_FOLIO_PARCIAL)
+        resultado[list(parcial)] = 0.5
+        exacto = filas & indice.buscar(folio, REGEX_FOLIO_EXACTO)
+        resultado[list(exacto)] = 1.0
+    return resultado
+
+def _similitud_tokens(textos_a, textos_b):
+    """Jaccard entre las palabras (3+ caracteres) de cada par de textos, con explode + merge en lugar de un ciclo."""
+    def tokens(textos):
+        t = pd.Series(textos).reset_index(drop=True).fillna('').astype(str).str.upper().str.findall(r'\w{3,}')
+        return t.explode().dropna().rename('token').rename_axis('fila').reset_index().drop_duplicates()
+    ta, tb = tokens(textos_a), tokens(textos_b)
+    interseccion = ta.merge(tb, on=['fila', 'token']).groupby('fila').size()
+    union = ta.groupby('fila').size().add(tb.groupby('fila').size(), fill_value=0).sub(interseccion, fill_value=0)
+    return (interseccion / union).reindex(range(len(textos_a)), fill_value=0.0).fillna(0.0).to_numpy()
+
+def calcular_features(merged):
+    """Las cinco features del modelo para cada par del cruce, como operaciones por columna."""
+    def columna(nombre, lado):
+        # Si ambos libros traen la columna, el cruce le agregó el sufijo del lado
+        return next((c for c in (f"{nombre}_{lado}", nombre) if c in merged.columns), None)
+    vacio = pd.Series('', index=merged.index)
+    concepto_col, folio_col, razon_col = columna('Concepto', 'AUX'), columna('Folio', 'CFDI'), columna('Razon_Social', 'CFDI')
+    concepto = merged[concepto_col].fillna('').astype(str).str.upper() if concepto_col else vacio
+    folio = _texto_folio(merged[folio_col]) if folio_col else vacio
+    diferencia = (merged['Monto_Search'] - merged['Monto_Target']).abs()
+    return pd.DataFrame({
+        'diferencia_monto': diferencia.to_numpy(),
+        'diferencia_dias': merged['Dias_Diferencia'].fillna(DIAS_SIN_FECHA).to_numpy(),
+        'similitud_folio': _similitud_folio(concepto, folio),
+        'similitud_razon_social': _similitud_tokens(concepto, merged[razon_col]) if razon_col else 0.0,
+        'es_mismo_monto': (a_centavos(diferencia.fillna(np.inf).clip(upper=1e12)) == 0).astype(int),
+    }, columns=FEATURES_MODELO)
+
+def _confianza_por_reglas(features):
+    """Sin modelo: mismo criterio que los pases del conciliador anterior (folio > fecha cercana > solo monto)."""
+    return np.select([features['similitud_folio'] > 0, features['diferencia_dias'] <= 5, features['diferencia_dias'] <= 30],
+                     [0.95, 0.65, 0.40], default=0.20)
+
+def calificar_coincidencias(merged, modelo=None, estadisticas=None, lote=LOTE_MODELO, progreso=None):
+    """
+    Agrega Confianza (probabilidad de match) a cada par: una llamada a predict_proba por lote de pares,
+    midiendo la latencia de cada lote (y reportando los pares calificados a progreso, si se pasa).
+    Si no hay modelo se usa _confianza_por_reglas.
+    """
+    features = calcular_features(merged)
+    lotes = []
+    if modelo is None or not len(features):
+        confianza = _confianza_por_reglas(features)
+    else:
+        clases = list(getattr(modelo, 'classes_', [0, 1]))
+        columna = clases.index(1) if 1 in clases else None
+        confianza = np.zeros(len(features))
+        for ini in range(0, len(features), lote):
+            inicio = time.perf_counter()
+            bloque = features.iloc[ini:ini + lote]
+            if columna is not None:
+                confianza[ini:ini + len(bloque)] = modelo.predict_proba(bloque)[:, columna]
+            lotes.append({"pares": len(bloque), "ms": round((time.perf_counter() - inicio) * 1000, 2)})
+            if progreso: progreso("conciliacion.calificacion", ini + len(bloque), len(features))
+    if estadisticas is not None:
+        estadisticas.update({
+            "modelo": "modelo" if modelo is not None else "reglas",
+            "pares_calificados": int(len(features)),
+            "lotes_modelo": lotes,
+            "ms_por_lote": round(sum(l["ms"] for l in lotes) / len(lotes), 2) if lotes else 0,
+        })
+    resultado = merged.copy()
+    for c in FEATURES_MODELO:
+        resultado[c] = features[c].to_numpy()
+    resultado['Confianza'] = np.round(confianza, 4)
+    return resultado
+
+def ejecutar_conciliacion(cfdi_path, aux_path, output_path, *args, estadisticas=None, usar_cache=True, progreso=None,
+                          **kwargs):
     """
     Programa: Conciliacion IA (Solo Excel)
-    Cruza Debe/Haber de AUX vs Columna IVA de CFDI.
+    Cruza Debe/Haber de AUX vs Columna IVA de CFDI y califica cada coincidencia con el modelo
+    (models/modelo_conciliacion.pkl) para repartirlas en Confianza_Alta / Media / Baja.
+    cfdi_path / aux_path: ruta del archivo o tabla ya cargada con load_cfdi / load_aux (modo completo).
+    Si se pasa el dict estadisticas, se llena con los datos de la calificación (lotes y latencia), en
+    estadisticas["etapas"] un span por etapa (carga, cruce, calificacion, escritura) con segundos, filas y
+    memoria residente (y su cambio en la etapa), y en estadisticas["tiempos"] solo los segundos de cada una; en
+    estadisticas["tablas_cache"] si cada archivo salió de la caché de tablas (usar_cache).
+    progreso(etapa, hecho, total), si se pasa (ver modulo_trabajos.Progreso), recibe el avance: carga,
+    renglones del AUX cruzados, pares calificados y escritura del Excel.
     """
+    etapas = Etapas("conciliacion")
     try:
-        df_cfdi = load_cfdi(cfdi_path)
-        df_aux = load_aux(aux_path)
+        if progreso: progreso("conciliacion.carga")
+        df_cfdi = cfdi_path if isinstance(cfdi_path, pd.DataFrame) else load_cfdi(cfdi_path, estadisticas, usar_cache)
+        df_aux = aux_path if isinstance(aux_path, pd.DataFrame) else load_aux(aux_path, estadisticas, usar_cache)
         if df_cfdi is None or df_aux is None: return False, [], "Error en carga de archivos."
+        etapas.marcar("carga", filas_cfdi=len(df_cfdi), filas_aux=len(df_aux))
 
-        # Merge por monto
-        merged = pd.merge(df_aux, df_cfdi, left_on='Monto_Search', right_on='Monto_Target', suffixes=('_AUX', '_CFDI'))
+        # Cruce uno a uno por monto, desempatando por fecha más cercana
+        merged = match_monto_fecha(df_aux, df_cfdi)
         merged['Match_Type'] = 'Monto_IA_IVA'
+        etapas.marcar("cruce", coincidencias=len(merged))
+        if progreso: progreso("conciliacion.cruce", len(merged), len(df_aux))
+        merged = calificar_coincidencias(merged, cargar_modelo(), estadisticas, progreso=progreso)
+        etapas.marcar("calificacion", pares=len(merged))
         
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            merged.to_excel(writer, sheet_name='Coincidencias', index=False)
-            df_aux[~df_aux['ID_AUX'].isin(merged['ID_AUX'])].to_excel(writer, sheet_name='Sobrantes_AUX', index=False)
+        alta = merged[merged['Confianza'] >= UMBRAL_ALTA]
+        media = merged[(merged['Confianza'] >= UMBRAL_MEDIA) & (merged['Confianza'] < UMBRAL_ALTA)]
+        baja = merged[merged['Confianza'] < UMBRAL_MEDIA]
+        sobrantes = df_aux[~df_aux['ID_AUX'].isin(merged['ID_AUX'])]
+        if progreso: progreso("conciliacion.escritura")
+        escribir_libro(output_path, [
+            ('Confianza_Alta', alta),
+            ('Confianza_Media', media),
+            ('Confianza_Baja', baja),
+            ('Sobrantes_AUX', sobrantes),
+        ])
+        etapas.marcar("escritura", filas=len(merged) + len(sobrantes))
+        if progreso: progreso("conciliacion.terminado")
+        if estadisticas is not None: estadisticas.update({"etapas": etapas.lista, "tiempos": etapas.tiempos})
 
-        dashboard = [{"Paso": "Match Monto IA (Debe/Haber vs IVA)", "Coincidencias": len(merged)}]
-        resumen = f"Se encontraron {len(merged)} coincidencias entre los montos de tu auxiliar y el IVA de las facturas."
+        dashboard = [
+            {"Paso": "Confianza Alta", "Coincidencias": len(alta)},
+            {"Paso": "Confianza Media", "Coincidencias": len(media)},
+            {"Paso": "Confianza Baja", "Coincidencias": len(baja)},
+        ]
+        resumen = (f"Se encontraron {len(merged)} coincidencias entre los montos de tu auxiliar y el IVA de las facturas: "
+                   f"{len(alta)} de confianza alta, {len(media)} media y {len(baja)} baja.")
         return True, dashboard, resumen
-    except Exception as e: return False, [], str(e)
+    except Exception as e:
+        etapas.fallar()
+        return False, [], str(e)
 
 def generar_resumen_ia(df_final, *args, **kwargs):
     """Función placeholder para mantener compatibilidad con app.py"""
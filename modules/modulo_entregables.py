@@ -0,0 +1,118 @@
+# modulo_entregables.py
+import os
+import threading
+import time
+import traceback
+import zipfile
+from pathlib import Path
+
+# Formatos que ya vienen comprimidos: se guardan en el zip sin volver a comprimir (ZIP_STORED)
+EXTENSIONES_COMPRIMIDAS = {'.pdf', '.xlsx', '.zip', '.png', '.jpg', '.jpeg', '.parquet'}
+SUFIJO_PARCIAL = '.parcial'
+# Retención de outputs/: antigüedad máxima de un resultado y espacio total que pueden ocupar
+RETENCION_DIAS = float(os.environ.get('SUITE_RETENCION_DIAS', 7))
+RETENCION_MB = int(os.environ.get('SUITE_RETENCION_MB', 2048))
+RETENCION_INTERVALO = int(os.environ.get('SUITE_RETENCION_INTERVALO', 3600))
+
+
+class ArchivoResultado:
+    """
+    Zip de resultados que se arma mientras se generan los entregables:
+        with ArchivoResultado(OUTPUT_FOLDER, nombre) as archivo:
+            archivo.zip.writestr(...) / archivo.agregar(ruta)
+            archivo.publicar()
+    Se escribe en '.<nombre>.zip.parcial' y solo al salir (sin excepción y con publicar()) se renombra
+    a '<nombre>.zip', así una descarga nunca ve un zip a medias. Si no se publicó, se borra.
+    """
+
+    def __init__(self, directorio, nombre):
+        self.ruta = Path(directorio) / f"{nombre}.zip"
+        self.ruta_parcial = Path(directorio) / f".{nombre}.zip{SUFIJO_PARCIAL}"
+        self.zip = None
+        self._publicar = False
+
+    def __enter__(self):
+        self.zip = zipfile.ZipFile(self.ruta_parcial, 'w', zipfile.ZIP_DEFLATED)
+        return self
+
+    def agregar(self, ruta, nombre=None):
+        """Copia un archivo al zip por bloques (sin cargarlo completo en memoria)."""
+        ruta = Path(ruta)
+        comprimir = ruta.suffix.lower() not in EXTENSIONES_COMPRIMIDAS
+        self.zip.write(ruta, nombre or ruta.name, compress_type=zipfile.ZIP_DEFLATED if comprimir else zipfile.ZIP_STORED)
+
+    def publicar(self):
+        self._publicar = True
+
+    def __exit__(self, tipo, valor, tb):
+        try:
+            self.zip.close()
+            if tipo is None and self._publicar:
+                os.replace(self.ruta_parcial, self.ruta)
+        finally:
+            self.ruta_parcial.unlink(missing_ok=True)
+        return False
+
+
+def limpiar_resultados(directorio, max_dias=RETENCION_DIAS, max_mb=RETENCION_MB, ahora=None):
+    """
+    Borra de directorio los zips con más de max_dias y, si aun así se rebasa max_mb, los más viejos
+    hasta quedar dentro del presupuesto. Los '.parcial' de trabajos en curso se respetan salvo que
+    lleven más de max_dias sin tocarse (trabajo interrumpido). Devuelve (archivos_borrados, bytes_liberados).
+    """
+    ahora = ahora or time.time()
+    limite_edad = ahora - max_dias * 86400
+    vigentes, borrados, liberados = [], 0, 0
+    for ruta in Path(directorio).iterdir():
+        if not ruta.is_file(): continue
+        try:
+            st = ruta.stat()
+        except FileNotFoundError:
+            continue
+        parcial = ruta.name.endswith(SUFIJO_PARCIAL)
+        if not parcial and ruta.suffix != '.zip': continue
+        if st.st_mtime < limite_edad:
+            ruta.unlink(missing_ok=True)
+            borrados, liberados = borrados + 1, liberados + st.st_size
+        elif not parcial:
+            vigentes.append((st.st_mtime, st.st_size, ruta))
+
+    total = sum(tamano for _, tamano, _ in vigentes)
+    for _, tamano, ruta in sorted(vigentes):
+        if total <= max_mb * 1024 * 1024: break
+        ruta.unlink(missing_ok=True)
+        total -= tamano
+        borrados, liberados = borrados + 1, liberados + tamano
+    return borrados, liberados
+
+
+class RetencionResultados:
+    """
+    Hilo que aplica limpiar_resultados (u otra función limpiar(directorio, **limites) que devuelva
+    (borrados, bytes_liberados)) cada intervalo segundos; cada worker de gunicorn corre el suyo.
+    """
+
+    def __init__(self, directorio, intervalo=RETENCION_INTERVALO, limpiar=limpiar_resultados, **limites):
+        self.directorio = directorio
+        self.intervalo = intervalo
+        self.limpiar = limpiar
+        self.limites = limites
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._ciclo, name="retencion", daemon=True)
+
+    def iniciar(self):
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        self._detener.set()
+
+    def _ciclo(self):
+        while not self._detener.is_set():
+            try:
+                borrados, liberados = self.limpiar(self.directorio, **self.limites)
+                if borrados:
+                    print(f"Retención: {borrados} resultados borrados ({liberados / 1024 / 1024:.1f} MB liberados).")
+            except Exception:
+                print(f"Error en la retención de resultados: {traceback.format_exc()}")
+            self._detener.wait(self.intervalo)
@@ -0,0 +1,227 @@
+# modulo_excel.py
+import os
+import numpy as np
+import openpyxl
+import pandas as pd
+
+try:
+    from python_calamine import CalamineWorkbook  # Lector en Rust, opcional (pip install python-calamine)
+except ImportError:
+    CalamineWorkbook = None
+
+try:
+    import xlsxwriter  # Escritor en modo constant_memory, opcional (pip install xlsxwriter)
+except ImportError:
+    xlsxwriter = None
+
+# 'auto' usa calamine si está instalado y si no openpyxl en modo read-only
+MOTOR_LECTURA = os.environ.get('SUITE_MOTOR_EXCEL', 'auto')
+# Copia de cada hoja entregada para otras herramientas: '' (ninguna), 'csv' o 'parquet'
+SIDECAR_ENTREGABLES = os.environ.get('SUITE_SIDECAR', '')
+
+FILAS_POR_BLOQUE = 10000
+FORMATO_FECHA = 'yyyy-mm-dd'
+FORMATO_MONEDA = '#,##0.00'
+
+
+def motor_disponible(motor=None):
+    motor = motor or MOTOR_LECTURA
+    if motor == 'auto':
+        return 'calamine' if CalamineWorkbook is not None else 'openpyxl'
+    if motor == 'calamine' and CalamineWorkbook is None:
+        raise ValueError("El motor 'calamine' requiere el paquete python-calamine.")
+    return motor
+
+
+def _elegir_hoja(nombres, hojas):
+    """Primera hoja de la lista que exista en el libro; si ninguna, la primera del libro."""
+    for hoja in hojas or []:
+        if hoja in nombres: return hoja
+    return nombres[0]
+
+
+def _filas_openpyxl(fuente, hojas):
+    wb = openpyxl.load_workbook(fuente, read_only=True, data_only=True)
+    try:
+        ws = wb[_elegir_hoja(wb.sheetnames, hojas)]
+        for fila in ws.iter_rows(values_only=True):
+            yield fila
+    finally:
+        wb.close()
+
+
+def _filas_calamine(fuente, hojas):
+    wb = CalamineWorkbook.from_object(fuente)
+    hoja = wb.get_sheet_by_name(_elegir_hoja(wb.sheet_names, hojas))
+    for fila in hoja.to_python(skip_empty_area=False):
+        yield tuple(None if v == "" else v for v in fila)
+
+
+def _nombres_columnas(encabezado):
+    """Igual que pandas: celdas vacías -> 'Unnamed: N' y nombres repetidos -> 'X.1', 'X.2'..."""
+    nombres, vistos = [], {}
+    for i, v in enumerate(encabezado):
+        nombre = f"Unnamed: {i}" if v is None or v == "" else str(v).strip()
+        if nombre in vistos:
+            vistos[nombre] += 1
+            nombre = f"{nombre}.{vistos[nombre]}"
+        else:
+            vistos[nombre] = 0
+        nombres.append(nombre)
+    return nombres
+
+
+def leer_hoja(fuente, hojas=None, fila_encabezado=1, columnas=None, motor=None):
+    """
+    Lee una hoja de Excel en UNA sola pasada y la devuelve como DataFrame.
+    - fuente: ruta o stream binario (.xlsx).
+    - hojas: nombres aceptados en orden de preferencia; si no hay ninguno se usa la primera hoja
+      (sin volver a abrir el libro).
+    - fila_encabezado: fila (1 = primera) con los nombres de columna; las anteriores se ignoran.
+    - columnas: None para todas, lista de nombres, o función que recibe los encabezados y devuelve
+      los nombres a conservar. Solo esas columnas se copian a memoria.
+    Las filas completamente vacías se omiten, como en pd.read_excel.
+    """
+    motor = motor_disponible(motor)
+    if hasattr(fuente, 'seek'): fuente.seek(0)
+    filas = _filas_calamine(fuente, hojas) if motor == 'calamine' else _filas_openpyxl(fuente, hojas)
+    return tabla_desde_filas(filas, fila_encabezado, columnas)
+
+
+def tabla_desde_filas(filas, fila_encabezado=1, columnas=None):
+    """
+    Mismo resultado que leer_hoja a partir de filas ya leídas (iterable de tuplas de valores), para
+    no volver a abrir un libro cuyas filas ya se tienen en memoria.
+    """
+    filas = iter(filas)
+    encabezado = None
+    for num, fila in enumerate(filas, start=1):
+        if num == fila_encabezado:
+            encabezado = _nombres_columnas(fila)
+            break
+    if encabezado is None:
+        return pd.DataFrame()
+
+    if columnas is None:
+        elegidas = encabezado
+    else:
+        deseadas = columnas(encabezado) if callable(columnas) else columnas
+        elegidas = [c for c in encabezado if c in set(deseadas)]
+    indices = [encabezado.index(c) for c in elegidas]
+
+    datos = [[] for _ in indices]
+    for fila in filas:
+        valores = [fila[i] if i < len(fila) else None for i in indices]
+        if all(v is None for v in valores): continue
+        for lista, v in zip(datos, valores):
+            lista.append(np.nan if v is None else v)
+    # Cada columna se tipa por separado (float64, datetime64, str...) como lo haría read_excel
+    return pd.DataFrame({c: pd.Series(lista, dtype=float if not lista else None) for c, lista in zip(elegidas, datos)},
+                        columns=elegidas)
+
+
+# --- ESCRITURA DE ENTREGABLES (una fila a la vez, memoria constante) ---
+
+def _formatos_por_columna(df, formatos=None):
+    """Formato numérico de cada columna: el indicado en formatos o, por tipo, fecha / moneda."""
+    formatos = formatos or {}
+    resultado = []
+    for c in df.columns:
+        if c in formatos:
+            resultado.append(formatos[c])
+        elif pd.api.types.is_datetime64_any_dtype(df[c]):
+            resultado.append(FORMATO_FECHA)
+        elif pd.api.types.is_float_dtype(df[c]):
+            resultado.append(FORMATO_MONEDA)
+        else:
+            resultado.append(None)
+    return resultado
+
+
+def _filas_python(df):
+    """Filas como tuplas de valores nativos (NaN/NaT -> celda vacía), convertidas por bloques de columnas."""
+    for inicio in range(0, len(df), FILAS_POR_BLOQUE):
+        bloque = df.iloc[inicio:inicio + FILAS_POR_BLOQUE]
+        columnas = [bloque[c].astype(object).where(bloque[c].notna(), None).tolist() for c in bloque.columns]
+        yield from zip(*columnas)
+
+
+def _escribir_xlsxwriter(ruta, hojas, formatos):
+    wb = xlsxwriter.Workbook(ruta, {'constant_memory': True})
+    negrita = wb.add_format({'bold': True})
+    cache_formatos = {}
+    for nombre, df in hojas:
+        ws = wb.add_worksheet(nombre)
+        for i, fmt in enumerate(_formatos_por_columna(df, formatos)):
+            if fmt and fmt not in cache_formatos:
+                cache_formatos[fmt] = wb.add_format({'num_format': fmt})
+            # El formato de columna se aplica a toda celda sin formato propio
+            ws.set_column(i, i, 16, cache_formatos.get(fmt))
+        ws.write_row(0, 0, [str(c) for c in df.columns], negrita)
+        for r, fila in enumerate(_filas_python(df), start=1):
+            ws.write_row(r, 0, fila)
+    wb.close()
+
+
+def _escribir_openpyxl(ruta, hojas, formatos):
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+    from openpyxl.utils import get_column_letter
+    wb = openpyxl.Workbook(write_only=True)
+    for nombre, df in hojas:
+        ws = wb.create_sheet(nombre)
+        fmts = _formatos_por_columna(df, formatos)
+        for i in range(len(df.columns)):
+            ws.column_dimensions[get_column_letter(i + 1)].width = 16
+        encabezado = []
+        for c in df.columns:
+            celda = WriteOnlyCell(ws, value=str(c))
+            celda.font = Font(bold=True)
+            encabezado.append(celda)
+        ws.append(encabezado)
+        # En write_only no hay estilo de columna: solo las columnas con formato llevan celda con estilo
+        con_formato = [(i, f) for i, f in enumerate(fmts) if f]
+        for fila in _filas_python(df):
+            fila = list(fila)
+            for i, fmt in con_formato:
+                if fila[i] is not None:
+                    celda = WriteOnlyCell(ws, value=fila[i])
+                    celda.number_format = fmt
+                    fila[i] = celda
+            ws.append(fila)
+    wb.save(ruta)
+
+
+def _escribir_sidecar(ruta, hojas, sidecar):
+    base = os.path.splitext(str(ruta))[0]
+    for nombre, df in hojas:
+        destino = f"{base}_{nombre}.{sidecar}"
+        if sidecar == 'csv':
+            df.to_csv(destino, index=False, encoding='utf-8-sig')
+        elif sidecar == 'parquet':
+            try:
+                df.to_parquet(destino, index=False)
+            except ImportError as e:
+                print(f"No se generó la copia parquet de {nombre}: {e}")
+        else:
+            raise ValueError(f"Formato de copia no soportado: {sidecar}")
+
+
+def escribir_libro(ruta, hojas, formatos=None, sidecar=None, motor=None):
+    """
+    Escribe un entregable .xlsx fila por fila sin armar el libro en memoria:
+    xlsxwriter en modo constant_memory si está instalado, si no openpyxl write_only.
+    - hojas: lista de (nombre_hoja, DataFrame) o dict con el mismo contenido.
+    - formatos: {columna: formato_numérico}; el resto se deduce del tipo (fechas y montos).
+    - sidecar: 'csv' / 'parquet' para dejar además una copia de cada hoja junto al .xlsx
+      (default: SUITE_SIDECAR).
+    """
+    hojas = list(hojas.items()) if isinstance(hojas, dict) else list(hojas)
+    motor = motor or ('xlsxwriter' if xlsxwriter is not None else 'openpyxl')
+    if motor == 'xlsxwriter':
+        _escribir_xlsxwriter(str(ruta), hojas, formatos)
+    else:
+        _escribir_openpyxl(str(ruta), hojas, formatos)
+    sidecar = SIDECAR_ENTREGABLES if sidecar is None else sidecar
+    if sidecar:
+        _escribir_sidecar(ruta, hojas, sidecar)
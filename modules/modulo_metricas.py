@@ -0,0 +1,281 @@
+# modulo_metricas.py
+import atexit
+import fcntl
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from modules.modulo_trabajos import identificar_proceso, proceso_vivo
+
+# Límites (segundos) de los buckets del histograma de latencia de peticiones
+BUCKETS_LATENCIA = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Almacén compartido entre workers: segundos máximos entre escrituras del archivo de cada proceso
+INTERVALO_METRICAS = float(os.environ.get('SUITE_INTERVALO_METRICAS', 5))
+ACUMULADO = "acumulado.json" # Suma de los procesos que ya terminaron
+
+
+def rss_actual_mb():
+    """Memoria residente actual del proceso (/proc/self/statm); None donde no hay /proc."""
+    try:
+        with open("/proc/self/statm") as f:
+            paginas = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(paginas * resource.getpagesize() / (1024 * 1024), 1)
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _etiquetas(**valores):
+    return "{" + ",".join(f'{k}="{_escapar(v)}"' for k, v in valores.items()) + "}"
+
+
+class RegistroMetricas:
+    """
+    Acumulados para /metrics: latencia de peticiones por endpoint (histograma) y totales por etapa
+    (ejecuciones, errores, segundos y conteos de filas / páginas / PDFs).
+    Cada proceso suma en memoria. Con compartir(directorio), además deja sus acumulados en
+    <directorio>/<pid_arranque>.json (a lo más cada intervalo segundos y siempre antes de responder /metrics)
+    y texto_prometheus() suma los de todos los workers de gunicorn: da igual a cuál llegue el scrape, los
+    contadores no retroceden. Los archivos de procesos que ya terminaron se suman a acumulado.json.
+    """
+
+    def __init__(self, buckets=BUCKETS_LATENCIA):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._peticiones = {}  # (endpoint, metodo, estado) -> [conteos por bucket, suma, total]
+        self._etapas = {}      # etapa -> {"ejecuciones", "errores", "segundos", "conteos": {}}
+        self.directorio = None
+        self._guardado = 0.0
+
+    def compartir(self, directorio, intervalo=INTERVALO_METRICAS):
+        """Activa el almacén compartido entre procesos en directorio."""
+        self.directorio, self.intervalo = Path(directorio), intervalo
+        self.directorio.mkdir(parents=True, exist_ok=True)
+        self._proceso = identificar_proceso()
+        self._archivo = self.directorio / f"{self._proceso.replace(':', '_')}.json"
+        self._compactar()
+        atexit.register(self._guardar)
+        return self
+
+    def observar_peticion(self, endpoint, metodo, estado, segundos):
+        clave = (endpoint or "desconocido", metodo, str(estado))
+        with self._lock:
+            serie = self._peticiones.setdefault(clave, [[0] * len(self.buckets), 0.0, 0])
+            for i, limite in enumerate(self.buckets):
+                if segundos <= limite: serie[0][i] += 1
+            serie[1] += segundos
+            serie[2] += 1
+        self._guardar_si_toca()
+
+    def registrar_etapa(self, nombre, segundos, conteos=None, error=False):
+        with self._lock:
+            etapa = self._etapas.setdefault(nombre, {"ejecuciones": 0, "errores": 0, "segundos": 0.0, "conteos": {}})
+            etapa["ejecuciones"] += 1
+            etapa["errores"] += int(error)
+            etapa["segundos"] += segundos
+            for tipo, n in (conteos or {}).items():
+                etapa["conteos"][tipo] = etapa["conteos"].get(tipo, 0) + n
+        self._guardar_si_toca()
+
+    def _instantanea(self):
+        with self._lock:
+            return {
+                "peticiones": [[*clave, list(v[0]), v[1], v[2]] for clave, v in self._peticiones.items()],
+                "etapas": {k: dict(v, conteos=dict(v["conteos"])) for k, v in self._etapas.items()},
+            }
+
+    def _guardar_si_toca(self):
+        if self.directorio is not None and time.monotonic() - self._guardado >= self.intervalo:
+            self._guardar()
+
+    def _guardar(self):
+        if self.directorio is None: return
+        self._guardado = time.monotonic()
+        datos = dict(self._instantanea(), proceso=self._proceso, rss_bytes=int((rss_actual_mb() or 0) * 1024 * 1024))
+        _escribir_json(self._archivo, datos)
+
+    def _compactar(self):
+        """Suma a acumulado.json los archivos de procesos que ya no corren (con candado: los workers arrancan juntos)."""
+        with open(self.directorio / ".candado", "a") as candado:
+            fcntl.flock(candado, fcntl.LOCK_EX)
+            muertos = [a for a in self.directorio.glob("*.json")
+                       if a.name != ACUMULADO and not proceso_vivo(a.stem.replace("_", ":"))]
+            if not muertos: return
+            acumulado = self._sumar([_leer_json(a) for a in [self.directorio / ACUMULADO] + muertos])
+            _escribir_json(self.directorio / ACUMULADO, {
+                "peticiones": [[*clave, v[0], v[1], v[2]] for clave, v in acumulado[0].items()], "etapas": acumulado[1],
+            })
+            for archivo in muertos:
+                archivo.unlink(missing_ok=True)
+
+    def _sumar(self, instantaneas):
+        """Suma instantáneas de varios procesos -> (peticiones, etapas) con la forma de los acumulados internos."""
+        peticiones, etapas = {}, {}
+        for datos in instantaneas:
+            for endpoint, metodo, estado, cubetas, suma, total in datos.get("peticiones", ()):
+                serie = peticiones.setdefault((endpoint, metodo, estado), [[0] * len(self.buckets), 0.0, 0])
+                serie[0] = [a + b for a, b in zip(serie[0], cubetas)]
+                serie[1] += suma
+                serie[2] += total
+            for nombre, parte in datos.get("etapas", {}).items():
+                etapa = etapas.setdefault(nombre, {"ejecuciones": 0, "errores": 0, "segundos": 0.0, "conteos": {}})
+                for campo in ("ejecuciones", "errores", "segundos"):
+                    etapa[campo] += parte[campo]
+                for tipo, n in parte["conteos"].items():
+                    etapa["conteos"][tipo] = etapa["conteos"].get(tipo, 0) + n
+        return peticiones, etapas
+
+    def texto_prometheus(self):
+        """Formato de exposición de texto de Prometheus (version 0.0.4)."""
+        if self.directorio is None:
+            instantaneas = [dict(self._instantanea(), proceso=str(os.getpid()),
+                                 rss_bytes=int((rss_actual_mb() or 0) * 1024 * 1024))]
+        else:
+            self._guardar()
+            instantaneas = [_leer_json(a) for a in sorted(self.directorio.glob("*.json"))]
+        peticiones, etapas = self._sumar(instantaneas)
+
+        lineas = ["# HELP suite_http_peticion_segundos Latencia de peticiones HTTP por endpoint.",
+                  "# TYPE suite_http_peticion_segundos histogram"]
+        for (endpoint, metodo, estado), (cubetas, suma, total) in sorted(peticiones.items()):
+            base = dict(endpoint=endpoint, metodo=metodo, estado=estado)
+            for limite, n in zip(self.buckets, cubetas):
+                lineas.append(f"suite_http_peticion_segundos_bucket{_etiquetas(**base, le=limite)} {n}")
+            lineas.append(f"suite_http_peticion_segundos_bucket{_etiquetas(**base, le='+Inf')} {total}")
+            lineas.append(f"suite_http_peticion_segundos_sum{_etiquetas(**base)} {suma:.6f}")
+            lineas.append(f"suite_http_peticion_segundos_count{_etiquetas(**base)} {total}")
+
+        for metrica, campo, ayuda in [
+            ("suite_etapa_ejecuciones_total", "ejecuciones", "Veces que se ejecutó cada etapa."),
+            ("suite_etapa_errores_total", "errores", "Ejecuciones de la etapa que terminaron con excepción."),
+            ("suite_etapa_segundos_total", "segundos", "Segundos acumulados en cada etapa."),
+        ]:
+            lineas += [f"# HELP {metrica} {ayuda}", f"# TYPE {metrica} counter"]
+            for nombre, etapa in sorted(etapas.items()):
+                valor = f"{etapa[campo]:.6f}" if campo == "segundos" else etapa[campo]
+                lineas.append(f"{metrica}{_etiquetas(etapa=nombre)} {valor}")
+
+        lineas += ["# HELP suite_etapa_elementos_total Filas, páginas o documentos procesados por etapa.",
+                   "# TYPE suite_etapa_elementos_total counter"]
+        for nombre, etapa in sorted(etapas.items()):
+            for tipo, n in sorted(etapa["conteos"].items()):
+                lineas.append(f"suite_etapa_elementos_total{_etiquetas(etapa=nombre, tipo=tipo)} {n}")
+
+        # Gauge por proceso vivo (la memoria no se suma entre workers)
+        lineas += ["# HELP suite_memoria_residente_bytes Memoria residente de cada worker.",
+                   "# TYPE suite_memoria_residente_bytes gauge"]
+        for datos in instantaneas:
+            proceso = datos.get("proceso")
+            if proceso and (self.directorio is None or proceso_vivo(proceso)):
+                lineas.append(f"suite_memoria_residente_bytes{_etiquetas(proceso=proceso.split(':')[0])} {datos['rss_bytes']}")
+        return "\n".join(lineas) + "\n"
+
+
+def _leer_json(ruta):
+    try:
+        with open(ruta) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {} # Aún no existe o lo reemplazaron a la mitad: se toma como vacío
+
+
+def _escribir_json(ruta, datos):
+    """Escritura atómica (temporal + os.replace): quien lea a la vez ve el archivo anterior o el nuevo."""
+    temporal = ruta.with_name(f".{ruta.name}.{os.getpid()}.{threading.get_ident()}")
+    with open(temporal, "w") as f:
+        json.dump(datos, f)
+    os.replace(temporal, ruta)
+
+
+registro_global = RegistroMetricas()
+
+
+class Span:
+    """
+    Una etapa medida: duración, conteos (filas, páginas...) y memoria residente al cerrar y cuánto cambió
+    desde que abrió. El pico del proceso (ru_maxrss) no sirve por etapa: solo crece desde que arrancó el worker.
+    """
+
+    def __init__(self, nombre, registro=None):
+        self.nombre = nombre
+        self.registro = registro or registro_global
+        self.conteos = {}
+        self.inicio = time.perf_counter()
+        self.rss_inicio = rss_actual_mb()
+        self.segundos = None
+        self.datos = None # dict del span una vez cerrado (para el dashboard)
+
+    def contar(self, **conteos):
+        for tipo, n in conteos.items():
+            self.conteos[tipo] = self.conteos.get(tipo, 0) + int(n)
+
+    def cerrar(self, error=False):
+        self.segundos = time.perf_counter() - self.inicio
+        self.registro.registrar_etapa(self.nombre, self.segundos, self.conteos, error)
+        rss = rss_actual_mb()
+        delta = round(rss - self.rss_inicio, 1) if rss is not None and self.rss_inicio is not None else None
+        datos = {"nombre": self.nombre, "segundos": round(self.segundos, 4), "rss_mb": rss, "rss_delta_mb": delta,
+                 **self.conteos}
+        if error: datos["error"] = True
+        self.datos = datos
+        return datos
+
+
+@contextmanager
+def span(nombre, registro=None, **conteos):
+    """
+    with span("carga", filas=n) as s: ...; s.contar(paginas=p)
+    Al salir registra la etapa en el registro del proceso (también si terminó con excepción).
+    """
+    actual = Span(nombre, registro)
+    actual.contar(**conteos)
+    try:
+        yield actual
+    except BaseException:
+        actual.cerrar(error=True)
+        raise
+    actual.cerrar()
+
+
+class Etapas:
+    """
+    Spans consecutivos de un proceso lineal: cada marcar() cierra la etapa que empezó en la marca
+    anterior, sin tener que anidar el código en bloques with.
+    """
+
+    def __init__(self, prefijo, registro=None):
+        self.prefijo = prefijo
+        self.registro = registro
+        self.lista = []
+        self.reiniciar()
+
+    def reiniciar(self):
+        self._actual = Span("", self.registro)
+
+    def marcar(self, nombre, **conteos):
+        actual = self._actual
+        actual.nombre = f"{self.prefijo}.{nombre}" if self.prefijo else nombre
+        actual.contar(**conteos)
+        datos = actual.cerrar()
+        datos["nombre"] = nombre
+        self.lista.append(datos)
+        self.reiniciar()
+        return datos
+
+    def fallar(self):
+        """Cierra la etapa en curso como error (sin nombre propio: '<prefijo>.error')."""
+        self._actual.nombre = f"{self.prefijo}.error" if self.prefijo else "error"
+        self._actual.cerrar(error=True)
+        self.reiniciar()
+
+    @property
+    def tiempos(self):
+        return {e["nombre"]: e["segundos"] for e in self.lista}
+
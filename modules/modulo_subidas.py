@@ -0,0 +1,115 @@
+# modulo_subidas.py
+import fcntl
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+# Tamaño de cada bloque que manda el navegador (debajo del client_max_body_size de nginx)
+TAMANO_BLOQUE = int(os.environ.get('SUITE_TAMANO_BLOQUE_MB', 8)) * 1024 * 1024
+MAX_SUBIDA_MB = int(os.environ.get('SUITE_MAX_SUBIDA_MB', 4096))
+# Una subida sin bloques nuevos en este tiempo se da por abandonada (archivo y registro)
+VIGENCIA_SUBIDA_DIAS = float(os.environ.get('SUITE_VIGENCIA_SUBIDA_DIAS', 1))
+LECTURA = 1024 * 1024
+# Límites para rechazar zips bomba antes de leer un solo miembro (ZIP de PDFs y zip de XML de CFDI)
+MAX_MB_ZIP = int(os.environ.get('SUITE_MAX_MB_ZIP', 2048)) # Tamaño total descomprimido
+MAX_RATIO_ZIP = int(os.environ.get('SUITE_MAX_RATIO_ZIP', 100)) # Descomprimido / comprimido por miembro
+
+
+
+def revisar_miembros_zip(miembros, maximo, tipo):
+    """
+    Valida los ZipInfo del directorio central contra los límites de miembros (maximo), tamaño descomprimido
+    y tasa de compresión; lanza ValueError si el zip rebasa alguno. tipo nombra los miembros en el mensaje.
+    zipfile nunca entrega más bytes que el tamaño declarado, así que validar lo declarado basta.
+    """
+    if len(miembros) > maximo:
+        raise ValueError(f"El ZIP tiene {len(miembros)} {tipo}; el máximo permitido es {maximo}.")
+    total = sum(i.file_size for i in miembros)
+    if total > MAX_MB_ZIP * 1024 * 1024:
+        raise ValueError(f"El ZIP descomprimido pesa {total // (1024 * 1024)} MB; el máximo es {MAX_MB_ZIP} MB.")
+    for i in miembros:
+        if i.file_size > 1024 * 1024 and i.file_size > MAX_RATIO_ZIP * max(i.compress_size, 1):
+            raise ValueError(f"El archivo {i.filename} tiene una compresión sospechosa; se rechaza el ZIP.")
+
+
+class ErrorSubida(Exception):
+    """Bloque fuera de lugar o subida inconsistente; recibido indica desde dónde reanudar."""
+
+    def __init__(self, mensaje, recibido):
+        super().__init__(mensaje)
+        self.recibido = recibido
+
+
+@contextmanager
+def bloquear(ruta):
+    """Candado exclusivo sobre el archivo: los bloques de una subida pueden llegar a workers distintos."""
+    with open(ruta, 'r+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class HashesEnCurso:
+    """
+    SHA-256 de cada subida calculado mientras llegan los bloques. El estado de hashlib no se puede
+    guardar en la DB, así que cada proceso lleva el suyo junto con hasta qué byte cubre; si otro
+    worker recibió bloques intermedios, se pone al día leyendo solo esa parte del archivo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hashes = {}  # id -> (hasher, bytes cubiertos)
+
+    def _al_dia(self, id_subida, f, hasta):
+        with self._lock:
+            hasher, cubierto = self._hashes.pop(id_subida, (None, 0))
+        if hasher is None or cubierto > hasta:
+            hasher, cubierto = hashlib.sha256(), 0
+        f.seek(cubierto)
+        while cubierto < hasta:
+            parte = f.read(min(LECTURA, hasta - cubierto))
+            if not parte: break
+            hasher.update(parte)
+            cubierto += len(parte)
+        return hasher, cubierto
+
+    def anexar(self, id_subida, f, offset, stream, longitud):
+        """
+        Escribe longitud bytes de stream en f a partir de offset (que debe ser el tamaño actual del
+        archivo) y actualiza el hash. Devuelve el nuevo tamaño.
+        """
+        recibido = os.fstat(f.fileno()).st_size
+        if offset != recibido:
+            raise ErrorSubida(f"Se esperaba el byte {recibido} y llegó {offset}.", recibido)
+        hasher, cubierto = self._al_dia(id_subida, f, offset)
+        f.seek(offset)
+        escritos = 0
+        while escritos < longitud:
+            parte = stream.read(min(LECTURA, longitud - escritos))
+            if not parte: break
+            f.write(parte)
+            hasher.update(parte)
+            escritos += len(parte)
+        if escritos < longitud:
+            # Conexión cortada a medio bloque: se descarta lo parcial para reanudar en un borde de bloque
+            f.truncate(offset)
+            raise ErrorSubida("El bloque llegó incompleto.", offset)
+        f.flush()
+        with self._lock:
+            self._hashes[id_subida] = (hasher, offset + escritos)
+        return offset + escritos
+
+    def finalizar(self, id_subida, f):
+        """SHA-256 (hex) de todo el archivo; libera el estado de la subida."""
+        hasher, _ = self._al_dia(id_subida, f, os.fstat(f.fileno()).st_size)
+        return hasher.hexdigest()
+
+    def descartar(self, id_subida):
+        with self._lock:
+            self._hashes.pop(id_subida, None)
+
+
+hashes_en_curso = HashesEnCurso()
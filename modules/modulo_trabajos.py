@@ -0,0 +1,132 @@
+# modulo_trabajos.py
+import fcntl
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ColaLlena(Exception):
+    """Se lanza cuando ya no hay cupo para aceptar más trabajos."""
+
+
+class ColaTrabajos:
+    """
+    Pool acotado de hilos para procesos largos (conciliación / auditoría).
+    - max_workers: trabajos ejecutándose al mismo tiempo en este proceso.
+    - max_cola: trabajos que pueden esperar turno detrás de los que corren.
+    Si se rebasa max_workers + max_cola, enviar() lanza ColaLlena en lugar de bloquear la petición.
+    """
+
+    def __init__(self, max_workers=2, max_cola=10):
+        self.max_workers = max_workers
+        self.max_cola = max_cola
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="trabajo")
+        self._cupos = threading.BoundedSemaphore(max_workers + max_cola)
+
+    def enviar(self, funcion, *args, **kwargs):
+        if not self._cupos.acquire(blocking=False):
+            raise ColaLlena("La cola de trabajos está llena, intenta de nuevo en unos minutos.")
+        try:
+            return self._executor.submit(self._ejecutar, funcion, *args, **kwargs)
+        except Exception:
+            self._cupos.release()
+            raise
+
+    def _ejecutar(self, funcion, *args, **kwargs):
+        try:
+            return funcion(*args, **kwargs)
+        except Exception:
+            print(f"Error en trabajo en segundo plano: {traceback.format_exc()}")
+        finally:
+            self._cupos.release()
+
+
+def identificar_proceso(pid=None):
+    """
+    'pid:arranque' del proceso (default: el actual). El arranque sale de /proc/<pid>/stat y distingue un
+    pid reutilizado después de reiniciar el servicio; sin /proc queda solo el pid.
+    """
+    pid = pid or os.getpid()
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            campos = f.read().rsplit(')', 1)[1].split()
+        return f"{pid}:{campos[19]}" # Campo 22 de stat (starttime); el 3 es el primero después del nombre
+    except (OSError, IndexError):
+        return str(pid)
+
+
+def proceso_vivo(identidad):
+    """True si el proceso de identificar_proceso() sigue corriendo (y no es otro con el mismo pid)."""
+    pid = int(identidad.split(':')[0])
+    if ':' in identidad:
+        return identificar_proceso(pid) == identidad
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # Existe, pero es de otro usuario
+    return True
+
+
+class CuposPorUsuario:
+    """
+    Conexiones largas simultáneas por usuario (p. ej. los eventos de un trabajo), contadas entre todos los
+    workers de gunicorn: cada conexión toma con flock uno de los por_usuario archivos de cupo del usuario.
+    Si el proceso muere el sistema suelta sus candados, así que un reinicio no deja cupos ocupados.
+    """
+
+    def __init__(self, directorio, por_usuario):
+        self.directorio = directorio
+        self.por_usuario = por_usuario
+        os.makedirs(directorio, exist_ok=True)
+
+    def tomar(self, usuario):
+        """Archivo del cupo tomado (para soltar()) o None si el usuario ya usa todos."""
+        for n in range(self.por_usuario):
+            f = open(os.path.join(self.directorio, f"{usuario}.{n}"), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except OSError:
+                f.close()
+        return None
+
+    @staticmethod
+    def soltar(cupo):
+        if cupo is not None and not cupo.closed:
+            cupo.close() # Cerrar el descriptor suelta el flock
+
+
+class Progreso:
+    """
+    Avance de un trabajo para mostrarlo en vivo: progreso("auditoria.indexado", hecho, total).
+    Guarda el último avance de cada herramienta (lo que va antes del punto) y llama a publicar(estado)
+    a lo más cada intervalo segundos; el cambio de etapa y el final de una etapa se publican siempre.
+    Entre publicaciones una llamada solo compara contra el reloj, así puede ir en ciclos largos.
+    Se puede llamar desde varios hilos (modo completo).
+    """
+
+    def __init__(self, publicar, intervalo=1.0):
+        self._publicar = publicar
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self._estado = {}  # herramienta -> {"etapa", "hecho", "total"}
+        self._siguiente = 0.0
+
+    def __call__(self, etapa, hecho=None, total=None):
+        herramienta, _, nombre = etapa.rpartition('.')
+        anterior = self._estado.get(herramienta)
+        urgente = anterior is None or anterior["etapa"] != nombre or (hecho is not None and hecho == total)
+        if not urgente and time.monotonic() < self._siguiente:
+            return
+        with self._lock:
+            self._estado[herramienta] = {"etapa": nombre, "hecho": hecho, "total": total}
+            estado = {k: dict(v) for k, v in self._estado.items()}
+            self._siguiente = time.monotonic() + self.intervalo
+        try:
+            self._publicar(estado)
+        except Exception:
+            print(f"Error publicando el avance del trabajo: {traceback.format_exc()}")
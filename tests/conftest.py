@@ -0,0 +1,17 @@
+import importlib.util
+import sys
+from pathlib import Path
+
+import pytest
+
+RAIZ = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(RAIZ))
+
+
+@pytest.fixture(scope="session")
+def legado():
+    """Script original de deprecated/ (las versiones con iterrows contra las que se comparan los pases)."""
+    spec = importlib.util.spec_from_file_location("legado", RAIZ / "deprecated" / "CODIGO_CONCIDENCIAS_CFDI.py")
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    return modulo
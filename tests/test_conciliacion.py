@@ -0,0 +1,198 @@
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import modules.modulo_conciliacion as conciliacion
+from modules.modulo_conciliacion import (REGEX_FOLIO_EXACTO, REGEX_FOLIO_PARCIAL, IndiceFolios, emparejar_montos,
+                                         match_by_monto_proximo)
+
+FECHA_BASE = pd.Timestamp("2024-01-01")
+
+
+@pytest.fixture
+def sort_estable(monkeypatch):
+    """El script anterior ordena candidatos con quicksort (empates en cualquier orden): se fija 'stable'."""
+    original = pd.DataFrame.sort_values
+
+    def sort_values(self, *args, **kwargs):
+        kwargs.setdefault("kind", "stable")
+        return original(self, *args, **kwargs)
+
+    monkeypatch.setattr(pd.DataFrame, "sort_values", sort_values)
+
+
+def _tablas(rng, n_cfdi, n_aux, fechas_nulas=0.1):
+    """
+    CFDI / AUX sintéticos con montos cercanos entre sí (muchos empates de diferencia) y fechas faltantes.
+    Los montos van en cuartos de peso, exactos en binario: el script anterior compara floats y deja fuera
+    montos justo en el borde de la tolerancia (102.04 - 0.05 = 101.99000000000001); los centavos no.
+    """
+    montos = rng.integers(400, 440, size=n_cfdi + n_aux) / 4
+    dias = rng.integers(0, 60, size=n_cfdi + n_aux)
+    fechas = [FECHA_BASE + pd.Timedelta(days=int(d)) for d in dias]
+    fechas = [pd.NaT if rng.random() < fechas_nulas else f for f in fechas]
+    cfdi = pd.DataFrame({
+        "UUID": [f"U{i:04d}" for i in range(n_cfdi)],
+        "Monto_Total": montos[:n_cfdi],
+        "Emisión": pd.to_datetime(fechas[:n_cfdi]),
+    })
+    es_debe = rng.random(n_aux) < 0.5
+    aux = pd.DataFrame({
+        "ID_AUX": np.arange(n_aux),
+        "Fecha": pd.to_datetime(fechas[n_cfdi:]),
+        "Monto_Debe": np.where(es_debe, montos[n_cfdi:], 0.0),
+        "Monto_Haber": np.where(es_debe, 0.0, montos[n_cfdi:]),
+    })
+    return cfdi, aux
+
+
+def _resumen(resultado):
+    encontrados, sobrantes_aux, sobrantes_cfdi = resultado
+    pares = set() if encontrados.empty else {
+        (u, int(a), round(float(d), 2)) for u, a, d in encontrados[["UUID", "ID_AUX", "Monto_Diff"]].itertuples(index=False)
+    }
+    return pares, sorted(sobrantes_aux["ID_AUX"]), sorted(sobrantes_cfdi["UUID"])
+
+
+@pytest.mark.parametrize("semilla", range(40))
+def test_monto_proximo_igual_al_anterior(legado, sort_estable, semilla):
+    rng = np.random.default_rng(semilla)
+    cfdi, aux = _tablas(rng, int(rng.integers(1, 40)), int(rng.integers(1, 60)))
+    tolerancia = float(rng.choice([0.25, 0.5, 1.0]))
+    ventana = int(rng.choice([0, 3, 10]))
+    nuevo = match_by_monto_proximo(cfdi, aux, tolerancia, ventana, "Monto Próximo", bloque=7)
+    anterior = legado.match_by_monto_proximo(cfdi, aux, tolerancia, ventana, "Monto Próximo")
+    assert _resumen(nuevo) == _resumen(anterior)
+
+
+@pytest.mark.parametrize("caso", ["cfdi_vacio", "aux_vacio", "cfdi_sin_fechas", "aux_sin_fechas"])
+def test_monto_proximo_sin_datos(legado, sort_estable, caso):
+    cfdi, aux = _tablas(np.random.default_rng(0), 10, 10, fechas_nulas=0)
+    if caso == "cfdi_vacio": cfdi = cfdi.iloc[0:0]
+    if caso == "aux_vacio": aux = aux.iloc[0:0]
+    if caso == "cfdi_sin_fechas": cfdi["Emisión"] = pd.NaT
+    if caso == "aux_sin_fechas": aux["Fecha"] = pd.NaT
+
+    encontrados, sobrantes_aux, sobrantes_cfdi = match_by_monto_proximo(cfdi, aux, 1.0, 5, "Monto Próximo")
+    assert encontrados.empty
+    assert sobrantes_aux is aux and sobrantes_cfdi is cfdi
+    assert _resumen((encontrados, sobrantes_aux, sobrantes_cfdi)) == \
+        _resumen(legado.match_by_monto_proximo(cfdi, aux, 1.0, 5, "Monto Próximo"))
+
+
+def _emparejar_por_pares(busqueda, indice, tolerancia):
+    """Referencia directa: todos los pares dentro de tolerancia por (diferencia, búsqueda, índice), greedy."""
+    busqueda, indice = np.rint(np.asarray(busqueda) * 100), np.rint(np.asarray(indice) * 100)
+    pares = sorted((abs(b - i), nb, ni) for nb, b in enumerate(busqueda) for ni, i in enumerate(indice)
+                   if abs(b - i) <= round(tolerancia * 100))
+    asignado, usados = [-1] * len(busqueda), set()
+    for _, nb, ni in pares:
+        if asignado[nb] < 0 and ni not in usados:
+            asignado[nb] = ni
+            usados.add(ni)
+    return asignado
+
+
+@pytest.mark.parametrize("semilla", range(30))
+def test_emparejar_montos_igual_a_pares(monkeypatch, semilla):
+    rng = np.random.default_rng(semilla)
+    if semilla % 2: monkeypatch.setattr(conciliacion, "PARES_POR_LOTE", 3)
+    rango = int(rng.integers(1, 15))
+    busqueda = rng.integers(10000, 10000 + rango, size=int(rng.integers(0, 60))) / 100
+    indice = rng.integers(10000, 10000 + rango, size=int(rng.integers(0, 60))) / 100
+    tolerancia = float(rng.choice([0, 0.01, 0.03]))
+    assert emparejar_montos(busqueda, indice, tolerancia).tolist() == _emparejar_por_pares(busqueda, indice, tolerancia)
+
+
+FOLIOS = ["12", "123", "0012", "A-15", "15", "-15", "7", "X7", "12.0", "Ñ12", "-", "F/123"]
+PALABRAS = ["PAGO", "FAC", "12", "123", "0012", "A-15", "-15", "15", "X7", "7", "FAC12", "12.0", "F/123", "AÑ12", "PAGO-12"]
+
+
+@pytest.mark.parametrize("plantilla", [REGEX_FOLIO_EXACTO, REGEX_FOLIO_PARCIAL])
+@pytest.mark.parametrize("semilla", range(20))
+def test_indice_folios_igual_a_regex(semilla, plantilla):
+    """Cada folio devuelve los mismos renglones que el str.contains por folio del script anterior."""
+    rng = np.random.default_rng(semilla)
+    conceptos = pd.Series([" ".join(rng.choice(PALABRAS, int(rng.integers(1, 4)))) for _ in range(40)] + [np.nan],
+                          index=np.arange(41) * 3)
+    indice = IndiceFolios(conceptos, FOLIOS)
+    for folio in FOLIOS:
+        patron = plantilla.format(folio=re.escape(folio))
+        esperado = set(conceptos.index[conceptos.str.contains(patron, na=False, regex=True)])
+        assert indice.buscar(folio, plantilla) == esperado, folio
+
+
+def _aux_cfdi(montos_aux, dias_aux, montos_cfdi, dias_cfdi):
+    """Tablas con las columnas de los cargadores; día None -> NaT."""
+    fecha = lambda dias: pd.to_datetime([pd.NaT if d is None else FECHA_BASE + pd.Timedelta(days=d) for d in dias])
+    aux = pd.DataFrame({"ID_AUX": np.arange(len(montos_aux)), "Monto_Search": np.asarray(montos_aux, dtype=float),
+                        "Fecha": fecha(dias_aux)})
+    cfdi = pd.DataFrame({"UUID": [f"U{i:04d}" for i in range(len(montos_cfdi))],
+                         "Monto_Target": np.asarray(montos_cfdi, dtype=float), "Emisión": fecha(dias_cfdi)})
+    return aux, cfdi
+
+
+def _cruce(merged):
+    """{ID_AUX: (UUID, Dias_Diferencia)}, con NaN como None."""
+    return {int(a): (u, None if pd.isna(d) else int(d))
+            for a, u, d in merged[["ID_AUX", "UUID", "Dias_Diferencia"]].itertuples(index=False)}
+
+
+def test_monto_fecha_montos_repetidos():
+    aux, cfdi = _aux_cfdi([100, 100, 100, 250], [0, 10, 20, 0], [100, 100, 100, 100, 300], [21, 1, 11, 40, 0])
+    assert _cruce(conciliacion.match_monto_fecha(aux, cfdi)) == {0: ("U0001", 1), 1: ("U0002", 1), 2: ("U0000", 1)}
+
+
+def test_monto_fecha_mas_cercano_primero():
+    """La asignación es global por distancia: el renglón 1 (a 1 día) gana U0000 aunque el 0 vaya antes."""
+    aux, cfdi = _aux_cfdi([100, 100], [5, 9], [100, 100], [10, 0])
+    assert _cruce(conciliacion.match_monto_fecha(aux, cfdi)) == {0: ("U0001", 5), 1: ("U0000", 1)}
+
+
+def test_monto_fecha_sin_fechas():
+    """Un renglón sin fecha se cruza después de los que tienen fecha y sin Dias_Diferencia."""
+    aux, cfdi = _aux_cfdi([100, 100, 200], [None, 3, 7], [100, 100, 200], [50, 3, None])
+    assert _cruce(conciliacion.match_monto_fecha(aux, cfdi)) == {0: ("U0000", None), 1: ("U0001", 0), 2: ("U0002", None)}
+    sin_columna = conciliacion.match_monto_fecha(aux.drop(columns="Fecha"), cfdi)
+    assert len(sin_columna) == 3 and sin_columna["Dias_Diferencia"].isna().all()
+
+
+def test_monto_fecha_excluye_montos_cero():
+    aux, cfdi = _aux_cfdi([0, np.nan, 100, 0], [0, 0, 0, 0], [0, 100, np.nan, 0], [0, 0, 0, 0])
+    assert _cruce(conciliacion.match_monto_fecha(aux, cfdi)) == {2: ("U0001", 0)}
+
+
+@pytest.mark.parametrize("rondas", [1, conciliacion.MAX_RONDAS])
+def test_monto_fecha_repetidos_mas_que_candidatos(monkeypatch, rondas):
+    """
+    Con max_candidatos=1 los 8 renglones del mismo día compiten por el mismo CFDI: las rondas (o el
+    emparejamiento por orden de lo que sobra) siguen hasta cruzar todos, uno a uno.
+    """
+    monkeypatch.setattr(conciliacion, "MAX_RONDAS", rondas)
+    aux, cfdi = _aux_cfdi([100] * 8, [0] * 8, [100] * 8, range(8))
+    cruce = _cruce(conciliacion.match_monto_fecha(aux, cfdi, max_candidatos=1))
+    assert sorted(cruce) == list(range(8))
+    assert sorted(u for u, _ in cruce.values()) == sorted(cfdi["UUID"])
+    assert sorted(d for _, d in cruce.values()) == list(range(8))
+
+
+@pytest.mark.parametrize("semilla", range(30))
+def test_monto_fecha_uno_a_uno(monkeypatch, semilla):
+    """Cada monto cruza min(renglones AUX, CFDI) pares, uno a uno, con la diferencia de días de sus fechas."""
+    rng = np.random.default_rng(semilla)
+    monkeypatch.setattr(conciliacion, "MAX_RONDAS", int(rng.integers(1, 5)))
+    n_aux, n_cfdi = int(rng.integers(0, 60)), int(rng.integers(0, 60))
+    dias = lambda n: [None if rng.random() < 0.2 else int(d) for d in rng.integers(0, 30, size=n)]
+    montos = lambda n: rng.choice([0, 100, 100.5, 200, 350.25], size=n)
+    aux, cfdi = _aux_cfdi(montos(n_aux), dias(n_aux), montos(n_cfdi), dias(n_cfdi))
+    merged = conciliacion.match_monto_fecha(aux, cfdi, max_candidatos=int(rng.integers(1, 4)))
+
+    assert merged["ID_AUX"].is_unique and merged["UUID"].is_unique
+    assert (merged["Monto_Search"] == merged["Monto_Target"]).all() and (merged["Monto_Search"] != 0).all()
+    for monto in (100, 100.5, 200, 350.25):
+        esperado = min((aux["Monto_Search"] == monto).sum(), (cfdi["Monto_Target"] == monto).sum())
+        assert (merged["Monto_Search"] == monto).sum() == esperado
+    dias_reales = (merged["Fecha"] - merged["Emisión"]).abs().dt.days
+    assert np.array_equal(merged["Dias_Diferencia"].to_numpy(dtype=float), dias_reales.to_numpy(dtype=float), equal_nan=True)
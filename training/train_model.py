@@ -1,35 +1,261 @@
 import pandas as pd
 import numpy as np
+import io
 import os
+import sys
+import time
+import zipfile
+import argparse
 import joblib
-from sklearn.model_selection import train_test_split, GridSearchCV
-from sklearn.ensemble import RandomForestClassifier
+from pathlib import Path
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401 (habilita HalvingRandomSearchCV)
+from sklearn.model_selection import train_test_split, GridSearchCV, HalvingRandomSearchCV
+from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
 from sklearn.metrics import classification_report, accuracy_score, confusion_matrix
 
+RAIZ = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(RAIZ))
+from modules.modulo_cache import hash_archivo, hash_stream
+from modules.modulo_conciliacion import FEATURES_MODELO, calcular_features
+
 ARCHIVO_DATOS = 'entrenamiento.csv'
-MODELO_SALIDA = '../models/modelo_conciliacion.pkl'
+MODELO_SALIDA = str(RAIZ / 'models' / 'modelo_conciliacion.pkl')
+DIR_HISTORICO = str(RAIZ / 'outputs') # Entregables anteriores (Resultados_IA_*.zip / Conciliacion_IA_*.xlsx)
+DIR_CACHE_FEATURES = str(Path(__file__).resolve().parent / 'cache_features')
 
-# Features utilizadas por la IA para predecir si es un "match"
-FEATURES = ['diferencia_monto', 'diferencia_dias', 'similitud_folio', 'similitud_razon_social', 'es_mismo_monto']
+# Features utilizadas por la IA para predecir si es un "match" (las mismas que calcula modulo_conciliacion)
+FEATURES = FEATURES_MODELO
 TARGET = 'es_match'
 
-def entrenar_modelo():
+# Etiqueta por hoja del entregable cuando el revisor no llenó la columna es_match / Validado. Solo se usa con
+# --etiquetas-por-hoja: la hoja es la predicción del propio modelo, entrenar con ella refuerza sus errores
+ETIQUETA_POR_HOJA = {'Confianza_Alta': 1, 'Coincidencias': 1, 'Confianza_Baja': 0}
+ETIQUETA_HOJA = '_etiqueta_hoja'
+VERSION_CACHE = 2 # Sube cuando cambia lo que se guarda por entregable en cache_features/
+COLUMNAS_VALIDACION = ['es_match', 'Validado', 'VALIDADO']
+ITERACIONES_INCREMENTALES = 50 # Árboles / iteraciones que agrega cada corrida incremental
+
+def _etiqueta_validacion(serie):
+    texto = serie.astype(str).str.strip().str.upper()
+    return texto.map({'1': 1, '1.0': 1, 'SI': 1, 'SÍ': 1, 'TRUE': 1, 'X': 1, '0': 0, '0.0': 0, 'NO': 0, 'FALSE': 0})
+
+def _features_de_hoja(df, hoja):
+    """
+    Features de una hoja de coincidencias de un entregable, con es_match (lo que marcó el revisor; vacío si
+    no hay columna de validación) y ETIQUETA_HOJA (la de ETIQUETA_POR_HOJA, solo si no hay columna).
+    """
+    if df.empty: return None
+    columna_validacion = next((c for c in COLUMNAS_VALIDACION if c in df.columns), None)
+    if columna_validacion:
+        etiqueta, etiqueta_hoja = _etiqueta_validacion(df[columna_validacion]), np.nan
+    elif hoja in ETIQUETA_POR_HOJA:
+        etiqueta, etiqueta_hoja = pd.Series(np.nan, index=df.index), ETIQUETA_POR_HOJA[hoja]
+    else:
+        return None
+
+    if all(c in df.columns for c in FEATURES):
+        features = df[FEATURES].reset_index(drop=True)
+    else:
+        # Entregables anteriores al modelo: se recalculan con el mismo código que usa la conciliación
+        if 'Dias_Diferencia' not in df.columns:
+            fecha = pd.to_datetime(df.get('Fecha'), errors='coerce')
+            emision = pd.to_datetime(df.get('Emisión'), errors='coerce')
+            df = df.assign(Dias_Diferencia=(fecha - emision).abs().dt.days)
+        if 'Monto_Search' not in df.columns or 'Monto_Target' not in df.columns: return None
+        features = calcular_features(df.reset_index(drop=True))
+    features[TARGET] = etiqueta.reset_index(drop=True)
+    features[ETIQUETA_HOJA] = etiqueta_hoja
+    return features.dropna(subset=[TARGET, ETIQUETA_HOJA], how='all')
+
+def _features_de_libro(fuente):
+    hojas = pd.read_excel(fuente, sheet_name=None, engine='openpyxl')
+    partes = [_features_de_hoja(df, nombre) for nombre, df in hojas.items() if nombre != 'Sobrantes_AUX']
+    partes = [p for p in partes if p is not None and not p.empty]
+    return pd.concat(partes, ignore_index=True) if partes else pd.DataFrame(columns=FEATURES + [TARGET, ETIQUETA_HOJA])
+
+def _leer_miembro(ruta_zip, miembro):
+    with zipfile.ZipFile(ruta_zip) as z:
+        return io.BytesIO(z.read(miembro))
+
+def _entregables(directorio):
+    """(clave, nombre, abrir) por cada libro de conciliación del histórico, incluidos los que vienen dentro de un zip."""
+    for ruta in sorted(Path(directorio).glob('*')):
+        if ruta.suffix.lower() == '.xlsx':
+            yield hash_archivo(ruta), ruta.name, (lambda r=ruta: str(r))
+        elif ruta.suffix.lower() == '.zip':
+            try:
+                with zipfile.ZipFile(ruta) as z:
+                    miembros = [m for m in z.namelist() if m.lower().endswith('.xlsx') and 'CONCILIACION_IA' in m.upper()]
+                    for miembro in miembros:
+                        with z.open(miembro) as f:
+                            clave = hash_stream(f)
+                        yield clave, f"{ruta.name}:{miembro}", (lambda r=ruta, m=miembro: _leer_miembro(r, m))
+            except zipfile.BadZipFile:
+                print(f"⚠️ Se omite {ruta.name}: no es un zip válido.")
+
+def cargar_historico(directorio, dir_cache, solo_nuevos=False, etiquetas_por_hoja=False):
+    """
+    Arma la matriz de features desde los entregables anteriores. Cada libro se procesa una sola vez:
+    sus features se guardan en dir_cache/<sha256>.v<VERSION_CACHE>.pkl y se reutilizan en las siguientes corridas.
+    Con solo_nuevos=True devuelve únicamente los libros que no estaban en caché (modo incremental).
+    Solo quedan los pares que validó el revisor (es_match / Validado); con etiquetas_por_hoja, los de hojas
+    sin esa columna toman la etiqueta de ETIQUETA_POR_HOJA.
+    """
+    os.makedirs(dir_cache, exist_ok=True)
+    partes, nuevos, reutilizados = [], 0, 0
+    if not os.path.isdir(directorio):
+        return pd.DataFrame(columns=FEATURES + [TARGET]), 0, 0
+    for clave, nombre, abrir in _entregables(directorio):
+        ruta_cache = os.path.join(dir_cache, f"{clave}.v{VERSION_CACHE}.pkl")
+        if os.path.exists(ruta_cache):
+            reutilizados += 1
+            if not solo_nuevos: partes.append(pd.read_pickle(ruta_cache))
+            continue
+        try:
+            df = _features_de_libro(abrir())
+        except Exception as e:
+            print(f"⚠️ Se omite {nombre}: {e}")
+            continue
+        df.to_pickle(ruta_cache)
+        nuevos += 1
+        partes.append(df)
+    datos = pd.concat(partes, ignore_index=True) if partes else pd.DataFrame(columns=FEATURES + [TARGET, ETIQUETA_HOJA])
+    if etiquetas_por_hoja:
+        datos[TARGET] = datos[TARGET].fillna(datos[ETIQUETA_HOJA])
+    datos = datos.drop(columns=[ETIQUETA_HOJA]).dropna(subset=[TARGET])
+    return datos, nuevos, reutilizados
+
+def _modelo_y_busqueda(tipo, busqueda):
+    if tipo == 'hgb':
+        modelo_base = HistGradientBoostingClassifier(random_state=42, class_weight='balanced')
+        parametros = {
+            'learning_rate': [0.03, 0.05, 0.1, 0.2],
+            'max_leaf_nodes': [15, 31, 63],
+            'max_depth': [None, 6, 10],
+            'l2_regularization': [0.0, 0.1, 1.0],
+            'max_iter': [100, 200, 300],
+        }
+    else:
+        modelo_base = RandomForestClassifier(random_state=42, n_jobs=-1)
+        parametros = {
+            'n_estimators': [50, 100, 200],
+            'max_depth': [None, 10, 20],
+            'min_samples_split': [2, 5, 10],
+            'class_weight': ['balanced']
+        }
+    if busqueda == 'grid':
+        return GridSearchCV(estimator=modelo_base, param_grid=parametros, cv=5, scoring='accuracy', n_jobs=-1)
+    # Successive halving: 27 combinaciones al azar empiezan con pocos ejemplos y solo las mejores reciben más
+    return HalvingRandomSearchCV(estimator=modelo_base, param_distributions=parametros, n_candidates=27, factor=3, cv=5,
+                                 scoring='accuracy', random_state=42, n_jobs=-1)
+
+def _latencia_inferencia(modelo, X, repeticiones=5):
+    """ms por lote completo y microsegundos por par de predict_proba."""
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        modelo.predict_proba(X)
+        tiempos.append(time.perf_counter() - inicio)
+    mejor = min(tiempos)
+    return mejor * 1000, mejor / max(len(X), 1) * 1e6
+
+def _reporte(modelo, X_test, y_test, segundos_entrenamiento, titulo="REPORTE DE RENDIMIENTO"):
+    predicciones = modelo.predict(X_test)
+    precision = accuracy_score(y_test, predicciones)
+    ms_lote, us_par = _latencia_inferencia(modelo, X_test)
+
+    print(f"\n--- 📈 {titulo} ---")
+    print(f"Precisión General (Accuracy): {precision * 100:.2f}%")
+    print(f"⏱️ Tiempo de entrenamiento: {segundos_entrenamiento:.2f}s")
+    print(f"⏱️ Latencia de inferencia: {ms_lote:.2f} ms por lote de {len(X_test)} pares ({us_par:.1f} µs por par)")
+    print("\nMatriz de Confusión (V. Positivos, F. Positivos, etc.):")
+    print(confusion_matrix(y_test, predicciones))
+    print("\nReporte Detallado:")
+    print(classification_report(y_test, predicciones, zero_division=0))
+
+    importancias = getattr(modelo, 'feature_importances_', None)
+    if importancias is not None:
+        print("\n--- 🧠 IMPORTANCIA DE VARIABLES ---")
+        # Ordenamos de mayor a menor importancia
+        importancias_ordenadas = sorted(zip(FEATURES, importancias), key=lambda x: x[1], reverse=True)
+        for feature, importancia in importancias_ordenadas:
+            print(f" - {feature}: {importancia * 100:.1f}%")
+
+def _guardar(modelo, ruta):
+    try:
+        os.makedirs(os.path.dirname(ruta) or '.', exist_ok=True)
+        joblib.dump(modelo, ruta)
+        print(f"\n💾 ¡Modelo guardado con éxito como '{ruta}'!")
+        print("Tu servidor (app.py) ya puede usar esta nueva IA actualizada (se recarga sola al cambiar el archivo).")
+    except Exception as e:
+        print(f"❌ ERROR al guardar el modelo: {e}")
+
+def entrenar_incremental(args):
+    """Agrega iteraciones (HGB) o árboles (RF) al modelo guardado usando solo el histórico nuevo."""
+    if not os.path.exists(args.salida):
+        print(f"❌ ERROR: No existe un modelo previo en '{args.salida}'. Corre primero un entrenamiento completo.")
+        return
+    df, nuevos, reutilizados = cargar_historico(args.historico, args.cache, solo_nuevos=True,
+                                                etiquetas_por_hoja=args.etiquetas_por_hoja)
+    print(f"📂 Entregables nuevos: {nuevos} (ya incorporados antes: {reutilizados})")
+    df = df.dropna(subset=FEATURES + [TARGET])
+    if df.empty or df[TARGET].nunique() < 2:
+        print("⚠️ No hay historia nueva con ejemplos de ambas clases; el modelo se queda igual.")
+        return
+
+    modelo = joblib.load(args.salida)
+    if isinstance(modelo, HistGradientBoostingClassifier):
+        modelo.set_params(warm_start=True, max_iter=modelo.max_iter + ITERACIONES_INCREMENTALES, early_stopping=False)
+    elif isinstance(modelo, RandomForestClassifier):
+        modelo.set_params(warm_start=True, n_estimators=modelo.n_estimators + ITERACIONES_INCREMENTALES)
+    else:
+        print(f"❌ ERROR: El modelo guardado ({type(modelo).__name__}) no admite entrenamiento incremental.")
+        return
+
+    X, y = df[FEATURES].astype(float), df[TARGET].astype(int)
+    print(f"📊 Ejemplos nuevos: {len(df)} (Matches reales: {int(y.sum())})")
+    # Misma división 80/20 que el entrenamiento completo: el reporte se mide en pares que el modelo no vio
+    try:
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42, stratify=y)
+        titulo = "REPORTE DE RENDIMIENTO (20% de la historia nueva, no usado al entrenar)"
+    except ValueError:
+        print("⚠️ Muy pocos ejemplos nuevos para apartar un 20% de prueba; se entrena con todos.")
+        X_train, X_test, y_train, y_test = X, X, y, y
+        titulo = "AJUSTE SOBRE LOS DATOS DE ENTRENAMIENTO (no mide rendimiento en pares nuevos)"
+    inicio = time.perf_counter()
+    modelo.fit(X_train, y_train)
+    segundos = time.perf_counter() - inicio
+    _reporte(modelo, X_test, y_test, segundos, titulo)
+    _guardar(modelo, args.salida)
+
+def entrenar_modelo(args=None):
+    args = args or _argumentos([])
     print("===================================================")
     print("   🧠 ENTRENAMIENTO DE IA PARA CONCILIACIÓN 🧠   ")
     print("===================================================")
 
-    if not os.path.exists(ARCHIVO_DATOS):
-        print(f"❌ ERROR: No se encontró el archivo de datos '{ARCHIVO_DATOS}'.")
+    if args.incremental:
+        return entrenar_incremental(args)
+
+    partes = []
+    historico, nuevos, reutilizados = cargar_historico(args.historico, args.cache, etiquetas_por_hoja=args.etiquetas_por_hoja)
+    if nuevos or reutilizados:
+        print(f"📂 Histórico de entregables: {nuevos} procesados, {reutilizados} desde caché ({len(historico)} pares)")
+        partes.append(historico)
+    if os.path.exists(args.datos):
+        print(f"📂 Cargando datos históricos desde {args.datos}...")
+        try:
+            partes.append(pd.read_csv(args.datos))
+        except Exception as e:
+            print(f"❌ ERROR al leer el archivo CSV: {e}")
+            return
+
+    if not partes:
+        print(f"❌ ERROR: No se encontraron entregables en '{args.historico}' ni el archivo de datos '{args.datos}'.")
         print("Asegúrate de tener un histórico de conciliaciones previas para entrenar a la IA.")
         return
+    df = pd.concat(partes, ignore_index=True)
 
-    print(f"📂 Cargando datos históricos desde {ARCHIVO_DATOS}...")
-    try:
-        df = pd.read_csv(ARCHIVO_DATOS)
-    except Exception as e:
-        print(f"❌ ERROR al leer el archivo CSV: {e}")
-        return
-    
     # Validación de columnas
     columnas_faltantes = [col for col in FEATURES + [TARGET] if col not in df.columns]
     if columnas_faltantes:
@@ -38,13 +264,13 @@ def entrenar_modelo():
 
     # Limpieza de datos nulos
     df = df.dropna(subset=FEATURES + [TARGET])
-    
+
     if len(df) < 20:
         print("⚠️ ADVERTENCIA: Tienes muy pocos datos para un entrenamiento cruzado efectivo.")
         print(f"Filas actuales: {len(df)}. Se recomienda tener al menos 100 ejemplos históricos.")
 
-    X = df[FEATURES]
-    y = df[TARGET]
+    X = df[FEATURES].astype(float)
+    y = df[TARGET].astype(int)
 
     print(f"📊 Total de ejemplos para entrenar: {len(df)} (Matches reales: {int(y.sum())})")
 
@@ -56,58 +282,37 @@ def entrenar_modelo():
         print("Posible causa: Necesitas tener ejemplos de ambas clases (matches exitosos y fallidos) en tu CSV.")
         return
 
-    print("⚙️ Buscando la configuración matemática óptima (esto puede tardar unos segundos)...")
-    
-    # Parámetros para buscar el mejor modelo
-    parametros_grid = {
-        'n_estimators': [50, 100, 200],
-        'max_depth': [None, 10, 20],
-        'min_samples_split': [2, 5, 10],
-        'class_weight': ['balanced']
-    }
-
-    modelo_base = RandomForestClassifier(random_state=42)
-    
-    # Usamos validación cruzada para asegurar que el modelo sea robusto
-    buscador = GridSearchCV(estimator=modelo_base, param_grid=parametros_grid, cv=5, scoring='accuracy', n_jobs=-1)
-    
+    print(f"⚙️ Buscando la configuración óptima ({args.modelo.upper()}, búsqueda {args.busqueda})...")
+    buscador = _modelo_y_busqueda(args.modelo, args.busqueda)
+
+    inicio = time.perf_counter()
     try:
         buscador.fit(X_train, y_train)
     except Exception as e:
         print(f"❌ ERROR durante el entrenamiento: {e}")
         print("Si el error menciona 'splits', es porque tienes muy pocos datos en el CSV para hacer validación cruzada (cv=5).")
         return
+    segundos = time.perf_counter() - inicio
 
     mejor_modelo = buscador.best_estimator_
 
     print("\n✅ ¡Entrenamiento completado!")
     print(f"Mejor configuración encontrada: {buscador.best_params_}")
-    
-    # Evaluación del modelo
-    predicciones = mejor_modelo.predict(X_test)
-    precision = accuracy_score(y_test, predicciones)
-    
-    print("\n--- 📈 REPORTE DE RENDIMIENTO ---")
-    print(f"Precisión General (Accuracy): {precision * 100:.2f}%")
-    print("\nMatriz de Confusión (V. Positivos, F. Positivos, etc.):")
-    print(confusion_matrix(y_test, predicciones))
-    print("\nReporte Detallado:")
-    print(classification_report(y_test, predicciones))
-
-    print("\n--- 🧠 IMPORTANCIA DE VARIABLES ---")
-    importancias = mejor_modelo.feature_importances_
-    # Ordenamos de mayor a menor importancia
-    importancias_ordenadas = sorted(zip(FEATURES, importancias), key=lambda x: x[1], reverse=True)
-    for feature, importancia in importancias_ordenadas:
-        print(f" - {feature}: {importancia * 100:.1f}%")
+    _reporte(mejor_modelo, X_test, y_test, segundos)
+    _guardar(mejor_modelo, args.salida)
 
-    # Guardar el modelo
-    try:
-        joblib.dump(mejor_modelo, MODELO_SALIDA)
-        print(f"\n💾 ¡Modelo guardado con éxito como '{MODELO_SALIDA}'!")
-        print("Tu servidor (app.py) ya puede usar esta nueva IA actualizada.")
-    except Exception as e:
-        print(f"❌ ERROR al guardar el modelo: {e}")
+def _argumentos(argv=None):
+    parser = argparse.ArgumentParser(description="Entrena el modelo que califica las coincidencias de la conciliación.")
+    parser.add_argument('--historico', default=DIR_HISTORICO, help="Carpeta con entregables anteriores (.xlsx o .zip)")
+    parser.add_argument('--datos', default=ARCHIVO_DATOS, help="CSV adicional con columnas de features + es_match")
+    parser.add_argument('--cache', default=DIR_CACHE_FEATURES, help="Carpeta de caché de features por entregable")
+    parser.add_argument('--salida', default=MODELO_SALIDA)
+    parser.add_argument('--modelo', choices=['hgb', 'rf'], default='hgb', help="HistGradientBoosting (default) o RandomForest")
+    parser.add_argument('--busqueda', choices=['halving', 'grid'], default='halving')
+    parser.add_argument('--incremental', action='store_true', help="Solo agrega al modelo guardado la historia nueva")
+    parser.add_argument('--etiquetas-por-hoja', action='store_true',
+                        help="Sin es_match / Validado, tomar Confianza_Alta como match y Confianza_Baja como no match")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    entrenar_modelo()
\ No newline at end of file
+    entrenar_modelo(_argumentos())